@@ -0,0 +1,339 @@
+"""
+Бенчмарки бота на временных базах (рабочую bot.db не трогают):
+  python bench.py due [история]     — выборка напоминаний: текущая форма против прежней
+  python bench.py kpi [история]     — KPI: свёртка kpi_daily, один проход по tasks и прежний расчёт
+  python bench.py sheets [задач]    — синхронизация Google Sheets на офлайн-заглушке (tests/sheets_fake.py)
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+# bot.py при импорте требует токен; бенчмарки в Telegram не ходят
+os.environ.setdefault("BOT_TOKEN", "123456:offline-bench-token")
+
+import bot
+from bot import (
+    UTC, DB_PATH, DUE_SCAN_SQL, GREEN,
+    db_pool, db_write, init_db, migrate_db,
+    kpi_daily_backfill, _compute_kpi, _compute_kpi_from_tasks,
+    gs_registry, gs_sync_all, _agcm_cache, _agcm_cache_projects,
+    sheets_outbox_put, sheets_outbox_drain, projects_sync_overdues,
+)
+from tests.sheets_fake import FakeSheetsBackend, use_fake
+
+# параметры заглушки для `bench.py sheets`: задержка «API», доля ответов 429, локаль таблицы
+GS_FAKE_LATENCY_MS = max(0.0, float(os.getenv("GS_FAKE_LATENCY_MS", "0")))
+GS_FAKE_429_RATE = min(1.0, max(0.0, float(os.getenv("GS_FAKE_429_RATE", "0"))))
+GS_FAKE_LOCALE = os.getenv("GS_FAKE_LOCALE", "en").strip().lower()
+
+# Прежний расчёт (Python-медианы + запрос серии на каждого сотрудника) — только для сравнения в `bench.py kpi`.
+async def _compute_kpi_legacy(db) -> list[list]:
+    now = datetime.now(UTC)
+    week_ago = int((now - timedelta(days=7)).timestamp())
+    month_ago = int((now - timedelta(days=30)).timestamp())
+
+    # заберём завершённые с delay_minutes
+    cur = await db.execute("""
+        SELECT u.full_name, u.tg_id, t.completed_ts, COALESCE(t.delay_minutes, 0)
+        FROM tasks t
+        JOIN users u ON u.id = t.user_id
+        WHERE t.status='done' AND t.completed_ts IS NOT NULL
+    """)
+    rows = await cur.fetchall()
+
+    from statistics import median
+
+    # аккумуляторы
+    data = {}  # (emp, period) -> list[delay_minutes]
+    for full, tg, completed_at, delay in rows:
+        emp = (full or f"user_{tg}")
+        delay = int(delay or 0)
+        # месяц
+        if completed_at >= month_ago:
+            data.setdefault((emp, "месяц"), []).append(delay)
+        # неделя
+        if completed_at >= week_ago:
+            data.setdefault((emp, "неделя"), []).append(delay)
+
+    # streak «дней без просрочек»: считаем по последним дням, пока нет задач с delay>0
+    # упрощённо: считаем подряд от вчера назад по датам completed_at
+    streak_cache = {}
+    for emp_period in list(data.keys()):
+        emp = emp_period[0]
+        if emp in streak_cache:
+            continue
+        cur2 = await db.execute("""
+            SELECT DATE(t.completed_at), MAX(CASE WHEN COALESCE(t.delay_minutes,0)>0 THEN 1 ELSE 0 END)
+            FROM tasks t
+            JOIN users u ON u.id = t.user_id
+            WHERE u.full_name=? OR u.full_name IS NULL
+            GROUP BY DATE(t.completed_at)
+            ORDER BY DATE(t.completed_at) DESC
+            LIMIT 60
+        """, (emp,))
+        days = await cur2.fetchall()
+        s = 0
+        # считаем от сегодняшней даты назад: если сегодня нет записей — streak не сбиваем
+        for d, has_late in days:
+            if int(has_late or 0) == 0:
+                s += 1
+            else:
+                break
+        streak_cache[emp] = s
+
+    out = []
+    for (emp, period), delays in sorted(data.items()):
+        total = len(delays)
+        late = sum(1 for x in delays if x > 0)
+        ontime = total - late
+        med = (median([x for x in delays if x > 0]) if late else 0)
+        pct = round(ontime / total * 100, 1) if total else 100.0
+        out.append([
+            emp, period, ontime, late, med, pct, streak_cache.get(emp, 0)
+        ])
+    return out
+
+# Старая форма выборки — только для сравнения в `bench.py due`.
+# NOT INDEXED воспроизводит прежний план: idx_tasks_nextrem это OR не обслуживал, был полный скан.
+_DUE_SCAN_LEGACY_SQL = """
+    SELECT id FROM tasks NOT INDEXED
+     WHERE status != 'done'
+       AND (next_reminder_at IS NULL OR next_reminder_at <= :now_iso OR deadline <= :now_iso)
+"""
+
+async def bench_due_scan(history_sizes=(10_000, 100_000, 1_000_000), open_tasks: int = 500, repeat: int = 20) -> list[dict]:
+    """
+    Бенчмарк выборки напоминаний на временной базе (рабочую не трогаем):
+    open_tasks открытых задач + растущая история done. Возвращает мс на запрос для новой и старой формы.
+    """
+    now = datetime.now(UTC)
+    now_ts = int(now.timestamp())
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = await aiosqlite.connect(os.path.join(tmp, "bench.db"), isolation_level=None)
+        try:
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=OFF")
+            await migrate_db(db)
+            n_users = 50
+            await db.executemany(
+                "INSERT INTO users(id, tg_id, full_name, role) VALUES (?, ?, ?, 'employee')",
+                ((u, u, f"bench {u}") for u in range(1, n_users + 1)),
+            )
+
+            def _open_rows():
+                for k in range(open_tasks):
+                    dl = now + timedelta(minutes=k - open_tasks // 2)
+                    nxt = None if k % 3 else (dl + timedelta(minutes=5)).isoformat()
+                    yield (1 + k % n_users, f"open {k}", dl.isoformat(), "in_progress", nxt)
+            await db.execute("BEGIN")
+            await db.executemany(
+                "INSERT INTO tasks(user_id, description, deadline, status, next_reminder_at) VALUES (?,?,?,?,?)",
+                _open_rows(),
+            )
+            await db.execute("COMMIT")
+
+            have = 0
+            for size in history_sizes:
+                def _done_rows(a=have, b=size):
+                    for k in range(a, b):
+                        ts = (now - timedelta(minutes=k)).isoformat()
+                        yield (1 + k % n_users, "done", ts, "done", ts, ts)
+                await db.execute("BEGIN")
+                await db.executemany(
+                    "INSERT INTO tasks(user_id, description, deadline, status, next_reminder_at, completed_at) "
+                    "VALUES (?,?,?,?,?,?)",
+                    _done_rows(),
+                )
+                await db.execute("COMMIT")
+                have = size
+                await db.execute("ANALYZE")
+
+                res = {"history": size}
+                for name, sql, params in (
+                    ("new_ms", DUE_SCAN_SQL, {"now": now_ts}),
+                    ("legacy_ms", _DUE_SCAN_LEGACY_SQL, {"now_iso": now.isoformat()}),
+                ):
+                    t0 = time.perf_counter()
+                    for _ in range(repeat):
+                        cur = await db.execute(sql, params)
+                        n = len(await cur.fetchall())
+                    res[name] = round((time.perf_counter() - t0) * 1000 / repeat, 3)
+                    res[name.replace("_ms", "_rows")] = n
+                out.append(res)
+        finally:
+            await db.close()
+    return out
+
+async def bench_kpi(history_sizes=(10_000, 100_000, 300_000), n_users: int = 50, repeat: int = 3) -> list[dict]:
+    """
+    Бенчмарк KPI на временной базе: история done-задач за ~2 года у n_users сотрудников,
+    каждая 7-я — с просрочкой. Возвращает мс на расчёт: по свёртке kpi_daily, одним проходом
+    по tasks и прежним способом; same — совпали ли свёртка и проход по tasks.
+    """
+    now = datetime.now(UTC)
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = await aiosqlite.connect(os.path.join(tmp, "bench.db"), isolation_level=None)
+        try:
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=OFF")
+            await migrate_db(db)
+            await db.executemany(
+                "INSERT INTO users(id, tg_id, full_name, role) VALUES (?, ?, ?, 'employee')",
+                ((u, u, f"bench {u}") for u in range(1, n_users + 1)),
+            )
+            have = 0
+            for size in history_sizes:
+                span_min = 2 * 365 * 24 * 60
+                def _done_rows(a=have, b=size):
+                    for k in range(a, b):
+                        ts = (now - timedelta(minutes=(k * 7919) % span_min)).isoformat()
+                        delay = (k % 180) + 1 if k % 7 == 0 else 0
+                        yield (1 + k % n_users, "done", ts, "done", ts, delay)
+                await db.execute("BEGIN")
+                await db.executemany(
+                    "INSERT INTO tasks(user_id, description, deadline, status, completed_at, delay_minutes) "
+                    "VALUES (?,?,?,?,?,?)",
+                    _done_rows(),
+                )
+                await db.execute("COMMIT")
+                have = size
+                await kpi_daily_backfill(db)
+                await db.execute("ANALYZE")
+
+                res = {"history": size}
+                got = {}
+                for name, fn in (
+                    ("rollup_ms", _compute_kpi),
+                    ("tasks_ms", _compute_kpi_from_tasks),
+                    ("legacy_ms", _compute_kpi_legacy),
+                ):
+                    t0 = time.perf_counter()
+                    for _ in range(repeat):
+                        rows = await fn(db)
+                    res[name] = round((time.perf_counter() - t0) * 1000 / repeat, 1)
+                    got[name] = rows
+                res["rows"] = len(got["rollup_ms"])
+                res["same"] = got["rollup_ms"] == got["tasks_ms"]
+                out.append(res)
+        finally:
+            await db.close()
+    return out
+
+async def bench_sheets_sync(n_tasks: int = 2000, n_users: int = 20) -> list[dict]:
+    """
+    Бенчмарк синхронизации с Google Sheets на офлайн-заглушке и временной базе:
+    полная пересборка, тихий прогон, правка пяти задач, очередь проекта, просрочки проектов.
+    Для каждой фазы — время и число «запросов к API». Запуск: `python bench.py sheets [задач]`.
+    """
+    gs_fake = FakeSheetsBackend(GS_FAKE_LATENCY_MS, GS_FAKE_429_RATE, GS_FAKE_LOCALE)
+    gs_registry.invalidate()
+    _agcm_cache.update(path=None, mgr=None)
+    _agcm_cache_projects.update(path=None, mgr=None)
+    now = datetime.now(UTC)
+    out = []
+    with use_fake(gs_fake), tempfile.TemporaryDirectory() as tmp:
+        db_pool.path = os.path.join(tmp, "bench.db")
+        await db_pool.open()
+        try:
+            await init_db()
+            async with db_write() as db:
+                await db.executemany(
+                    "INSERT INTO users(id, tg_id, full_name, role) VALUES (?, ?, ?, 'employee')",
+                    ((u, u, f"bench {u}") for u in range(1, n_users + 1)),
+                )
+                def _rows():
+                    for k in range(n_tasks):
+                        dl = now - timedelta(hours=(k % 400) * 22) + timedelta(days=2)  # ~год истории
+                        done = k % 3 != 0
+                        fin = (dl + timedelta(minutes=(k % 5) * 40 - 60)).isoformat() if done else None
+                        yield (1 + k % n_users, f"bench task {k}", dl.isoformat(), "done" if done else "in_progress", fin)
+                await db.executemany(
+                    "INSERT INTO tasks(user_id, description, deadline, status, completed_at) VALUES (?,?,?,?,?)", _rows()
+                )
+                await kpi_daily_backfill(db)
+                start = (now - timedelta(days=10)).date()
+                await db.execute("INSERT INTO projects(id, name, created_by_id) VALUES (1, 'bench', 1)")
+                await db.execute(
+                    "INSERT INTO project_meta(project_id, prj_type, start_date, deadline, sheet_title) VALUES (1, '3D', ?, ?, 'bench')",
+                    (start.isoformat(), (start + timedelta(days=40)).isoformat()),
+                )
+                await db.commit()
+
+            async def _projects_ops():
+                start = (now - timedelta(days=10)).date()
+                async with db_write() as db:
+                    await sheets_outbox_put(db, "ensure_project_ws", sheet_title="bench",
+                                            start=start.isoformat(), end=(start + timedelta(days=40)).isoformat())
+                    for k in range(50):
+                        cur = await db.execute(
+                            "UPDATE project_meta SET next_row = next_row + 1 WHERE project_id=1 RETURNING next_row - 1")
+                        row = (await cur.fetchone())[0]
+                        day = start + timedelta(days=k % 20)
+                        cur = await db.execute("""
+                            INSERT INTO project_tasks(project_id, row_index, task_text, assignee_user_id, planned_date, duration_days, status)
+                            VALUES(1, ?, ?, 1, ?, 1, 'open')
+                        """, (row, f"bench step {k}", day.isoformat()))
+                        await sheets_outbox_put(db, "set_values", sheet_title="bench", row=row, col=1, values=[f"bench step {k}", "bench 1"])
+                        await sheets_outbox_put(db, "paint", sheet_title="bench", row=row, col=3 + (day - start).days,
+                                                color=GREEN, ptask_id=cur.lastrowid)
+                    await db.commit()
+                while await sheets_outbox_drain():
+                    pass
+
+            async def _edit():
+                async with db_write() as db:
+                    await db.execute("UPDATE tasks SET description = description || ' (ред.)' WHERE id <= 5")
+                    await db.commit()
+                await gs_sync_all()
+
+            for name, fn in (
+                ("full", lambda: gs_sync_all(full=True)),
+                ("quiet", gs_sync_all),
+                ("edit5", _edit),
+                ("projects50", _projects_ops),
+                ("overdues", projects_sync_overdues),
+                ("overdues_quiet", projects_sync_overdues),
+            ):
+                gs_fake.reset_stats()
+                t0 = time.perf_counter()
+                await fn()
+                out.append({"phase": name, "ms": round((time.perf_counter() - t0) * 1000, 1),
+                            "calls": gs_fake.calls(), "by_method": dict(gs_fake.stats)})
+        finally:
+            await db_pool.close()
+            db_pool.path = DB_PATH
+    return out
+
+def _sizes(arg: str | None, default: int, parts: tuple[int, ...]) -> list[int]:
+    top = int(arg) if arg else default
+    return sorted({max(1, top // p) for p in parts})
+
+async def _main(argv: list[str]):
+    what = argv[0] if argv else ""
+    arg = argv[1] if len(argv) > 1 else None
+    if what == "due":
+        print("история | новая, мс | старая, мс | строк")
+        for r in await bench_due_scan(_sizes(arg, 1_000_000, (100, 10, 1))):
+            print(f"{r['history']} | {r['new_ms']} | {r['legacy_ms']} | {r['new_rows']}/{r['legacy_rows']}")
+    elif what == "kpi":
+        print("история | свёртка, мс | tasks, мс | прежний, мс | строк | совпало")
+        for r in await bench_kpi(_sizes(arg, 100_000, (10, 1))):
+            print(f"{r['history']} | {r['rollup_ms']} | {r['tasks_ms']} | {r['legacy_ms']} | {r['rows']} | "
+                  f"{'да' if r['same'] else 'нет'}")
+    elif what == "sheets":
+        for r in await bench_sheets_sync(int(arg) if arg else 2000):
+            methods = ", ".join(f"{k}={v}" for k, v in sorted(r["by_method"].items()))
+            print(f"{r['phase']:<15} {r['ms']:>9} ms  {r['calls']:>4} calls  {methods}")
+    else:
+        raise SystemExit(__doc__)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1:]))
@@ -6,6 +6,13 @@ from datetime import datetime, timedelta, timezone, date
 from math import ceil
 from dateutil import parser as dateparser
 from html import escape
+import re
+import time
+import random
+import heapq
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 
 
 from aiogram.filters import StateFilter
@@ -20,6 +27,7 @@ from aiogram.enums import ParseMode
 from aiogram.filters import Command
 from aiogram.filters.command import CommandObject
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 
 from dotenv import load_dotenv
 from pathlib import Path
@@ -33,6 +41,7 @@ import aiosqlite
 
 # --- Google Sheets (async) ---
 import json
+import hashlib
 import gspread_asyncio
 from google.oauth2.service_account import Credentials
 
@@ -73,11 +82,475 @@ DB_PATH = "bot.db"
 PAGE_SIZE = 8  # постраничный выбор сотрудников
 
 # =========================
-# Инициализация БД
+# Пул соединений SQLite
+# =========================
+DB_POOL_READERS = max(1, int(os.getenv("DB_POOL_READERS", "4")))
+DB_SLOW_ACQUIRE_MS = int(os.getenv("DB_SLOW_ACQUIRE_MS", "200"))
+# Групповой commit: мелкие записи, пришедшие в пределах окна, фиксируются одной транзакцией (одним fsync).
+# 0 — выключено, каждая секция db_write() коммитится сама, как раньше.
+DB_GROUP_COMMIT_MS = max(0.0, float(os.getenv("DB_GROUP_COMMIT_MS", "4")))
+DB_GROUP_COMMIT_MAX = max(1, int(os.getenv("DB_GROUP_COMMIT_MAX", "64")))
+
+# (task, connection) писателя, захваченного текущей задачей — для вложенных захватов
+_db_writer_owner: ContextVar[tuple | None] = ContextVar("_db_writer_owner", default=None)
+
+# Счётчик запросов текущего апдейта (ставит AccessMiddleware); None — вне апдейта
+_db_query_counter: ContextVar[dict | None] = ContextVar("_db_query_counter", default=None)
+_USERS_TABLE_RE = re.compile(r"\busers\b", re.IGNORECASE)
+
+class _CountedConn:
+    """
+    Тонкая обёртка над aiosqlite.Connection: считает execute*-вызовы
+    в счётчике текущего апдейта. Всё остальное проксирует как есть.
+    """
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn: aiosqlite.Connection):
+        self._conn = conn
+
+    @staticmethod
+    def _count(sql: str):
+        c = _db_query_counter.get()
+        if c is not None:
+            c["queries"] += 1
+            if _USERS_TABLE_RE.search(sql or ""):
+                c["users"] += 1
+
+    def execute(self, sql, *args, **kwargs):
+        self._count(sql)
+        return self._conn.execute(sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        self._count(sql)
+        return self._conn.executemany(sql, *args, **kwargs)
+
+    def executescript(self, sql, *args, **kwargs):
+        self._count(sql)
+        return self._conn.executescript(sql, *args, **kwargs)
+
+    def execute_fetchall(self, sql, *args, **kwargs):
+        self._count(sql)
+        return self._conn.execute_fetchall(sql, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class _BatchConn(_CountedConn):
+    """
+    Писатель внутри группового commit: секция живёт в своём SAVEPOINT общей транзакции.
+    commit() — no-op (фиксирует пул по окну), rollback() откатывает только свою секцию.
+    """
+    __slots__ = ()
+
+    async def commit(self):
+        return None
+
+    async def rollback(self):
+        await self._conn.execute("ROLLBACK TO w")
+
+class DBPool:
+    """
+    Долгоживущие соединения SQLite вместо aiosqlite.connect() на каждый апдейт.
+      • читатели (DB_POOL_READERS шт., PRAGMA query_only) — параллельные SELECT в WAL;
+      • один писатель — все изменения идут через него строго по очереди.
+    Вложенный захват внутри той же задачи переиспользует уже взятого писателя,
+    поэтому хелперы вида ensure_user(db, ...) можно звать как раньше.
+
+    Групповой commit (DB_GROUP_COMMIT_MS > 0): секции записи разных задач копятся в одной
+    транзакции и коммитятся разом по окну или по DB_GROUP_COMMIT_MAX. Выход из `async with db_write()`
+    ждёт этого commit — вызывающий продолжает только когда его данные уже на диске.
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers_n = readers
+        self._readers: asyncio.Queue | None = None
+        self._writer: _CountedConn | None = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._conns: list[aiosqlite.Connection] = []
+        self.stats = {
+            lane: {"acquired": 0, "waited": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0}
+            for lane in ("read", "write")
+        }
+        self.group_ms = DB_GROUP_COMMIT_MS
+        self.group_max = DB_GROUP_COMMIT_MAX
+        # ожидающие durability-подтверждения секции текущей пачки и колбэки «после commit»
+        self._pending: list[asyncio.Future] = []
+        self._after_commit: list = []
+        self._flush_task: asyncio.Task | None = None
+        self.commit_stats = {"commits": 0, "sections": 0, "max_batch": 0, "failed": 0}
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA busy_timeout=5000")
+        # foreign_keys не включаем: как и раньше, вне init_db бот работал без проверки внешних ключей
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        self._conns.append(conn)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # писатель первым: он же включает WAL в файле базы
+            self._writer = _CountedConn(await self._connect(readonly=False))
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_n):
+                self._readers.put_nowait(_CountedConn(await self._connect(readonly=True)))
+            logging.info("DB pool opened: %s readers + 1 writer (%s)", self.readers_n, self.path)
+
+    async def close(self):
+        if self._writer is not None:
+            async with self._writer_lock:
+                await self._flush_locked()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        for conn in self._conns:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        self._conns.clear()
+        self._writer = None
+        self._readers = None
+
+    def _account(self, lane: str, waited_ms: float):
+        st = self.stats[lane]
+        st["acquired"] += 1
+        st["wait_total_ms"] += waited_ms
+        if waited_ms > st["wait_max_ms"]:
+            st["wait_max_ms"] = waited_ms
+        if waited_ms >= 1:
+            st["waited"] += 1
+        if waited_ms >= DB_SLOW_ACQUIRE_MS:
+            logging.warning("DB %s lane: slow acquire %.0f ms", lane, waited_ms)
+
+    def _held_writer(self) -> _CountedConn | None:
+        owner = _db_writer_owner.get()
+        if owner and owner[0] is asyncio.current_task():
+            return owner[1]
+        return None
+
+    @asynccontextmanager
+    async def read(self):
+        held = self._held_writer()
+        if held is not None:
+            # внутри записи читаем через того же писателя — видим свои незакоммиченные изменения
+            yield held
+            return
+        if self._writer is None:
+            await self.open()
+        t0 = time.perf_counter()
+        conn = await self._readers.get()
+        self._account("read", (time.perf_counter() - t0) * 1000)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self, batch: bool = True):
+        held = self._held_writer()
+        if held is not None:
+            yield held
+            return
+        if self._writer is None:
+            await self.open()
+        if not batch or self.group_ms <= 0:
+            async with self._write_direct() as conn:
+                yield conn
+            return
+
+        t0 = time.perf_counter()
+        async with self._writer_lock:
+            self._account("write", (time.perf_counter() - t0) * 1000)
+            raw = self._writer._conn
+            if not raw.in_transaction:
+                await raw.execute("BEGIN IMMEDIATE")
+            await raw.execute("SAVEPOINT w")
+            conn = _BatchConn(raw)
+            token = _db_writer_owner.set((asyncio.current_task(), conn))
+            try:
+                yield conn
+            except BaseException:
+                try:
+                    await raw.execute("ROLLBACK TO w")
+                    await raw.execute("RELEASE w")
+                except Exception:
+                    pass
+                raise
+            finally:
+                _db_writer_owner.reset(token)
+            await raw.execute("RELEASE w")
+            ack = asyncio.get_running_loop().create_future()
+            self._pending.append(ack)
+            if len(self._pending) >= self.group_max:
+                await self._flush_locked()
+            elif self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+        # durability: дожидаемся commit своей пачки уже без лока — остальные продолжают копить
+        await ack
+
+    @asynccontextmanager
+    async def _write_direct(self):
+        """Писатель без группировки: сперва сбрасываем накопленную пачку, дальше — обычные commit."""
+        t0 = time.perf_counter()
+        async with self._writer_lock:
+            self._account("write", (time.perf_counter() - t0) * 1000)
+            await self._flush_locked()
+            conn = self._writer
+            token = _db_writer_owner.set((asyncio.current_task(), conn))
+            try:
+                yield conn
+                # хвосты без явного commit (например, log_task_event после commit) — фиксируем
+                if conn.in_transaction:
+                    await conn.commit()
+                    self.commit_stats["commits"] += 1
+            except BaseException:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                _db_writer_owner.reset(token)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.group_ms / 1000)
+        async with self._writer_lock:
+            self._flush_task = None
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        """Закоммитить пачку и раздать подтверждения. Только под _writer_lock."""
+        pending, self._pending = self._pending, []
+        hooks, self._after_commit = self._after_commit, []
+        if not pending:
+            return
+        raw = self._writer._conn
+        err = None
+        try:
+            if raw.in_transaction:
+                await raw.commit()
+        except Exception as e:
+            err = e
+            self.commit_stats["failed"] += 1
+            logging.warning(f"DB group commit failed ({len(pending)} sections): {e}")
+            try:
+                await raw.rollback()
+            except Exception:
+                pass
+        else:
+            st = self.commit_stats
+            st["commits"] += 1
+            st["sections"] += len(pending)
+            st["max_batch"] = max(st["max_batch"], len(pending))
+            for fn in hooks:
+                try:
+                    fn()
+                except Exception as e:
+                    logging.warning(f"after-commit hook failed: {e}")
+        for ack in pending:
+            if not ack.done():
+                ack.set_exception(err) if err else ack.set_result(None)
+
+    def after_commit(self, fn):
+        """
+        Повторить fn после фактического commit текущей пачки (сброс кэшей).
+        Без открытой пачки ничего не делает — вызывающий уже отработал fn сам.
+        """
+        if self._writer is not None and self._writer._conn.in_transaction:
+            self._after_commit.append(fn)
+
+    def snapshot(self) -> dict:
+        out = {}
+        for lane, st in self.stats.items():
+            avg = st["wait_total_ms"] / st["acquired"] if st["acquired"] else 0.0
+            out[lane] = {
+                "acquired": st["acquired"],
+                "waited": st["waited"],
+                "wait_total_ms": round(st["wait_total_ms"], 2),
+                "wait_max_ms": round(st["wait_max_ms"], 2),
+                "wait_avg_ms": round(avg, 2),
+            }
+        out["read"]["idle"] = self._readers.qsize() if self._readers else 0
+        out["write"]["busy"] = self._writer_lock.locked()
+        cs = self.commit_stats
+        out["commit"] = {
+            **cs,
+            "window_ms": self.group_ms,
+            "sections_per_commit": round(cs["sections"] / cs["commits"], 2) if cs["commits"] else 0.0,
+        }
+        return out
+
+db_pool = DBPool(DB_PATH, DB_POOL_READERS)
+
+def db_read():
+    """Соединение для чтения из пула: `async with db_read() as db:`."""
+    return db_pool.read()
+
+def db_write(batch: bool = True):
+    """
+    Единственное соединение-писатель: `async with db_write() as db:`.
+    batch=False — без группового commit (миграции и всё, что само управляет транзакцией).
+    """
+    return db_pool.write(batch)
+
+# =========================
+# Исходящие сообщения: общая очередь с лимитами Telegram
 # =========================
-CREATE_SQL = """
-PRAGMA journal_mode=WAL;
+SEND_WORKERS = max(1, int(os.getenv("SEND_WORKERS", "8")))
+SEND_RATE_PER_SEC = float(os.getenv("SEND_RATE_PER_SEC", "25"))        # глобально (лимит Telegram ~30/с)
+SEND_PER_CHAT_INTERVAL = float(os.getenv("SEND_PER_CHAT_INTERVAL", "1.0"))  # не чаще 1/с в один чат
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+
+class OutboundQueue:
+    """
+    Все bot.send_message идут через очередь:
+      • ограниченное число воркеров — один медленный чат не держит остальных;
+      • глобальный темп SEND_RATE_PER_SEC и интервал на чат SEND_PER_CHAT_INTERVAL
+        (слот в чате резервируется при постановке в работу — порядок сообщений сохраняется);
+      • TelegramRetryAfter — пауза всей очереди на retry_after и повтор, сообщение не теряется;
+      • сетевые/5xx ошибки — повтор с backoff; остальные ошибки отдаются вызывающему.
+    """
+
+    def __init__(self, workers: int, rate: float, per_chat_interval: float):
+        self.workers_n = workers
+        self.min_gap = 1.0 / rate if rate > 0 else 0.0
+        self.per_chat_interval = per_chat_interval
+        self._q: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._next_global = 0.0
+        self._pause_until = 0.0
+        self._chat_next: dict[int, float] = {}
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "retried": 0, "retry_after": 0,
+                      "latency_total_ms": 0.0, "latency_max_ms": 0.0}
+
+    def _ensure_started(self):
+        if self._q is None:
+            self._q = asyncio.Queue()
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(), name=f"outbox-{i}")
+                             for i in range(self.workers_n)]
+
+    async def close(self):
+        for t in self._workers:
+            t.cancel()
+        for t in self._workers:
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._workers = []
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Поставить сообщение в очередь; future завершится отправленным Message или исключением."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        self.stats["queued"] += 1
+        self._q.put_nowait((chat_id, text, kwargs, fut, time.monotonic()))
+        return fut
+
+    async def _wait_slot(self, chat_id: int):
+        now = time.monotonic()
+        # глобальный темп (+ пауза после flood-wait)
+        slot = max(now, self._next_global, self._pause_until)
+        self._next_global = slot + self.min_gap
+        # слот в конкретном чате
+        chat_slot = max(slot, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = chat_slot + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        delay = chat_slot - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, fut, enq_at = await self._q.get()
+            try:
+                if not fut.cancelled():
+                    await self._deliver(chat_id, text, kwargs, fut, enq_at)
+            finally:
+                self._q.task_done()
+
+    async def _deliver(self, chat_id, text, kwargs, fut, enq_at):
+        # повторяем в том же воркере — так сообщения в одном чате не перемешиваются
+        attempt = 0
+        while True:
+            await self._wait_slot(chat_id)
+            try:
+                msg = await bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                self._pause_until = max(self._pause_until, time.monotonic() + e.retry_after)
+                logging.warning("outbox: flood wait %ss (chat %s)", e.retry_after, chat_id)
+                err = e
+            except (TelegramNetworkError, TelegramServerError) as e:
+                await asyncio.sleep(min(30, 2 ** attempt))
+                err = e
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            else:
+                lat_ms = (time.monotonic() - enq_at) * 1000
+                self.stats["sent"] += 1
+                self.stats["latency_total_ms"] += lat_ms
+                self.stats["latency_max_ms"] = max(self.stats["latency_max_ms"], lat_ms)
+                if not fut.done():
+                    fut.set_result(msg)
+                return
+
+            attempt += 1
+            if attempt >= SEND_MAX_RETRIES:
+                self.stats["failed"] += 1
+                if not fut.done():
+                    fut.set_exception(err)
+                return
+            self.stats["retried"] += 1
+
+    def snapshot(self) -> dict:
+        st = self.stats
+        avg = st["latency_total_ms"] / st["sent"] if st["sent"] else 0.0
+        return {
+            "depth": self._q.qsize() if self._q else 0,
+            "queued": st["queued"], "sent": st["sent"], "failed": st["failed"],
+            "retried": st["retried"], "retry_after": st["retry_after"],
+            "latency_avg_ms": round(avg, 1), "latency_max_ms": round(st["latency_max_ms"], 1),
+            "paused_sec": round(max(0.0, self._pause_until - time.monotonic()), 1),
+        }
 
+outbox = OutboundQueue(SEND_WORKERS, SEND_RATE_PER_SEC, SEND_PER_CHAT_INTERVAL)
+
+async def send_queued(chat_id: int, text: str, **kwargs):
+    """bot.send_message через общую очередь; ждёт доставки и возвращает Message."""
+    return await outbox.submit(chat_id, text, **kwargs)
+
+def notify_many(chat_ids, text: str, what: str, **kwargs):
+    """
+    Разослать одно сообщение нескольким чатам, не дожидаясь доставки.
+    Ошибки доставки логируются с меткой `what`.
+    """
+    for cid in chat_ids:
+        fut = outbox.submit(cid, text, **kwargs)
+
+        def _log(f, cid=cid):
+            if not f.cancelled() and f.exception() is not None:
+                logging.warning(f"notify manager failed ({what}) tg_id={cid}: {f.exception()}")
+        fut.add_done_callback(_log)
+
+# =========================
+# Инициализация БД: версионные миграции (PRAGMA user_version)
+# =========================
+# Базовая схема (v1). Добавлять сюда НЕЛЬЗЯ — только новой миграцией в MIGRATIONS.
+SCHEMA_V1_SQL = """
 CREATE TABLE IF NOT EXISTS users (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   tg_id INTEGER UNIQUE NOT NULL,
@@ -163,150 +636,379 @@ CREATE TABLE IF NOT EXISTS project_links (
 );
 
 CREATE INDEX IF NOT EXISTS idx_project_links_proj ON project_links(project_id);
+
+CREATE TABLE IF NOT EXISTS daily_plan_items (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  plan_date TEXT NOT NULL,      -- YYYY-MM-DD
+  text TEXT NOT NULL,           -- сырой пункт (с временем)
+  time_str TEXT NOT NULL,       -- HH:MM
+  task_id INTEGER,              -- связанная задача (если создана)
+  created_at TEXT DEFAULT (datetime('now')),
+  FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+-- Credentials (пароли командных сервисов)
+CREATE TABLE IF NOT EXISTS creds (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  title TEXT NOT NULL,             -- название сервиса (например, 'Figma', 'Notion', 'Jira')
+  login TEXT NOT NULL,
+  password TEXT NOT NULL,
+  note TEXT,
+  created_by_id INTEGER NOT NULL,  -- кто добавил (users.id)
+  created_at TEXT NOT NULL,
+  FOREIGN KEY(created_by_id) REFERENCES users(id)
+);
+CREATE INDEX IF NOT EXISTS idx_creds_title ON creds(title);
+CREATE INDEX IF NOT EXISTS idx_creds_created_by ON creds(created_by_id);
+
+-- Журнал событий задач (для Ганта)
+CREATE TABLE IF NOT EXISTS task_events (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  task_id INTEGER NOT NULL,
+  event TEXT NOT NULL,           -- 'create' | 'start' | 'deadline_set' | 'postpone' | 'done'
+  at TEXT NOT NULL,              -- ISO-UTC timestamp
+  meta TEXT,                     -- произвольные данные (старый/новый дедлайн, причина и т.п.)
+  FOREIGN KEY(task_id) REFERENCES tasks(id)
+);
+CREATE INDEX IF NOT EXISTS idx_task_events_task ON task_events(task_id);
 """
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Включаем внешние ключи
-        await db.execute("PRAGMA foreign_keys = ON;")
+# Колонки, которые старые базы получали ALTER-ами (v1 докатывает недостающие)
+SCHEMA_V1_COLUMNS = [
+    # Этап A: статистика/аналитика
+    ("tasks", "completed_at", "TEXT"),
+    ("tasks", "delay_minutes", "INTEGER"),
+    # дополнительные служебные поля
+    ("tasks", "last_postpone_reason", "TEXT"),
+    ("tasks", "started_at", "TEXT"),
+    ("tasks", "planned_start_at", "TEXT"),
+    ("tasks", "assigned_by_user_id", "INTEGER"),
+    ("tasks", "last_reminder_msg_id", "INTEGER"),
+    ("tasks", "completed_by_user_id", "INTEGER"),
+    ("tasks", "overdue_minutes", "INTEGER"),
+    ("users", "last_plan_msg_id", "INTEGER"),
+    ("users", "last_plan_date", "TEXT"),
+    # управление доступом
+    ("users", "registered", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "is_active", "INTEGER NOT NULL DEFAULT 1"),
+    # отдел пользователя
+    ("users", "dept", "TEXT"),
+]
 
-        # Базовая схема (создаст таблицы, индексы и PRAGMA из CREATE_SQL)
-        await db.executescript(CREATE_SQL)
+def _split_sql(script: str) -> list[str]:
+    """Скрипт → отдельные statements (executescript сам коммитит, а нам нужна одна транзакция)."""
+    lines = [ln.split("--", 1)[0] for ln in script.splitlines()]
+    return [st.strip() for st in "\n".join(lines).split(";") if st.strip()]
+
+async def _table_columns(db, table: str) -> set[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return {r[1] for r in await cur.fetchall()}
+
+async def _add_column_if_missing(db, table: str, column: str, decl: str):
+    if column not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+async def _migrate_v1(db):
+    for st in _split_sql(SCHEMA_V1_SQL):
+        await db.execute(st)
+    for table, column, decl in SCHEMA_V1_COLUMNS:
+        await _add_column_if_missing(db, table, column, decl)
+
+async def _migrate_v2(db):
+    # транзитивное замыкание manager_links: ancestor (прямо или косвенно) руководит descendant
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS manager_closure (
+          ancestor INTEGER NOT NULL,
+          descendant INTEGER NOT NULL,
+          depth INTEGER NOT NULL,
+          PRIMARY KEY(ancestor, descendant)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_mclosure_desc ON manager_closure(descendant, ancestor)")
+
+# Целочисленные epoch-копии ISO-колонок: (таблица, ISO-колонка, epoch-колонка).
+# Код по-прежнему пишет ISO, *_ts заполняют триггеры — сравнения и сортировки идут по INTEGER с индексом.
+TS_COLUMNS = [
+    ("tasks", "deadline", "deadline_ts"),
+    ("tasks", "next_reminder_at", "next_reminder_ts"),
+    ("tasks", "completed_at", "completed_ts"),
+    ("tasks", "created_at", "created_ts"),
+    ("task_events", "at", "at_ts"),
+]
 
-        # Таблица для элементов плана — создаём один раз
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS daily_plan_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            plan_date TEXT NOT NULL,      -- YYYY-MM-DD
-            text TEXT NOT NULL,           -- сырой пункт (с временем)
-            time_str TEXT NOT NULL,       -- HH:MM
-            task_id INTEGER,              -- связанная задача (если создана)
-            created_at TEXT DEFAULT (datetime('now')),
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
+def _ts_expr(col: str) -> str:
+    # strftime('%s') понимает и isoformat() с offset/микросекундами, и datetime('now'); мусор → NULL
+    return f"CAST(strftime('%s', {col}) AS INTEGER)"
+
+async def _migrate_v3(db):
+    for table, iso_col, ts_col in TS_COLUMNS:
+        await _add_column_if_missing(db, table, ts_col, "INTEGER")
+        await db.execute(f"UPDATE {table} SET {ts_col} = {_ts_expr(iso_col)}")
+
+    by_table: dict[str, list[tuple[str, str]]] = {}
+    for table, iso_col, ts_col in TS_COLUMNS:
+        by_table.setdefault(table, []).append((iso_col, ts_col))
+    for table, cols in by_table.items():
+        sets = ", ".join(f"{ts} = {_ts_expr('NEW.' + iso)}" for iso, ts in cols)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_ts_ins AFTER INSERT ON {table}
+            BEGIN UPDATE {table} SET {sets} WHERE rowid = NEW.rowid; END
         """)
-        await db.commit()
-
-            # --- Credentials (пароли командных сервисов) ---
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS creds (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,             -- название сервиса (например, 'Figma', 'Notion', 'Jira')
-            login TEXT NOT NULL,
-            password TEXT NOT NULL,
-            note TEXT,
-            created_by_id INTEGER NOT NULL,  -- кто добавил (users.id)
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(created_by_id) REFERENCES users(id)
-        );
+        watched = ", ".join(iso for iso, _ in cols)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_ts_upd AFTER UPDATE OF {watched} ON {table}
+            BEGIN UPDATE {table} SET {sets} WHERE rowid = NEW.rowid; END
         """)
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_creds_title ON creds(title);")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_creds_created_by ON creds(created_by_id);")
-        await db.commit()
 
-        # Аккуратные ALTER для старых баз — каждый в try/except
-        alters = [
-            # Этап A: статистика/аналитика
-            "ALTER TABLE tasks ADD COLUMN completed_at TEXT",
-            "ALTER TABLE tasks ADD COLUMN delay_minutes INTEGER",
-
-            # дополнительные служебные поля (если их ещё нет)
-            "ALTER TABLE tasks ADD COLUMN last_postpone_reason TEXT",
-            "ALTER TABLE tasks ADD COLUMN started_at TEXT",
-            "ALTER TABLE tasks ADD COLUMN planned_start_at TEXT",
-            "ALTER TABLE tasks ADD COLUMN assigned_by_user_id INTEGER",
-            "ALTER TABLE tasks ADD COLUMN last_reminder_msg_id INTEGER",
-            "ALTER TABLE users ADD COLUMN last_plan_msg_id INTEGER",
-            "ALTER TABLE users ADD COLUMN last_plan_date TEXT",
-            "ALTER TABLE tasks ADD COLUMN completed_by_user_id INTEGER",
-            "ALTER TABLE tasks ADD COLUMN overdue_minutes INTEGER"
-
-            "CREATE TABLE IF NOT EXISTS projects ("
-            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            " name TEXT NOT NULL UNIQUE,"
-            " created_by_id INTEGER NOT NULL,"
-            " created_at TEXT DEFAULT (datetime('now')),"
-            " FOREIGN KEY(created_by_id) REFERENCES users(id)"
-            ")",
-            "CREATE TABLE IF NOT EXISTS project_links ("
-            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            " project_id INTEGER NOT NULL,"
-            " title TEXT NOT NULL,"
-            " url TEXT NOT NULL,"
-            " created_by_id INTEGER NOT NULL,"
-            " created_at TEXT DEFAULT (datetime('now')),"
-            " FOREIGN KEY(project_id) REFERENCES projects(id),"
-            " FOREIGN KEY(created_by_id) REFERENCES users(id)"
-            ")",
-            "CREATE INDEX IF NOT EXISTS idx_project_links_proj ON project_links(project_id)",
-        ]
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_deadline_ts ON tasks(deadline_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_completed_ts ON tasks(completed_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_task_events_at_ts ON task_events(at_ts)")
 
-                # --- Журнал событий задач (для Ганта) ---
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS task_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            task_id INTEGER NOT NULL,
-            event TEXT NOT NULL,           -- 'create' | 'start' | 'deadline_set' | 'postpone' | 'done'
-            at TEXT NOT NULL,              -- ISO-UTC timestamp
-            meta TEXT,                     -- произвольные данные (старый/новый дедлайн, причина и т.п.)
-            FOREIGN KEY(task_id) REFERENCES tasks(id)
+async def _migrate_v4(db):
+    # Частичный индекс только по открытым задачам: размер не зависит от истории done.
+    # (next_reminder_ts, deadline_ts) + rowid покрывают выборку «кого пора напомнить» целиком.
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_open_due
+        ON tasks(next_reminder_ts, deadline_ts) WHERE status != 'done'
+    """)
+    # по ISO next_reminder_at больше никто не ищет
+    await db.execute("DROP INDEX IF EXISTS idx_tasks_nextrem")
+
+# Ревизия строки Ганта: глобальный счётчик в sync_state. Писатель один и транзакции идут строго
+# по очереди, поэтому закоммиченные ревизии всегда образуют префикс — водяной знак «> rev» ничего не теряет.
+_GANTT_REV_BUMP_SQL = "UPDATE sync_state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'gantt_rev'"
+_GANTT_REV_SQL = "(SELECT CAST(value AS INTEGER) FROM sync_state WHERE key = 'gantt_rev')"
+
+async def _migrate_v5(db):
+    # служебные ключи синхронизаций (водяные знаки, кэш локали и т.п.)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+          key TEXT PRIMARY KEY,
+          value TEXT
+        )
+    """)
+    await db.execute("INSERT OR IGNORE INTO sync_state(key, value) VALUES('gantt_rev', '0')")
+    # какой строке листа "Gantt" соответствует задача (строится полной пересборкой)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS gantt_rows (
+          task_id INTEGER PRIMARY KEY,
+          row_index INTEGER NOT NULL
         )
+    """)
+    await _add_column_if_missing(db, "tasks", "gantt_rev", "INTEGER NOT NULL DEFAULT 0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_gantt_rev ON tasks(gantt_rev)")
+
+    # ревизию двигают только поля, которые попадают в строку Ганта
+    for name, event, where in (
+        ("trg_tasks_gantt_ins", "AFTER INSERT ON tasks", "rowid = NEW.rowid"),
+        ("trg_tasks_gantt_upd",
+         "AFTER UPDATE OF user_id, description, deadline, completed_at, status, last_postpone_reason, created_at ON tasks",
+         "rowid = NEW.rowid"),
+        ("trg_users_gantt_name", "AFTER UPDATE OF full_name ON users", "user_id = NEW.id"),
+        ("trg_task_events_gantt", "AFTER INSERT ON task_events WHEN NEW.event = 'postpone'", "id = NEW.task_id"),
+    ):
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} {event}
+            BEGIN
+              {_GANTT_REV_BUMP_SQL};
+              UPDATE tasks SET gantt_rev = {_GANTT_REV_SQL} WHERE {where};
+            END
         """)
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_task_events_task ON task_events(task_id)")
-        await db.commit()
 
-        for alter in alters:
-            try:
-                await db.execute(alter)
-                await db.commit()
-            except Exception:
-                # колонка уже есть — пропускаем
-                pass
-                # Новые колонки для управления доступом
-            try:
-                await db.execute("ALTER TABLE users ADD COLUMN registered INTEGER NOT NULL DEFAULT 0")
-                await db.commit()
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE users ADD COLUMN is_active INTEGER NOT NULL DEFAULT 1")
-                await db.commit()
-            except Exception:
-                pass
-            # --- отдел пользователя ---
-            try:
-                await db.execute("ALTER TABLE users ADD COLUMN dept TEXT")
-                await db.commit()
-            except Exception:
-                pass
+async def _migrate_v6(db):
+    # последняя заливка, которую мы успешно отправили в ячейку листа проекта
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS project_cell_paint (
+          project_task_id INTEGER NOT NULL,
+          col_index INTEGER NOT NULL,
+          color TEXT NOT NULL,
+          painted_at TEXT DEFAULT (datetime('now')),
+          PRIMARY KEY(project_task_id, col_index),
+          FOREIGN KEY(project_task_id) REFERENCES project_tasks(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_project_tasks_open ON project_tasks(planned_date) WHERE status='open'")
+
+async def _migrate_v7(db):
+    # очередь изменений для Google Sheets: пишется в одной транзакции с изменением БД
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sheets_outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          target TEXT NOT NULL,                 -- 'projects' (вторая таблица)
+          op TEXT NOT NULL,                     -- ensure_project_ws | set_values | paint
+          payload TEXT NOT NULL,                -- JSON
+          status TEXT NOT NULL DEFAULT 'pending', -- pending | dead
+          attempts INTEGER NOT NULL DEFAULT 0,
+          next_try_ts INTEGER NOT NULL DEFAULT 0,
+          last_error TEXT,
+          created_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_sheets_outbox_pending ON sheets_outbox(id) WHERE status='pending'")
+
+async def _migrate_v8(db):
+    # KPI: завершённые задачи сотрудника по времени — покрывающий индекс для серий и окон
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_done_user_completed
+        ON tasks(user_id, completed_ts, delay_minutes) WHERE status='done'
+    """)
+
+# Пересчёт kpi_daily из tasks: день — сутки UTC (completed_ts / 86400),
+# delay_hist — JSON {просрочка_мин: кол-во} только по просроченным задачам.
+_KPI_DAILY_FILL_SQL = """
+    INSERT INTO kpi_daily(user_id, day, done, late, delay_sum, delay_hist)
+    SELECT user_id, day,
+           SUM(n),
+           SUM(CASE WHEN d > 0 THEN n ELSE 0 END),
+           SUM(CASE WHEN d > 0 THEN d * n ELSE 0 END),
+           json_group_object(CAST(d AS TEXT), n) FILTER (WHERE d > 0)
+    FROM (
+        SELECT user_id, completed_ts / 86400 AS day, MAX(COALESCE(delay_minutes, 0), 0) AS d, COUNT(*) AS n
+        FROM tasks
+        WHERE status = 'done' AND completed_ts IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY user_id, day, d
+    )
+    GROUP BY user_id, day
+"""
+
+async def _migrate_v9(db):
+    # дневная свёртка KPI: обновляется при завершении задачи, недели/месяцы считаются по ней
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS kpi_daily (
+          user_id INTEGER NOT NULL,
+          day INTEGER NOT NULL,              -- сутки UTC: completed_ts / 86400
+          done INTEGER NOT NULL DEFAULT 0,
+          late INTEGER NOT NULL DEFAULT 0,
+          delay_sum INTEGER NOT NULL DEFAULT 0,  -- сумма просрочек (мин) по просроченным
+          delay_hist TEXT NOT NULL DEFAULT '{}', -- JSON {просрочка_мин: кол-во}
+          PRIMARY KEY(user_id, day)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_kpi_daily_day ON kpi_daily(day)")
+    await db.execute("DELETE FROM kpi_daily")
+    await db.execute(_KPI_DAILY_FILL_SQL)
+
+async def _migrate_v10(db):
+    # хэш содержимого строки, последним записанной в лист "Gantt": одинаковое не пишем повторно
+    await _add_column_if_missing(db, "gantt_rows", "row_hash", "TEXT")
+
+async def _migrate_v11(db):
+    # задания для отдельного процесса синхронизации Google Sheets (SHEETS_SYNC_MODE=worker)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sheets_jobs (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          kind TEXT NOT NULL,                      -- sync | sync_full | proj_overdues
+          status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | failed
+          owner TEXT,
+          requested_ts INTEGER NOT NULL,
+          started_ts INTEGER,
+          finished_ts INTEGER,
+          error TEXT
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_sheets_jobs_active ON sheets_jobs(status, id) WHERE status IN ('pending','running')")
+
+async def _migrate_v12(db):
+    # счётчик следующей свободной строки листа проекта (строка 1 — шапка)
+    await _add_column_if_missing(db, "project_meta", "next_row", "INTEGER NOT NULL DEFAULT 2")
+    await db.execute("""
+        UPDATE project_meta
+        SET next_row = MAX(2, COALESCE((SELECT MAX(pt.row_index) + 1 FROM project_tasks pt
+                                         WHERE pt.project_id = project_meta.project_id), 2))
+    """)
+
+# (версия, описание, шаг). Версии строго по возрастанию, уже выпущенные шаги не меняем.
+MIGRATIONS = [
+    (1, "базовая схема + колонки старых ALTER", _migrate_v1),
+    (2, "manager_closure", _migrate_v2),
+    (3, "epoch-колонки *_ts + триггеры + индексы", _migrate_v3),
+    (4, "частичный индекс открытых задач для выборки напоминаний", _migrate_v4),
+    (5, "sync_state, gantt_rows и ревизии строк для инкрементального Ганта", _migrate_v5),
+    (6, "project_cell_paint — состояние заливки ячеек листов проектов", _migrate_v6),
+    (7, "sheets_outbox — персистентная очередь операций Google Sheets", _migrate_v7),
+    (8, "покрывающий индекс завершённых задач для KPI", _migrate_v8),
+    (9, "kpi_daily — дневная свёртка KPI + заполнение из истории", _migrate_v9),
+    (10, "gantt_rows.row_hash — пропуск неизменившихся строк Ганта", _migrate_v10),
+    (11, "sheets_jobs — задания для процесса синхронизации Google Sheets", _migrate_v11),
+    (12, "project_meta.next_row — счётчик строк листов проектов", _migrate_v12),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def migrate_db(db) -> list[int]:
+    """
+    Применить недостающие миграции одной транзакцией и записать PRAGMA user_version.
+    На актуальной базе — один PRAGMA-запрос и ни одного DDL.
+    """
+    cur = await db.execute("PRAGMA user_version")
+    current = (await cur.fetchone())[0]
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(f"DB schema v{current} is newer than code (v{SCHEMA_VERSION})")
+    pending = [(v, title, step) for v, title, step in MIGRATIONS if v > current]
+    if not pending:
+        return []
+
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        for v, title, step in pending:
+            logging.info("DB migration v%s: %s", v, title)
+            await step(db)
+        await db.execute(f"PRAGMA user_version = {pending[-1][0]}")
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return [v for v, _, _ in pending]
 
+async def init_db():
+    async with db_write(batch=False) as db:
+        applied = await migrate_db(db)
+        if applied:
+            logging.info("DB schema migrated to v%s", applied[-1])
 
         # Промоущаем разработчика (даже если он не зарегистрирован формально)
         if DEVELOPER_TG_ID:
             await db.execute("UPDATE users SET role='developer', is_active=1 WHERE tg_id=?", (DEVELOPER_TG_ID,))
             await db.commit()
 
+        # Замыкание иерархии — пересобираем на старте (дёшево, и лечит ручные правки manager_links)
+        await manager_closure_rebuild(db)
+        await db.commit()
+    mgr_mirror_invalidate()
+
 # === FULL RESET: утилита жёсткого сброса базы ===
 async def db_full_reset():
     """
     Полностью очищает все основные таблицы и делает VACUUM.
     Затем (если есть DEVELOPER_TG_ID в .env) — создаёт запись разработчика.
     """
+    # дочерние таблицы раньше родительских: сброс проходит и с включёнными внешними ключами
     TABLES = [
         "task_events",
         "reminders",
+        "project_cell_paint",
         "project_tasks",
-        "projects",
+        "project_links",
+        "project_meta",
+        "creds",
+        "daily_plan_items",
+        "manager_links",
+        "manager_closure",
+        "kpi_daily",
+        "gantt_rows",
+        "sheets_outbox",
         "tasks",
+        "projects",
         "users",
     ]
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         for t in TABLES:
             try:
                 await db.execute(f"DELETE FROM {t}")
-            except Exception:
-                pass
+            except Exception as e:
+                # reminders и т.п. есть не во всех базах
+                logging.warning(f"db_full_reset: {t}: {e}")
+        await manager_closure_rebuild(db)
         try:
             await db.execute("VACUUM")
         except Exception:
@@ -320,12 +1022,14 @@ async def db_full_reset():
 
     dev_tg = getenv("DEVELOPER_TG_ID")  # <— имя переменной окружения
     if dev_tg:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_write() as db:
             await db.execute(
                 "INSERT INTO users(tg_id, full_name, role, created_at) VALUES(?,?,?,?)",
                 (int(dev_tg), "Developer", "developer", datetime.now(UTC).isoformat()),
             )
             await db.commit()
+    user_cache_invalidate()
+    mgr_mirror_invalidate()
 
 # =========================
 # Утилиты
@@ -385,8 +1089,7 @@ def render_task_card(
     overdue = False
     if deadline_iso:
         try:
-            dl = dateparser.parse(deadline_iso)
-            if (dl.replace(tzinfo=dl.tzinfo or UTC)) < datetime.now(UTC) and s != "done":
+            if _parse_iso(deadline_iso) < datetime.now(UTC) and s != "done":
                 overdue = True
         except Exception:
             pass
@@ -530,9 +1233,8 @@ def _proj_done_cb(tid: int) -> str: return f"projdone:{tid}"
 
 
 @router.message(F.text == "🧩 Добавить проект")
-async def bigproj_start(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def bigproj_start(m: Message, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(m.from_user.id)
     if me["role"] not in ("head","developer"):
         await m.answer("Нет доступа."); return
     await state.set_state(BigProjectCreate.waiting_name)
@@ -608,7 +1310,7 @@ async def bigproj_startdate(m: Message, state: FSMContext):
     await m.answer("Дедлайн (ДД.ММ.ГГГГ)?")
 
 @router.message(BigProjectCreate.waiting_deadline)
-async def bigproj_deadline(m: Message, state: FSMContext):
+async def bigproj_deadline(m: Message, state: FSMContext, current_user: dict | None = None):
     dl = _parse_dmy(m.text or "")
     if not dl:
         await m.answer("Формат даты: ДД.ММ.ГГГГ"); return
@@ -620,10 +1322,12 @@ async def bigproj_deadline(m: Message, state: FSMContext):
 
     name = data["prj_name"]
     prj_type = data["prj_type"]
+    sheet_titles = await _projects_sheet_titles()
 
-    # 1) создаём/находим проект в нашей БД
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    # 1) создаём/находим проект, 2) выбираем имя листа, 3) сохраняем мету и ставим создание листа
+    #    в очередь Sheets — всё одной транзакцией, сам лист создаст фоновый воркер
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         # projects.name уже уникально (существует в схеме)
         cur = await db.execute("SELECT id FROM projects WHERE name=?", (name,))
         row = await cur.fetchone()
@@ -631,22 +1335,18 @@ async def bigproj_deadline(m: Message, state: FSMContext):
             pid = row[0]
         else:
             cur2 = await db.execute("INSERT INTO projects(name, created_by_id) VALUES(?,?)", (name, me["id"]))
-            await db.commit()
             pid = cur2.lastrowid
 
-    # 2) создаём лист во 2-й таблице
-    sh = await _gs_open_projects()
-    sheet_title = await _dedupe_sheet_title(sh, _sheet_title_from_name(name))
-    ws = await _ensure_project_ws(sh, sheet_title, start, dl)
-
-    # 3) сохраняем мету (upsert)
-    async with aiosqlite.connect(DB_PATH) as db:
+        sheet_title = await _dedupe_sheet_title(db, _sheet_title_from_name(name), sheet_titles)
         await db.execute("""
             INSERT INTO project_meta(project_id, prj_type, start_date, deadline, sheet_title)
             VALUES(?,?,?,?,?)
             ON CONFLICT(project_id) DO UPDATE SET prj_type=excluded.prj_type,
-                start_date=excluded.start_date, deadline=excluded.deadline, sheet_title=excluded.sheet_title
+                start_date=excluded.start_date, deadline=excluded.deadline, sheet_title=excluded.sheet_title,
+                next_row=CASE WHEN project_meta.sheet_title = excluded.sheet_title THEN project_meta.next_row ELSE 2 END
         """, (pid, prj_type, start.isoformat(), dl.isoformat(), sheet_title))
+        await sheets_outbox_put(db, "ensure_project_ws", sheet_title=sheet_title,
+                                start=start.isoformat(), end=dl.isoformat())
         await db.commit()
 
     await state.clear()
@@ -687,7 +1387,7 @@ async def proj_summary(cq: CallbackQuery):
     pid = int(cq.data.split(":")[2])
     today = datetime.now(LOCAL_TZ).date()
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         # имя проекта
         cur = await db.execute("SELECT name FROM projects WHERE id=?", (pid,))
         r = await cur.fetchone()
@@ -749,12 +1449,12 @@ async def proj_summary(cq: CallbackQuery):
     await cq.answer()
 
 # --- выбор исполнителя (отдельный picker, чтобы не мешать существующему assign_user) ---
-async def show_user_picker_project(m_or_cq, page: int, for_tg_id: int):
+async def show_user_picker_project(m_or_cq, page: int, for_tg_id: int, me: dict | None = None):
     is_cq = isinstance(m_or_cq, CallbackQuery)
     chat_id = m_or_cq.message.chat.id if is_cq else m_or_cq.chat.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, for_tg_id)
+    async with db_read() as db:
+        me = me or await get_user_by_tg(db, for_tg_id)
         if me["role"] == "developer":
             cur = await db.execute("""SELECT id, full_name, tg_id FROM users
                                       WHERE is_active=1 AND role='employee'
@@ -796,18 +1496,18 @@ async def show_user_picker_project(m_or_cq, page: int, for_tg_id: int):
         await bot.send_message(chat_id, txt, reply_markup=kb.as_markup())
 
 @router.message(ProjTaskAdd.waiting_text)
-async def proj_task_got_text(m: Message, state: FSMContext):
+async def proj_task_got_text(m: Message, state: FSMContext, current_user: dict | None = None):
     text = (m.text or "").strip()
     if len(text) < 2:
         await m.answer("Слишком коротко, опиши задачу."); return
     await state.update_data(add_text=text)
     await state.set_state(ProjTaskAdd.picking_assignee)
-    await show_user_picker_project(m, 0, for_tg_id=m.from_user.id)
+    await show_user_picker_project(m, 0, for_tg_id=m.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("projuser_list:"))
-async def proj_user_list(cq: CallbackQuery, state: FSMContext):
+async def proj_user_list(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     page = int(cq.data.split(":")[1])
-    await show_user_picker_project(cq, page, for_tg_id=cq.from_user.id)
+    await show_user_picker_project(cq, page, for_tg_id=cq.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("projuser_user:"))
 async def proj_user_pick(cq: CallbackQuery, state: FSMContext):
@@ -817,7 +1517,7 @@ async def proj_user_pick(cq: CallbackQuery, state: FSMContext):
     # достанем диапазон дат проекта для клавиатуры
     data = await state.get_data()
     pid = int(data["add_pid"])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT start_date, deadline FROM project_meta WHERE project_id=?", (pid,))
         row = await cur.fetchone()
     if not row:
@@ -850,7 +1550,7 @@ async def proj_date_pick(cq: CallbackQuery, state: FSMContext):
     assignee_id = int(data["add_assignee"])
 
     # получим мету проекта и лист
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT sheet_title, start_date FROM project_meta WHERE project_id=?", (pid,))
         row = await cur.fetchone()
         cur2 = await db.execute("SELECT full_name FROM users WHERE id=?", (assignee_id,))
@@ -860,25 +1560,25 @@ async def proj_date_pick(cq: CallbackQuery, state: FSMContext):
     sheet_title, start_iso = row[0], row[1]
     start = date.fromisoformat(start_iso)
 
-    sh = await _gs_open_projects()
-    ws = await _gs_ensure_ws(sh, sheet_title)
-
-    # запись строки
-    next_row = await _projects_next_row(ws)
-    await ws.update_cell(next_row, 1, task_text)
-    await ws.update_cell(next_row, 2, ass or "—")
-
-    # зелёная ячейка в колонке нужной даты
     col = 3 + (day - start).days
-    await _projects_paint_cell(ws, next_row, col, GREEN)
 
-    # сохраняем в БД строку задачи проекта
-    async with aiosqlite.connect(DB_PATH) as db:
+    # строка задачи в БД + запись строки и зелёной ячейки в очередь Sheets — одной транзакцией
+    async with db_write() as db:
+        # строку листа выдаёт счётчик project_meta.next_row: инкремент внутри транзакции записи,
+        # два одновременных добавления получают разные строки
+        cur = await db.execute(
+            "UPDATE project_meta SET next_row = next_row + 1 WHERE project_id=? RETURNING next_row - 1", (pid,)
+        )
+        next_row = (await cur.fetchone())[0]
         cur = await db.execute("""
             INSERT INTO project_tasks(project_id, row_index, task_text, assignee_user_id, planned_date, duration_days, status)
             VALUES(?,?,?,?,?,1,'open')
         """, (pid, next_row, task_text, assignee_id, day.isoformat()))
         tid = cur.lastrowid
+        await sheets_outbox_put(db, "set_values", sheet_title=sheet_title, row=next_row, col=1,
+                                values=[task_text, ass or "—"])
+        await sheets_outbox_put(db, "paint", sheet_title=sheet_title, row=next_row, col=col,
+                                color=GREEN, ptask_id=tid)
         await db.commit()
 
     # кнопки после создания
@@ -897,7 +1597,7 @@ async def proj_date_pick(cq: CallbackQuery, state: FSMContext):
 async def proj_extend1(cq: CallbackQuery):
     tid = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT pt.project_id, pt.row_index, pt.planned_date, pt.duration_days, pt.status,
                    pm.sheet_title, pm.start_date, pm.deadline
@@ -924,13 +1624,11 @@ async def proj_extend1(cq: CallbackQuery):
     if next_day > deadline:
         await cq.answer("Нельзя продлить — дальше дедлайна проекта.", show_alert=True); return
 
-    sh = await _gs_open_projects()
-    ws = await _gs_ensure_ws(sh, sheet_title)
     col = 3 + (next_day - start).days
-    await _projects_paint_cell(ws, row_index, col, BLUE)
-
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute("UPDATE project_tasks SET duration_days = duration_days + 1 WHERE id=?", (tid,))
+        await sheets_outbox_put(db, "paint", sheet_title=sheet_title, row=row_index, col=col,
+                                color=BLUE, ptask_id=tid)
         await db.commit()
 
     await cq.message.edit_text("✅ Продлено на 1 день.")
@@ -939,7 +1637,7 @@ async def proj_extend1(cq: CallbackQuery):
 @router.callback_query(F.data.startswith("projdone:"))
 async def proj_done(cq: CallbackQuery):
     tid = int(cq.data.split(":")[1])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute("UPDATE project_tasks SET status='done' WHERE id=?", (tid,))
         await db.commit()
     await cq.message.edit_text("✅ Задача завершена.")
@@ -948,7 +1646,7 @@ async def proj_done(cq: CallbackQuery):
 @router.callback_query(F.data.startswith("projmove:"))
 async def proj_move_start(cq: CallbackQuery):
     tid = int(cq.data.split(":")[1])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT pt.project_id, pm.start_date, pm.deadline
             FROM project_tasks pt
@@ -976,7 +1674,7 @@ async def proj_dates_page(cq: CallbackQuery, state: FSMContext):
     _, pid_s, page_s = cq.data.split(":")
     pid, page = int(pid_s), int(page_s)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT start_date, deadline FROM project_meta WHERE project_id=?", (pid,))
         row = await cur.fetchone()
     if not row:
@@ -994,7 +1692,7 @@ async def proj_move_page(cq: CallbackQuery):
     _, tid_s, page_s = cq.data.split(":")
     tid, page = int(tid_s), int(page_s)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT pm.start_date, pm.deadline
             FROM project_tasks pt
@@ -1018,7 +1716,7 @@ async def proj_move_date(cq: CallbackQuery):
     tid = int(tid)
     new_day = date.fromisoformat(iso)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT pt.project_id, pt.row_index, pt.planned_date, pm.sheet_title, pm.start_date
             FROM project_tasks pt
@@ -1032,18 +1730,17 @@ async def proj_move_date(cq: CallbackQuery):
     start = date.fromisoformat(start_iso)
     old_day = date.fromisoformat(old_iso)
 
-    sh = await _gs_open_projects()
-    ws = await _gs_ensure_ws(sh, sheet_title)
-
     # старую ячейку -> жёлтый, новую -> зелёный
     old_col = 3 + (old_day - start).days
     new_col = 3 + (new_day - start).days
-    await _projects_paint_cell(ws, row_index, old_col, YELLOW)
-    await _projects_paint_cell(ws, row_index, new_col, GREEN)
 
-    # обновим дату в БД
-    async with aiosqlite.connect(DB_PATH) as db:
+    # обновим дату в БД и поставим перекраску в очередь Sheets
+    async with db_write() as db:
         await db.execute("UPDATE project_tasks SET planned_date=? WHERE id=?", (new_day.isoformat(), tid))
+        await sheets_outbox_put(db, "paint", sheet_title=sheet_title, row=row_index, col=old_col,
+                                color=YELLOW, ptask_id=tid)
+        await sheets_outbox_put(db, "paint", sheet_title=sheet_title, row=row_index, col=new_col,
+                                color=GREEN, ptask_id=tid)
         await db.commit()
 
     await cq.message.edit_text("✅ Дата задачи обновлена.")
@@ -1060,30 +1757,43 @@ async def cb_noop(cq: CallbackQuery):
 
 # --- Периодическая перекраска просроченных (красный) ---
 async def projects_sync_overdues():
-    """Каждый запуск подсвечивает красным все open-задачи, чей planned_date < сегодня."""
+    """
+    Подсвечивает красным open-задачи, чей planned_date < сегодня, — но только те ячейки,
+    чья последняя отправленная заливка (project_cell_paint) ещё не красная.
+    В установившемся режиме — один SELECT и ни одного запроса к Google; всплеск раз в сутки после полуночи.
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        today = datetime.now(LOCAL_TZ).date()
+        red = _paint_key(RED)
+        async with db_read() as db:
+            # колонка дня: C = 3 + (planned_date - start_date)
             cur = await db.execute("""
-                SELECT pt.id, pt.project_id, pt.row_index, pt.planned_date, pm.sheet_title, pm.start_date
+                SELECT pt.id, pt.row_index,
+                       3 + CAST(julianday(pt.planned_date) - julianday(pm.start_date) AS INTEGER) AS col,
+                       pm.sheet_title
                 FROM project_tasks pt
                 JOIN project_meta pm ON pm.project_id=pt.project_id
-                WHERE pt.status='open'
-            """)
-            rows = await cur.fetchall()
-        if not rows:
+                WHERE pt.status='open' AND pt.planned_date < ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM project_cell_paint p
+                      WHERE p.project_task_id = pt.id AND p.color = ?
+                        AND p.col_index = 3 + CAST(julianday(pt.planned_date) - julianday(pm.start_date) AS INTEGER)
+                  )
+            """, (today.isoformat(), red))
+            todo = await cur.fetchall()
+        if not todo:
             return
 
-        today = datetime.now(LOCAL_TZ).date()
         sh = await _gs_open_projects()
-
-        for tid, pid, row_index, planned_iso, sheet_title, start_iso in rows:
-            d = date.fromisoformat(planned_iso)
-            if d >= today:
-                continue
+        for tid, row_index, col, sheet_title in todo:
             ws = await _gs_ensure_ws(sh, sheet_title)
-            start = date.fromisoformat(start_iso)
-            col = 3 + (d - start).days
-            await _projects_paint_cell(ws, row_index, col, RED)
+            _projects_paint_cell(sh, ws, row_index, col, RED)
+        # все просрочки всех проектов — один batchUpdate
+        if await sheets_buffer(sh).flush():
+            async with db_write() as db:
+                await project_paint_record(db, [(tid, col, RED) for tid, _, col, _ in todo])
+                await db.commit()
+        logging.info("projects_sync_overdues: repainted %s cells", len(todo))
     except Exception as e:
         logging.warning(f"projects_sync_overdues: {e}")
 
@@ -1102,9 +1812,8 @@ def _creds_menu_kb(can_add: bool) -> InlineKeyboardBuilder:
     return kb
 
 @router.message(F.text.in_({"🔐 Пароли", "Пароли", "Доступы"}))
-async def creds_menu_entry(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+async def creds_menu_entry(m: Message, current_user: dict | None = None):
+    u = current_user or await get_user_cached(m.from_user.id, m.from_user.full_name or "")
     can_add = _can_manage_creds(u)
 
     text_lines = [
@@ -1188,9 +1897,8 @@ def _admin_fire_cb(user_id: int) -> str:
     return f"admin:fire:{user_id}"
 
 @router.callback_query(F.data == "admin:users")
-async def admin_users_root(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def admin_users_root(cq: CallbackQuery, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
 
     if not me or not me.get("is_active", 1):
         await cq.answer("❌ Пользователь удалён/заблокирован.", show_alert=True); return
@@ -1200,9 +1908,9 @@ async def admin_users_root(cq: CallbackQuery):
     await admin_users_show_page(cq, 0)
 
 @router.callback_query(F.data == "admin:stats")
-async def admin_stats(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def admin_stats(cq: CallbackQuery, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if not me or not me.get("is_active", 1):
             await cq.answer("❌ Пользователь удалён или заблокирован.", show_alert=True)
             return
@@ -1272,7 +1980,7 @@ def _admin_role_set_cb(user_id: int, role: str) -> str:
 
 async def admin_users_show_page(cq: CallbackQuery, page: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             cur = await db.execute("""
                 SELECT id, full_name, tg_id, role
                 FROM users
@@ -1318,15 +2026,15 @@ def _admin_fire_cancel_cb(user_id: int) -> str:
     return f"admin:fire_cancel:{user_id}"
 
 @router.callback_query(F.data.startswith("admin:fire:"))
-async def admin_fire_prompt(cq: CallbackQuery):
+async def admin_fire_prompt(cq: CallbackQuery, current_user: dict | None = None):
     parts = (cq.data or "").split(":")
     if len(parts) != 3 or not parts[2].isdigit():
         await cq.answer("Некорректный запрос.", show_alert=True); return
     user_id = int(parts[2])
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            me = await get_user_by_tg(db, cq.from_user.id)
+        async with db_read() as db:
+            me = current_user or await get_user_by_tg(db, cq.from_user.id)
             if not me or not me.get("is_active", 1):
                 await cq.answer("❌ Пользователь удалён/заблокирован.", show_alert=True); return
             if me.get("role") != "developer":
@@ -1360,33 +2068,36 @@ async def admin_fire_cancel(cq: CallbackQuery):
     await cq.message.edit_text("❎ Увольнение отменено.")
 
 @router.callback_query(F.data.startswith("admin:fire_confirm:"))
-async def admin_fire_confirm(cq: CallbackQuery):
+async def admin_fire_confirm(cq: CallbackQuery, current_user: dict | None = None):
     parts = (cq.data or "").split(":")
     if len(parts) != 3 or not parts[2].isdigit():
         await cq.answer("Некорректный запрос.", show_alert=True); return
     user_id = int(parts[2])
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            me = await get_user_by_tg(db, cq.from_user.id)
-            if not me or not me.get("is_active", 1):
-                await cq.answer("❌ Пользователь удалён/заблокирован.", show_alert=True); return
-            if me.get("role") != "developer":
-                await cq.answer("Нет доступа", show_alert=True); return
-
+        async with db_read() as db:
+            me = current_user or await get_user_by_tg(db, cq.from_user.id)
             tgt = await get_user_by_id(db, user_id)
-            if not tgt:
-                await cq.answer("Пользователь уже удалён.", show_alert=True); return
-            if tgt.get("tg_id") == DEVELOPER_TG_ID:
-                await cq.answer("Нельзя удалять разработчика.", show_alert=True); return
+        if not me or not me.get("is_active", 1):
+            await cq.answer("❌ Пользователь удалён/заблокирован.", show_alert=True); return
+        if me.get("role") != "developer":
+            await cq.answer("Нет доступа", show_alert=True); return
+        if not tgt:
+            await cq.answer("Пользователь уже удалён.", show_alert=True); return
+        if tgt.get("tg_id") == DEVELOPER_TG_ID:
+            await cq.answer("Нельзя удалять разработчика.", show_alert=True); return
 
+        async with db_write() as db:
             # soft-delete
             await db.execute("UPDATE users SET is_active=0 WHERE id=?", (user_id,))
             await db.execute("DELETE FROM manager_links WHERE manager_user_id=? OR subordinate_user_id=?", (user_id, user_id))
+            await manager_closure_rebuild(db)
             await db.execute("DELETE FROM daily_plan_items WHERE user_id=?", (user_id,))
             # опционально закрыть открытые задачи:
             await db.execute("UPDATE tasks SET status='done', next_reminder_at=NULL WHERE user_id=? AND status!='done'", (user_id,))
             await db.commit()
+        user_cache_invalidate(user_id=user_id)
+        mgr_mirror_invalidate()
     except Exception as e:
         logging.exception("admin_fire_confirm failed: %s", e)
         await cq.answer("Ошибка при увольнении.", show_alert=True); return
@@ -1397,23 +2108,22 @@ async def admin_fire_confirm(cq: CallbackQuery):
     await cq.answer("Удалён")
 
 @router.callback_query(F.data.startswith("admin:users_page:"))
-async def admin_users_page(cq: CallbackQuery):
+async def admin_users_page(cq: CallbackQuery, current_user: dict | None = None):
     page = int(cq.data.split(":")[2])
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] != "developer":
         await cq.answer("Нет доступа", show_alert=True); return
     await admin_users_show_page(cq, page)
 
 @router.callback_query(F.data.startswith("admin:role:"))
-async def admin_role_menu(cq: CallbackQuery):
+async def admin_role_menu(cq: CallbackQuery, current_user: dict | None = None):
     parts = (cq.data or "").split(":")
     if len(parts) != 3 or not parts[2].isdigit():
         await cq.answer("Некорректный запрос.", show_alert=True); return
     user_id = int(parts[2])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if not me or me.get("role") != "developer":
             await cq.answer("Нет доступа", show_alert=True); return
         tgt = await get_user_by_id(db, user_id)
@@ -1437,7 +2147,7 @@ async def admin_role_menu(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("admin:role_set:"))
-async def admin_role_set(cq: CallbackQuery):
+async def admin_role_set(cq: CallbackQuery, current_user: dict | None = None):
     parts = (cq.data or "").split(":")
     if len(parts) != 4 or not parts[2].isdigit():
         await cq.answer("Некорректный запрос.", show_alert=True); return
@@ -1446,18 +2156,20 @@ async def admin_role_set(cq: CallbackQuery):
     if new_role not in ("employee","lead","head"):
         await cq.answer("Недопустимая роль.", show_alert=True); return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
-        if not me or me.get("role") != "developer":
-            await cq.answer("Нет доступа", show_alert=True); return
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         tgt = await get_user_by_id(db, user_id)
-        if not tgt:
-            await cq.answer("Пользователь не найден", show_alert=True); return
-        if tgt.get("tg_id") == DEVELOPER_TG_ID:
-            await cq.answer("Нельзя менять роль разработчика.", show_alert=True); return
+    if not me or me.get("role") != "developer":
+        await cq.answer("Нет доступа", show_alert=True); return
+    if not tgt:
+        await cq.answer("Пользователь не найден", show_alert=True); return
+    if tgt.get("tg_id") == DEVELOPER_TG_ID:
+        await cq.answer("Нельзя менять роль разработчика.", show_alert=True); return
 
+    async with db_write() as db:
         await db.execute("UPDATE users SET role=? WHERE id=?", (new_role, user_id))
         await db.commit()
+    user_cache_invalidate(user_id=user_id)
 
     await cq.message.edit_text(
         f"✅ Роль пользователя {tgt.get('full_name','(без имени)')} обновлена: {tgt.get('role')} → {new_role}"
@@ -1468,15 +2180,15 @@ from aiogram import F
 from aiogram.types import CallbackQuery
 
 @router.callback_query(F.data.startswith("start_task_from_list:"))
-async def cb_start_task_from_list(cq: CallbackQuery):
+async def cb_start_task_from_list(cq: CallbackQuery, current_user: dict | None = None):
     """
     Из списка «Мои задачи»: ставим статус in_progress и
     РЕДАКТИРУЕМ текущее сообщение карточки вместо отправки нового.
     """
     rid = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        user = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_write() as db:
+        user = current_user or await get_user_by_tg(db, cq.from_user.id)
         now = datetime.now(UTC).isoformat()
 
         await db.execute("""
@@ -1516,10 +2228,9 @@ async def cb_start_task_later(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data == "creds:menu")
-async def creds_menu_cb(cq: CallbackQuery):
+async def creds_menu_cb(cq: CallbackQuery, current_user: dict | None = None):
     await _remove_kb_safe(cq.message)
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    u = current_user or await get_user_cached(cq.from_user.id, cq.from_user.full_name or "")
     can_add = _can_manage_creds(u)
 
     text_lines = [
@@ -1533,10 +2244,10 @@ async def creds_menu_cb(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data == "creds:choose")
-async def creds_choose_cb(cq: CallbackQuery):
+async def creds_choose_cb(cq: CallbackQuery, current_user: dict | None = None):
     await _remove_kb_safe(cq.message)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT title, COUNT(*) as cnt
             FROM creds
@@ -1547,8 +2258,7 @@ async def creds_choose_cb(cq: CallbackQuery):
         rows = await cur.fetchall()
 
     if not rows:
-        async with aiosqlite.connect(DB_PATH) as db:
-            u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+        u = current_user or await get_user_cached(cq.from_user.id, cq.from_user.full_name or "")
         await cq.message.answer(
             "Пока нет ни одного сервиса.",
             reply_markup=_creds_main_kb(_can_manage_creds(u)).as_markup()
@@ -1564,7 +2274,7 @@ async def creds_choose_cb(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("creds:open:"))
-async def creds_open_by_title(cq: CallbackQuery):
+async def creds_open_by_title(cq: CallbackQuery, current_user: dict | None = None):
     # удалить сообщение "Выберите сервис"
     await _delete_msg_safe(cq.message)
 
@@ -1573,8 +2283,8 @@ async def creds_open_by_title(cq: CallbackQuery):
         await cq.answer("Некорректный запрос.", show_alert=True); return
     title = parts[2]
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, cq.from_user.id)
         cur = await db.execute("""
             SELECT id, title, login
             FROM creds
@@ -1598,14 +2308,14 @@ async def creds_open_by_title(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("cred_open:"))
-async def cred_open(cq: CallbackQuery):
+async def cred_open(cq: CallbackQuery, current_user: dict | None = None):
     # удаляем сообщение со списком, где была нажата кнопка
     await _delete_msg_safe(cq.message)
 
     cred_id = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, cq.from_user.id)
         rec = await _get_cred_by_id(db, cred_id, u["id"])
 
     if not rec:
@@ -1617,10 +2327,10 @@ async def cred_open(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("creds:reveal:"))
-async def creds_reveal_cb(cq: CallbackQuery):
+async def creds_reveal_cb(cq: CallbackQuery, current_user: dict | None = None):
     # доступ только head/lead/developer
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, cq.from_user.id)
         if not _can_manage_creds(u):
             await cq.answer("Нет прав", show_alert=True)
             return
@@ -1644,16 +2354,16 @@ async def creds_reveal_cb(cq: CallbackQuery):
     # автоудаление
     # разовая синхронизация (если нужно запустить вручную из этого обработчика)
     try:
-        await gs_sync_all()
+        await gs_sync_now(wait=False)
     except Exception as e:
         logging.exception("Manual gs_sync_all() failed: %s", e)
     await cq.answer()
 
 
 @router.callback_query(F.data == "creds:add")
-async def creds_add_start_cb(cq: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+async def creds_add_start_cb(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, cq.from_user.id)
         if not _can_manage_creds(u):
             await cq.answer("Нет прав", show_alert=True)
             return
@@ -1678,12 +2388,12 @@ async def creds_find_start(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.callback_query(F.data == "creds:list")
-async def creds_list(cq: CallbackQuery):
+async def creds_list(cq: CallbackQuery, current_user: dict | None = None):
     # убираем кнопки у текущего сообщения
     await _remove_kb_safe(cq.message)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, cq.from_user.id)
 
         cur = await db.execute("""
             SELECT id, title
@@ -1716,7 +2426,7 @@ class CredsState(StatesGroup):
     waiting_find = State()   # добавили — для ввода текста запроса
 
 @router.message(StateFilter(CredsState.waiting_add))
-async def creds_add_apply(m: Message, state: FSMContext):
+async def creds_add_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     raw = (m.text or "").strip()
     if not raw:
         await m.answer("Нужен текст.")
@@ -1744,13 +2454,13 @@ async def creds_add_apply(m: Message, state: FSMContext):
         await m.answer("Не смог разобрать. Минимум нужно: «сервис — логин — пароль». Попробуй ещё раз.")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
-        if not _can_manage_creds(u):
-            await m.answer("Нет прав.")
-            await state.clear()
-            return
+    u = current_user or await get_user_cached(m.from_user.id)
+    if not _can_manage_creds(u):
+        await m.answer("Нет прав.")
+        await state.clear()
+        return
 
+    async with db_write() as db:
         now = datetime.now(UTC).isoformat()
         await db.execute("""
             INSERT INTO creds(title, login, password, note, created_by_id, created_at)
@@ -1767,14 +2477,14 @@ async def creds_add_apply(m: Message, state: FSMContext):
     )
 
 @router.message(CredsState.waiting_find)
-async def creds_find_apply(m: Message, state: FSMContext):
+async def creds_find_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     q = (m.text or "").strip()
     if not q:
         await m.answer("Нужен текст запроса.")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, m.from_user.id)
         like = f"%{q}%"
         cur = await db.execute("""
             SELECT id, title
@@ -1868,6 +2578,90 @@ async def disable_kb_and_optionally_edit(message, extra_note: str | None = None)
     except Exception:
         pass
 
+# =========================
+# Кэш пользователей (tg_id → карточка)
+# =========================
+USER_CACHE_TTL_SEC = int(os.getenv("USER_CACHE_TTL_SEC", "300"))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "2000"))
+
+# tg_id → (expires_at_monotonic, user_dict); порядок = давность использования (LRU)
+_user_cache: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+_user_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _user_cache_get(tg_id: int) -> dict | None:
+    item = _user_cache.get(tg_id)
+    if item is None:
+        _user_cache_stats["misses"] += 1
+        return None
+    expires_at, u = item
+    if expires_at < time.monotonic():
+        _user_cache.pop(tg_id, None)
+        _user_cache_stats["misses"] += 1
+        return None
+    _user_cache.move_to_end(tg_id)
+    _user_cache_stats["hits"] += 1
+    return dict(u)  # копия: хэндлеры иногда правят словарь «на месте»
+
+def _user_cache_put(u: dict | None):
+    if not u or u.get("tg_id") is None:
+        return
+    _user_cache[u["tg_id"]] = (time.monotonic() + USER_CACHE_TTL_SEC, dict(u))
+    _user_cache.move_to_end(u["tg_id"])
+    while len(_user_cache) > USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+
+def user_cache_invalidate(tg_id: int | None = None, user_id: int | None = None):
+    """
+    Сбросить карточку из кэша. Вызывать ПОСЛЕ commit, иначе параллельный
+    читатель может успеть закэшировать старую строку.
+    Без аргументов — очищает кэш целиком (полный сброс БД и т.п.).
+    """
+    _user_cache_stats["invalidations"] += 1
+    _user_cache_drop(tg_id, user_id)
+    # при групповом commit данные ещё не на диске — сбросим повторно после фактического commit
+    db_pool.after_commit(lambda: _user_cache_drop(tg_id, user_id))
+
+def _user_cache_drop(tg_id: int | None, user_id: int | None):
+    if tg_id is None and user_id is None:
+        _user_cache.clear()
+        return
+    if tg_id is not None:
+        _user_cache.pop(tg_id, None)
+    if user_id is not None:
+        for k, (_, u) in list(_user_cache.items()):
+            if u.get("id") == user_id:
+                _user_cache.pop(k, None)
+
+def user_cache_snapshot() -> dict:
+    return {**_user_cache_stats, "size": len(_user_cache), "ttl_sec": USER_CACHE_TTL_SEC}
+
+def _user_needs_heal(u: dict, tg_id: int, full_name: str | None) -> bool:
+    """Те же условия, при которых ensure_user() правит существующую карточку."""
+    if full_name and full_name.strip() and (not u["full_name"] or u["full_name"] == "unknown"):
+        return True
+    if is_dev_tg(tg_id) and (u["role"] != "developer" or u["is_active"] != 1):
+        return True
+    if OWNER_TG_ID and tg_id == OWNER_TG_ID and not is_dev_tg(tg_id) and u["role"] not in ("developer", "head"):
+        return True
+    return False
+
+async def get_user_cached(tg_id: int, full_name: str | None = None) -> dict:
+    """
+    Карточка пользователя для middleware: сначала кэш, затем БД.
+    Если пользователя ещё нет (или карточку надо «подлечить») — ensure_user через писателя.
+    """
+    u = _user_cache_get(tg_id)
+    if u is not None and not _user_needs_heal(u, tg_id, full_name):
+        return u
+    if u is None:
+        async with db_read() as db:
+            u = await get_user_by_tg(db, tg_id)
+    if not u or _user_needs_heal(u, tg_id, full_name):
+        async with db_write() as db:
+            u = await ensure_user(db, tg_id, full_name)
+    _user_cache_put(u)
+    return dict(u)
+
 async def get_user_by_tg(db, tg_id: int):
     cur = await db.execute("SELECT id, tg_id, full_name, role, registered, is_active, dept FROM users WHERE tg_id=?", (tg_id,))
     row = await cur.fetchone()
@@ -1900,6 +2694,7 @@ async def rehire_user_by_tg(db, tg_id: int, role: str | None = None, set_registe
 
     cur = await db.execute(sql, tuple(params))
     await db.commit()
+    user_cache_invalidate(tg_id=tg_id)
     return cur.rowcount  # 0 — не нашли, 1 — ок
 
 async def log_task_event(db, task_id: int, event: str, meta: str | None = None):
@@ -1917,6 +2712,19 @@ async def log_task_event(db, task_id: int, event: str, meta: str | None = None):
         # журнал — служебный, не должен ломать основной сценарий
         pass
 
+async def log_task_events(db, events: list[tuple[int, str, str | None]]):
+    """Пакетный вариант log_task_event: [(task_id, event, meta), ...] одним executemany."""
+    if not events:
+        return
+    at = datetime.now(UTC).isoformat()
+    try:
+        await db.executemany(
+            "INSERT INTO task_events(task_id, event, at, meta) VALUES(?,?,?,?)",
+            [(tid, ev, at, meta) for tid, ev, meta in events]
+        )
+    except Exception:
+        pass
+
 def is_dev_tg(tg_id: int) -> bool:
     return DEVELOPER_TG_ID and tg_id == DEVELOPER_TG_ID
 
@@ -1929,16 +2737,19 @@ async def ensure_user(db, tg_id: int, full_name: str | None):
         if safe_name and (not u["full_name"] or u["full_name"] == "unknown"):
             await db.execute("UPDATE users SET full_name=? WHERE tg_id=?", (safe_name, tg_id))
             await db.commit()
+            user_cache_invalidate(tg_id=tg_id)
             u["full_name"] = safe_name
         # Разработчик — всегда developer и активен
         if is_dev_tg(tg_id) and (u["role"] != "developer" or u["is_active"] != 1):
             await db.execute("UPDATE users SET role='developer', is_active=1 WHERE tg_id=?", (tg_id,))
             await db.commit()
+            user_cache_invalidate(tg_id=tg_id)
             u["role"] = "developer"; u["is_active"] = 1
         # Владелец (если не дев) — head, но не перебивает developer
         elif OWNER_TG_ID and tg_id == OWNER_TG_ID and u["role"] not in ("developer","head"):
             await db.execute("UPDATE users SET role='head' WHERE tg_id=?", (tg_id,))
             await db.commit()
+            user_cache_invalidate(tg_id=tg_id)
             u["role"] = "head"
         return u
 
@@ -1974,54 +2785,115 @@ async def user_has_active_task(db, user_id: int) -> bool:
     )
     return (await cur.fetchone()) is not None
 
+# =========================
+# Иерархия руководителей: таблица-замыкание + зеркало в памяти
+# =========================
+# Пересобираем зеркало лениво: версия растёт после каждого commit, меняющего manager_closure
+_mgr_mirror = {"version": 0, "loaded": -1, "anc_ids": {}, "anc_tg": {}}
+
+def mgr_mirror_invalidate():
+    """Звать ПОСЛЕ commit изменений manager_links/manager_closure (и удаления пользователей)."""
+    _mgr_mirror["version"] += 1
+    db_pool.after_commit(_mgr_mirror_bump)
+
+def _mgr_mirror_bump():
+    _mgr_mirror["version"] += 1
+
+async def _mgr_mirror_get(db) -> dict:
+    if _mgr_mirror["loaded"] == _mgr_mirror["version"]:
+        return _mgr_mirror
+    version = _mgr_mirror["version"]
+    cur = await db.execute("""
+        SELECT mc.descendant, mc.ancestor, u.tg_id
+        FROM manager_closure mc
+        JOIN users u ON u.id = mc.ancestor
+    """)
+    anc_ids: dict[int, set[int]] = {}
+    anc_tg: dict[int, set[int]] = {}
+    for desc, anc, tg in await cur.fetchall():
+        anc_ids.setdefault(desc, set()).add(anc)
+        anc_tg.setdefault(desc, set()).add(tg)
+    _mgr_mirror.update(anc_ids=anc_ids, anc_tg=anc_tg, loaded=version)
+    return _mgr_mirror
+
+async def manager_closure_add_link(db, manager_id: int, subordinate_id: int):
+    """
+    Инкрементально дополнить замыкание новой связью manager → subordinate:
+    все (предки manager + он сам) × (потомки subordinate + он сам). Commit — за вызывающим.
+    """
+    await db.execute("""
+        INSERT INTO manager_closure(ancestor, descendant, depth)
+        SELECT a.anc, d.des, a.depth + 1 + d.depth
+        FROM (SELECT ? AS anc, 0 AS depth
+              UNION ALL
+              SELECT ancestor, depth FROM manager_closure WHERE descendant=?) a,
+             (SELECT ? AS des, 0 AS depth
+              UNION ALL
+              SELECT descendant, depth FROM manager_closure WHERE ancestor=?) d
+        WHERE a.anc != d.des
+        ON CONFLICT(ancestor, descendant) DO UPDATE SET depth = MIN(depth, excluded.depth)
+    """, (manager_id, manager_id, subordinate_id, subordinate_id))
+
+async def manager_closure_rebuild(db):
+    """
+    Полная пересборка из manager_links (старт и удаление связей: при удалении
+    ребра в DAG нельзя локально понять, остался ли обходной путь). Commit — за вызывающим.
+    """
+    await db.execute("DELETE FROM manager_closure")
+    await db.execute("""
+        INSERT INTO manager_closure(ancestor, descendant, depth)
+        WITH RECURSIVE chain(anc, des, depth) AS (
+          SELECT manager_user_id, subordinate_user_id, 1 FROM manager_links
+          UNION
+          SELECT ml.manager_user_id, c.des, c.depth + 1
+          FROM manager_links ml
+          JOIN chain c ON ml.subordinate_user_id = c.anc
+          WHERE c.depth < 64
+        )
+        SELECT anc, des, MIN(depth) FROM chain WHERE anc != des GROUP BY anc, des
+    """)
+
 async def is_manager_of(db, manager_id: int, subordinate_id: int) -> bool:
     # developer может всё
     cur = await db.execute("SELECT role FROM users WHERE id=?", (manager_id,))
     row = await cur.fetchone()
     if row and row[0] == "developer":
         return True
-    sql = """
-    WITH RECURSIVE chain(manager_id, subordinate_id) AS (
-      SELECT manager_user_id, subordinate_user_id FROM manager_links
-      UNION
-      SELECT ml.manager_user_id, c.subordinate_id
-      FROM manager_links ml
-      JOIN chain c ON ml.subordinate_user_id = c.manager_id
-    )
-    SELECT 1 FROM chain WHERE manager_id=? AND subordinate_id=? LIMIT 1;
-    """
-    cur = await db.execute(sql, (manager_id, subordinate_id))
-    return (await cur.fetchone()) is not None
+    mirror = await _mgr_mirror_get(db)
+    return manager_id in mirror["anc_ids"].get(subordinate_id, ())
+
+async def _manager_tg_ids_of(db, subordinate_user_id: int) -> set[int]:
+    mirror = await _mgr_mirror_get(db)
+    return set(mirror["anc_tg"].get(subordinate_user_id, ()))
 
 async def get_manager_tg_ids(db, subordinate_user_id: int):
-    sql = """
-    WITH RECURSIVE chain(manager_id, subordinate_id) AS (
-      SELECT manager_user_id, subordinate_user_id FROM manager_links
-      UNION
-      SELECT ml.manager_user_id, c.subordinate_id
-      FROM manager_links ml
-      JOIN chain c ON ml.subordinate_user_id = c.manager_id
-    )
-    SELECT DISTINCT u.tg_id
-    FROM chain ch
-    JOIN users u ON u.id = ch.manager_id
-    WHERE ch.subordinate_id = ?;
-    """
-    cur = await db.execute(sql, (subordinate_user_id,))
-    rows = await cur.fetchall()
-    tg_ids = {r[0] for r in rows}
+    tg_ids = await _manager_tg_ids_of(db, subordinate_user_id)
     # developer всегда получает уведомления
     if DEVELOPER_TG_ID:
         tg_ids.add(DEVELOPER_TG_ID)
     return list(tg_ids)
 
-def fmt_dt_local(iso: str | None) -> str:
-    if not iso:
-        return "не указан"
-    try:
+def _parse_iso(iso: str) -> datetime:
+    """
+    ISO из БД → aware datetime (naive считаем UTC).
+    Мы сами пишем isoformat(), так что fromisoformat почти всегда срабатывает; dateutil — запасной путь.
+    """
+    try:
+        dt = datetime.fromisoformat(iso)
+    except ValueError:
         dt = dateparser.parse(iso)
-        dt_local = dt.astimezone(LOCAL_TZ) if dt.tzinfo else dt.replace(tzinfo=UTC).astimezone(LOCAL_TZ)
-        return dt_local.strftime("%d.%m.%Y %H:%M")
+    return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+
+def fmt_ts_local(ts: int | None) -> str:
+    if ts is None:
+        return "не указан"
+    return datetime.fromtimestamp(ts, LOCAL_TZ).strftime("%d.%m.%Y %H:%M")
+
+def fmt_dt_local(iso: str | None) -> str:
+    if not iso:
+        return "не указан"
+    try:
+        return _parse_iso(iso).astimezone(LOCAL_TZ).strftime("%d.%m.%Y %H:%M")
     except Exception:
         return iso
     
@@ -2315,7 +3187,7 @@ async def active_tasks_summary(db, user_id: int) -> str:
         SELECT id, description, status, deadline
         FROM tasks
         WHERE user_id=? AND status!='done'
-        ORDER BY COALESCE(deadline,'9999-12-31'), id
+        ORDER BY deadline_ts IS NULL, deadline_ts, id
     """, (user_id,))
     rows = await cur.fetchall()
 
@@ -2337,7 +3209,7 @@ async def render_user_summary(db, user_id: int) -> str:
         SELECT id, description, deadline, status, planned_start_at, updated_at, started_at
         FROM tasks
         WHERE user_id=? AND status!='done'
-        ORDER BY COALESCE(deadline, '9999') ASC, id DESC
+        ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
         LIMIT 100
     """, (user_id,))
     rows = await cur.fetchall()
@@ -2368,7 +3240,7 @@ def next_reminder_after(deadline_iso: str | None) -> str:
             nxt = now + timedelta(hours=1)
             return clamp_to_work_hours(nxt).isoformat()
 
-        dl = dateparser.parse(deadline_iso)
+        dl = _parse_iso(deadline_iso)
         # грейс 5 минут после дедлайна
         if (dl - now) <= timedelta(hours=1):
             nxt = dl + timedelta(minutes=5)
@@ -2407,8 +3279,8 @@ async def _gs_open_projects():
     if _agcm_cache_projects["mgr"] is None or _agcm_cache_projects["path"] != cred_abs:
         _agcm_cache_projects["mgr"] = _agcm_builder(cred_abs)  # из первой части helpers
         _agcm_cache_projects["path"] = cred_abs
-    agc = await _agcm_cache_projects["mgr"].authorize()
-    return await agc.open_by_key(gs_id)
+        gs_registry.invalidate(gs_id)
+    return await gs_registry.open(gs_id, _agcm_cache_projects["mgr"])
 
 def _sheet_title_from_name(name: str) -> str:
     # Google ограничивает длину и спецсимволы
@@ -2418,21 +3290,32 @@ def _sheet_title_from_name(name: str) -> str:
         t = t.replace(ch, ' ')
     return t.strip() or "Project"
 
-async def _dedupe_sheet_title(sh, desired: str) -> str:
-    """Если такой лист уже есть — добавляем суффикс ' (2)', '(3)', ..."""
+async def _projects_sheet_titles() -> set[str]:
+    """
+    Имена листов таблицы проектов: из реестра, а если он ещё холодный — один запрос метаданных.
+    Звать до db_write(): запрос к API под блокировкой писателя держал бы всю базу.
+    """
     try:
-        existing = {ws.title for ws in await sh.worksheets()}
-    except Exception:
-        existing = set()
+        return set(await gs_registry.titles(await _gs_open_projects()))
+    except Exception as e:
+        logging.warning(f"projects sheet titles unavailable: {e}")
+        return gs_registry.cached_titles(os.getenv("GSHEET_PROJECTS_ID", "").strip())
+
+async def _dedupe_sheet_title(db, desired: str, sheet_titles: set[str] = frozenset()) -> str:
+    """
+    Если такой лист уже есть — добавляем суффикс ' (2)', '(3)', ...
+    Занятые имена — листы наших проектов плюс sheet_titles (см. _projects_sheet_titles):
+    там и листы, созданные в таблице руками.
+    """
+    cur = await db.execute("SELECT sheet_title FROM project_meta")
+    existing = {r[0] for r in await cur.fetchall()}
+    existing |= sheet_titles
     if desired not in existing:
         return desired
-    base = desired
     i = 2
-    while True:
-        cand = f"{base} ({i})"
-        if cand not in existing:
-            return cand
+    while f"{desired} ({i})" in existing:
         i += 1
+    return f"{desired} ({i})"
 
 async def _ensure_project_ws(sh, sheet_title: str, start_date: date, end_date: date):
     """Создаёт/обновляет лист проекта: A=Задача, B=Исполнитель, C..=дни."""
@@ -2458,32 +3341,492 @@ async def _ensure_project_ws(sh, sheet_title: str, start_date: date, end_date: d
         pass
     return ws
 
-async def _projects_next_row(ws) -> int:
-    """Номер следующей строки (1-based) после последней заполненной в колонке A."""
-    try:
-        colA = await ws.col_values(1)
-    except Exception:
-        colA = []
-    return max(2, len(colA) + 1)
+SHEETS_FLUSH_MS = max(0, int(os.getenv("SHEETS_FLUSH_MS", "300")))
+
+def _cell_value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, (int, float)):
+        return {"numberValue": v}
+    return {"stringValue": "" if v is None else str(v)}
 
-async def _projects_paint_cell(ws, row_index: int, col_index: int, color: dict):
+class SheetsWriteBuffer:
     """
-    Закрасить ячейку (row_index, col_index) указанным цветом.
-    Работает с gspread_asyncio через Worksheet.format(A1, {...}).
+    Буфер записи для одной таблицы: значения ячеек (updateCells) и заливка (repeatCell)
+    копятся в пределах окна SHEETS_FLUSH_MS и уходят одним spreadsheets.batchUpdate.
+    Повторная запись в ту же ячейку в пределах окна заменяет предыдущую.
     """
-    # импорт локально, чтобы не трогать импортов сверху
-    from gspread.utils import rowcol_to_a1
 
-    # A1-нотация для конкретной ячейки
-    a1 = rowcol_to_a1(row_index, col_index)
+    def __init__(self, sh, autoflush: bool = True):
+        self.sh = sh
+        # False — окно уходит только явным flush(): его результат тогда честно относится ко всем операциям
+        self.autoflush = autoflush
+        # (sheetId, row, col, kind) → запрос; dict сохраняет порядок первой записи
+        self._ops: dict[tuple, dict] = {}
+        self._waiters: list[asyncio.Future] = []
+        self._timer: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.stats = {"ops": 0, "merged": 0, "flushes": 0, "api_calls": 0, "failed": 0}
+
+    def _put(self, key: tuple, req: dict):
+        self.stats["ops"] += 1
+        if key in self._ops:
+            self.stats["merged"] += 1
+        self._ops[key] = req
+        if self._timer is None and self.autoflush:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    def set_values(self, ws, row: int, col: int, values: list):
+        """Записать значения в строку row начиная с колонки col (1-based)."""
+        for k, v in enumerate(values):
+            self._put((ws.id, row, col + k, "v"), {
+                "updateCells": {
+                    "range": {"sheetId": ws.id, "startRowIndex": row - 1, "endRowIndex": row,
+                              "startColumnIndex": col - 1 + k, "endColumnIndex": col + k},
+                    "rows": [{"values": [{"userEnteredValue": _cell_value(v)}]}],
+                    "fields": "userEnteredValue",
+                }
+            })
+
+    def paint(self, ws, row: int, col: int, color: dict):
+        """Залить ячейку (row, col) — то же, что ws.format(a1, {"backgroundColor": color})."""
+        self._put((ws.id, row, col, "bg"), {
+            "repeatCell": {
+                "range": {"sheetId": ws.id, "startRowIndex": row - 1, "endRowIndex": row,
+                          "startColumnIndex": col - 1, "endColumnIndex": col},
+                "cell": {"userEnteredFormat": {"backgroundColor": color}},
+                "fields": "userEnteredFormat.backgroundColor",
+            }
+        })
+
+    async def _flush_later(self):
+        await asyncio.sleep(SHEETS_FLUSH_MS / 1000)
+        self._timer = None
+        await self.flush()
+
+    async def wait(self) -> bool:
+        """Дождаться flush текущего окна. False — запись не удалась (ошибка уже в логе)."""
+        if not self._ops:
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        return await fut
+
+    async def flush(self) -> bool:
+        async with self._lock:
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+                self._timer = None
+            ops, self._ops = list(self._ops.values()), {}
+            waiters, self._waiters = self._waiters, []
+            ok = True
+            if ops:
+                try:
+                    await self.sh.batch_update({"requests": ops})
+                    self.stats["api_calls"] += 1
+                except Exception as e:
+                    ok = False
+                    self.stats["failed"] += 1
+                    logging.warning("sheets buffer flush failed (%s ops): %s", len(ops), e)
+                self.stats["flushes"] += 1
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(ok)
+            return ok
+
+    def snapshot(self) -> dict:
+        st = self.stats
+        # без буфера каждая операция была отдельным вызовом API
+        return {**st, "saved": st["ops"] - st["api_calls"] - st["failed"], "pending": len(self._ops)}
+
+_sheets_buffers: dict[str, SheetsWriteBuffer] = {}
+
+def sheets_buffer(sh) -> SheetsWriteBuffer:
+    buf = _sheets_buffers.get(sh.id)
+    if buf is None:
+        buf = _sheets_buffers[sh.id] = SheetsWriteBuffer(sh)
+    else:
+        buf.sh = sh  # свежий объект таблицы (после повторной авторизации)
+    return buf
+
+def _paint_key(color: dict) -> str:
+    return ",".join(f"{float(color.get(k, 0.0)):.3f}" for k in ("red", "green", "blue"))
+
+async def project_paint_record(db, paints: list[tuple[int, int, dict]]):
+    """Запомнить отправленные заливки [(project_task_id, col_index, color), ...]. Commit — за вызывающим."""
+    if not paints:
+        return
+    await db.executemany("""
+        INSERT INTO project_cell_paint(project_task_id, col_index, color, painted_at)
+        VALUES(?, ?, ?, datetime('now'))
+        ON CONFLICT(project_task_id, col_index) DO UPDATE SET color=excluded.color, painted_at=excluded.painted_at
+    """, [(ptid, col, _paint_key(color)) for ptid, col, color in paints])
+
+def _projects_paint_cell(sh, ws, row_index: int, col_index: int, color: dict, buf: SheetsWriteBuffer | None = None):
+    """
+    Закрасить ячейку (row_index, col_index) указанным цветом — через буфер таблицы (или переданный buf).
+    Запрос уйдёт в ближайшем flush; дождаться можно через sheets_buffer(sh).wait().
+    """
+    (buf or sheets_buffer(sh)).paint(ws, row_index, col_index, color)
+
+# --- Персистентная очередь операций Sheets: хэндлеры не ждут API ---
+# inline — синхронизация в процессе бота (как раньше); worker — в отдельном процессе `python bot.py sheets-worker`
+SHEETS_SYNC_MODE = os.getenv("SHEETS_SYNC_MODE", "inline").strip().lower()
+# воркер в другом процессе не видит _sheets_outbox_wakeup бота — там опрашиваем очередь чаще
+SHEETS_OUTBOX_POLL_SEC = max(0.5, float(os.getenv("SHEETS_OUTBOX_POLL_SEC", "2" if SHEETS_SYNC_MODE == "worker" else "15")))
+SHEETS_OUTBOX_BATCH = max(1, int(os.getenv("SHEETS_OUTBOX_BATCH", "200")))
+SHEETS_OUTBOX_MAX_ATTEMPTS = max(1, int(os.getenv("SHEETS_OUTBOX_MAX_ATTEMPTS", "20")))
+_sheets_outbox_wakeup = asyncio.Event()
+_sheets_outbox_task: asyncio.Task | None = None
+_sheets_outbox_stats = {"enqueued": 0, "applied": 0, "drains": 0, "failed": 0, "dead": 0}
+
+async def sheets_outbox_put(db, op: str, target: str = "projects", **payload):
+    """
+    Поставить операцию в очередь. Звать внутри той же db_write()-секции, что и изменение БД:
+    запись в БД и будущая запись в таблицу коммитятся вместе и переживают рестарт.
+    """
+    await db.execute(
+        "INSERT INTO sheets_outbox(target, op, payload) VALUES(?, ?, ?)",
+        (target, op, json.dumps(payload, ensure_ascii=False)),
+    )
+    _sheets_outbox_stats["enqueued"] += 1
+    # воркер проснётся, когда секция уже закоммичена (или на следующем тике)
+    _sheets_outbox_wakeup.set()
+
+async def _sheets_outbox_fail(ids: list[int], attempts: dict[int, int], err: Exception):
+    """Отложить операции с экспоненциальной паузой; после SHEETS_OUTBOX_MAX_ATTEMPTS — в 'dead'."""
+    now = int(time.time())
+    async with db_write() as db:
+        for oid in ids:
+            n = attempts[oid] + 1
+            if n >= SHEETS_OUTBOX_MAX_ATTEMPTS:
+                _sheets_outbox_stats["dead"] += 1
+                logging.warning(f"sheets outbox op {oid} dropped after {n} attempts: {err}")
+                await db.execute(
+                    "UPDATE sheets_outbox SET status='dead', attempts=?, last_error=? WHERE id=?",
+                    (n, str(err)[:500], oid),
+                )
+            else:
+                await db.execute(
+                    "UPDATE sheets_outbox SET attempts=?, next_try_ts=?, last_error=? WHERE id=?",
+                    (n, now + min(600, 2 ** n), str(err)[:500], oid),
+                )
+        await db.commit()
+    _sheets_outbox_stats["failed"] += len(ids)
+
+class _OutboxFlushError(RuntimeError):
+    pass
+
+async def sheets_outbox_drain() -> int:
+    """
+    Применить накопившиеся операции по порядку id: значения и заливка — одним batchUpdate через буфер,
+    создание листа — сразу (следующие операции могут на него ссылаться).
+    Буфер у прохода свой, без таймера: общий буфер таблицы мог бы отправить (и потерять при ошибке)
+    наши операции чужим flush, а строки очереди мы удаляем только после подтверждённой записи.
+    Берём только операции, которым пришло время; отложенная держит лишь свой лист: его более поздние
+    операции ждут её (порядок внутри листа сохраняется), остальные листы идут дальше.
+    """
+    now = int(time.time())
+    async with db_read() as db:
+        cur = await db.execute("""
+            SELECT id, op, payload, attempts
+            FROM sheets_outbox o
+            WHERE status='pending' AND target='projects' AND next_try_ts <= :now
+              AND NOT EXISTS (
+                SELECT 1 FROM sheets_outbox d
+                WHERE d.status='pending' AND d.target='projects' AND d.next_try_ts > :now AND d.id < o.id
+                  AND json_extract(d.payload, '$.sheet_title') = json_extract(o.payload, '$.sheet_title')
+              )
+            ORDER BY id
+            LIMIT :lim
+        """, {"now": now, "lim": SHEETS_OUTBOX_BATCH})
+        rows = await cur.fetchall()
+    if not rows:
+        return 0
+    _sheets_outbox_stats["drains"] += 1
+    # операции пришли из действий пользователей — вперёд фоновой синхронизации
+    gs_token = _gs_priority.set("interactive")
+
+    attempts = {oid: n for oid, _, _, n in rows}
+    buffered: list[int] = []
+    paints: list[tuple[int, int, dict]] = []
+    applied = 0
+
+    async def _settle(ids: list[int], paint_rows: list):
+        async with db_write() as db:
+            await db.executemany("DELETE FROM sheets_outbox WHERE id=?", [(i,) for i in ids])
+            await project_paint_record(db, paint_rows)
+            await db.commit()
 
+    async def _flush_buffered():
+        nonlocal buffered, paints, applied
+        if not buffered:
+            return
+        if not await buf.flush():
+            raise _OutboxFlushError("buffer flush failed")
+        await _settle(buffered, paints)
+        applied += len(buffered)
+        buffered, paints = [], []
+
+    current = rows[0][0]
+    buf = None
     try:
-        # основной путь — форматирование ячейки на уровне листа
-        await ws.format(a1, {"backgroundColor": color})
+        sh = await _gs_open_projects()
+        buf = SheetsWriteBuffer(sh, autoflush=False)
+        for oid, op, payload, _ in rows:
+            current = oid
+            p = json.loads(payload)
+            if op == "ensure_project_ws":
+                # предыдущие записи — до создания следующего листа
+                await _flush_buffered()
+                await _ensure_project_ws(sh, p["sheet_title"], date.fromisoformat(p["start"]), date.fromisoformat(p["end"]))
+                await _settle([oid], [])
+                applied += 1
+                continue
+            ws = await _gs_ensure_ws(sh, p["sheet_title"])
+            if op == "set_values":
+                buf.set_values(ws, p["row"], p["col"], p["values"])
+            elif op == "paint":
+                _projects_paint_cell(sh, ws, p["row"], p["col"], p["color"], buf)
+                if p.get("ptask_id"):
+                    paints.append((p["ptask_id"], p["col"], p["color"]))
+            else:
+                logging.warning(f"sheets outbox: unknown op {op!r} (id={oid})")
+            buffered.append(oid)
+        await _flush_buffered()
     except Exception as e:
-        # резерв: просто проглатываем, чтобы не ронять обработчик (логировать при желании)
-        import logging
-        logging.warning("projects_paint_cell fallback/skip: %s", e)
+        # не прошёл flush — откладываем всю пачку буфера, иначе — операцию, на которой упали
+        await _sheets_outbox_fail(buffered if isinstance(e, _OutboxFlushError) else [current], attempts, e)
+    finally:
+        _gs_priority.reset(gs_token)
+        if buf is not None:
+            # в /gsstats — вместе с общим буфером таблицы
+            shared = sheets_buffer(buf.sh).stats
+            for k, v in buf.stats.items():
+                shared[k] += v
+    _sheets_outbox_stats["applied"] += applied
+    return applied
+
+async def sheets_outbox_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_sheets_outbox_wakeup.wait(), timeout=SHEETS_OUTBOX_POLL_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _sheets_outbox_wakeup.clear()
+        # короткая пауза: даём групповому commit зафиксировать секцию и копим соседние операции
+        await asyncio.sleep(SHEETS_FLUSH_MS / 1000)
+        try:
+            while await sheets_outbox_drain() >= SHEETS_OUTBOX_BATCH:
+                pass
+        except Exception as e:
+            logging.warning(f"sheets outbox loop: {e}")
+
+async def sheets_outbox_start():
+    global _sheets_outbox_task
+    if _sheets_outbox_task is None or _sheets_outbox_task.done():
+        _sheets_outbox_task = asyncio.create_task(sheets_outbox_loop(), name="sheets_outbox")
+        _sheets_outbox_wakeup.set()  # хвосты с прошлого запуска
+
+async def sheets_outbox_stop():
+    global _sheets_outbox_task
+    if _sheets_outbox_task is not None:
+        _sheets_outbox_task.cancel()
+        try:
+            await _sheets_outbox_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _sheets_outbox_task = None
+
+async def sheets_outbox_snapshot() -> dict:
+    async with db_read() as db:
+        cur = await db.execute("SELECT status, COUNT(*) FROM sheets_outbox GROUP BY status")
+        by_status = dict(await cur.fetchall())
+    return {**_sheets_outbox_stats, "pending": by_status.get("pending", 0), "dead_total": by_status.get("dead", 0)}
+
+# --- Процесс синхронизации Google Sheets (SHEETS_SYNC_MODE=worker) ---
+# Бот только ставит задания в sheets_jobs и пишет операции в sheets_outbox; HTTP к Google, сборка строк
+# Ганта/KPI и ожидание квот — в отдельном процессе, цикл бота на это время не занят.
+SHEETS_WORKER_POLL_SEC = max(0.5, float(os.getenv("SHEETS_WORKER_POLL_SEC", "2")))
+SHEETS_JOB_STALE_SEC = max(60, int(os.getenv("SHEETS_JOB_STALE_SEC", "1800")))
+SHEETS_OUTBOX_LEASE_SEC = 60
+
+def _sheets_job_kinds() -> dict:
+    return {
+        "sync": lambda: gs_sync_all(),
+        "sync_full": lambda: gs_sync_all(full=True),
+        "proj_overdues": projects_sync_overdues,
+    }
+
+async def sheets_job_request(kind: str) -> int:
+    """Поставить задание воркеру; такое же ещё не начатое — не дублируем, возвращаем его id."""
+    async with db_write() as db:
+        cur = await db.execute("SELECT id FROM sheets_jobs WHERE kind=? AND status='pending' ORDER BY id LIMIT 1", (kind,))
+        row = await cur.fetchone()
+        if row:
+            return row[0]
+        cur = await db.execute(
+            "INSERT INTO sheets_jobs(kind, requested_ts) VALUES(?, ?)", (kind, int(time.time()))
+        )
+        await db.commit()
+        return cur.lastrowid
+
+async def sheets_job_wait(job_id: int, timeout: float = 600) -> tuple[str, str | None]:
+    """Дождаться завершения задания (опрос БД). ('timeout', None), если воркер не успел."""
+    deadline = time.monotonic() + timeout
+    while True:
+        async with db_read() as db:
+            cur = await db.execute("SELECT status, error FROM sheets_jobs WHERE id=?", (job_id,))
+            row = await cur.fetchone()
+        if row and row[0] in ("done", "failed"):
+            return row[0], row[1]
+        if time.monotonic() >= deadline:
+            return "timeout", None
+        await asyncio.sleep(1)
+
+async def gs_sync_now(full: bool = False, wait: bool = True):
+    """Синхронизация по запросу: в режиме worker — задание воркеру (и ожидание), иначе — прямо здесь."""
+    if SHEETS_SYNC_MODE != "worker":
+        await gs_sync_all(full=full)
+        return
+    job_id = await sheets_job_request("sync_full" if full else "sync")
+    if not wait:
+        return
+    status, err = await sheets_job_wait(job_id)
+    if status == "failed":
+        raise RuntimeError(err or "sheets worker job failed")
+    if status == "timeout":
+        raise TimeoutError("воркер синхронизации не ответил (запущен ли `bot.py sheets-worker`?)")
+
+async def _sheets_job_claim(owner: str) -> tuple[int, str] | None:
+    """Забрать самое раннее задание (или зависшее у упавшего воркера). Атомарно между процессами."""
+    now = int(time.time())
+    stale = now - SHEETS_JOB_STALE_SEC
+    async with db_read() as db:
+        # без заданий — только чтение, холостой воркер не занимает писателя
+        cur = await db.execute("""
+            SELECT 1 FROM sheets_jobs
+            WHERE status='pending' OR (status='running' AND started_ts < ?) LIMIT 1
+        """, (stale,))
+        if await cur.fetchone() is None:
+            return None
+    async with db_write() as db:
+        cur = await db.execute("""
+            UPDATE sheets_jobs SET status='running', owner=?, started_ts=?
+            WHERE id = (
+                SELECT id FROM sheets_jobs
+                WHERE status='pending' OR (status='running' AND started_ts < ?)
+                ORDER BY id LIMIT 1
+            )
+            RETURNING id, kind
+        """, (owner, now, stale))
+        row = await cur.fetchone()
+        await db.commit()
+    return (row[0], row[1]) if row else None
+
+async def _sheets_job_finish(job_id: int, err: Exception | None):
+    async with db_write() as db:
+        await db.execute(
+            "UPDATE sheets_jobs SET status=?, finished_ts=?, error=? WHERE id=?",
+            ("failed" if err else "done", int(time.time()), str(err)[:500] if err else None, job_id),
+        )
+        # история нужна только для диагностики — держим сутки
+        await db.execute("DELETE FROM sheets_jobs WHERE status IN ('done','failed') AND finished_ts < ?",
+                         (int(time.time()) - 86400,))
+        await db.commit()
+
+async def _sheets_outbox_lease(owner: str) -> bool:
+    """Очередь sheets_outbox разбирает один воркер (порядок операций); аренда в sync_state с продлением."""
+    now = int(time.time())
+    async with db_write() as db:
+        cur_val = await sync_state_get(db, "sheets_outbox_lease")
+        holder, _, until = (cur_val or "").rpartition("|")
+        if cur_val and holder != owner and int(until or 0) > now:
+            return False
+        if holder == owner and int(until or 0) - now > SHEETS_OUTBOX_LEASE_SEC // 2:
+            return True  # продлеваем ближе к концу аренды, а не каждый тик
+        await sync_state_set(db, "sheets_outbox_lease", f"{owner}|{now + SHEETS_OUTBOX_LEASE_SEC}")
+        await db.commit()
+    return True
+
+async def _sheets_outbox_lease_keeper(owner: str):
+    """
+    Своё сердцебиение аренды, независимое от заданий: длинный sync_full не даёт аренде истечь,
+    а если продлить не вышло (перехватили, ошибка БД) — разбор очереди останавливаем сразу,
+    чтобы два воркера не разбирали sheets_outbox одновременно.
+    """
+    while True:
+        try:
+            held = await _sheets_outbox_lease(owner)
+        except Exception as e:
+            logging.warning("Sheets worker: outbox lease: %s", e)
+            held = False
+        if held:
+            await sheets_outbox_start()
+        else:
+            await sheets_outbox_stop()
+        await asyncio.sleep(SHEETS_OUTBOX_LEASE_SEC / 4)
+
+async def sheets_worker_main():
+    """
+    Процесс синхронизации: `python bot.py sheets-worker` (в боте SHEETS_SYNC_MODE=worker).
+    Раз в GSYNC_PERIOD_MIN ставит sync и proj_overdues, выполняет задания из sheets_jobs по одному,
+    разбирает sheets_outbox (если держит аренду). Воркеров может быть несколько.
+    """
+    import socket
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    period_sec = 60 * max(1, int(os.getenv("GSYNC_PERIOD_MIN", "5") or 5))
+    kinds = _sheets_job_kinds()
+    await db_pool.open()
+    await init_db()
+    logging.info("Sheets worker %s started (period %ss)", owner, period_sec)
+    next_periodic = 0.0
+    lease_task = asyncio.create_task(_sheets_outbox_lease_keeper(owner), name="sheets_outbox_lease")
+    try:
+        while True:
+            if time.monotonic() >= next_periodic:
+                next_periodic = time.monotonic() + period_sec
+                try:
+                    _require_gs_config()
+                    await sheets_job_request("sync")
+                except Exception as e:
+                    logging.warning("Sheets worker: periodic sync skipped: %s", e)
+                await sheets_job_request("proj_overdues")
+
+            job = await _sheets_job_claim(owner)
+            if job is None:
+                await asyncio.sleep(SHEETS_WORKER_POLL_SEC)
+                continue
+            job_id, kind = job
+            t0 = time.perf_counter()
+            err = None
+            try:
+                fn = kinds.get(kind)
+                if fn is None:
+                    raise ValueError(f"unknown job kind {kind!r}")
+                await fn()
+            except Exception as e:
+                err = e
+                logging.warning("Sheets worker job %s (%s) failed: %s", job_id, kind, e)
+            await _sheets_job_finish(job_id, err)
+            logging.info("Sheets worker job %s (%s): %.1f s", job_id, kind, time.perf_counter() - t0)
+    finally:
+        lease_task.cancel()
+        try:
+            await lease_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        await sheets_outbox_stop()
+        await db_pool.close()
+
+async def sheets_jobs_snapshot() -> dict:
+    async with db_read() as db:
+        cur = await db.execute("SELECT status, COUNT(*) FROM sheets_jobs GROUP BY status")
+        by_status = dict(await cur.fetchall())
+        cur = await db.execute("SELECT MAX(finished_ts) FROM sheets_jobs WHERE status='done'")
+        last = (await cur.fetchone())[0]
+    return {"mode": SHEETS_SYNC_MODE, **by_status,
+            "last_done": fmt_ts_local(last) if last else "—"}
 
 # =========================
 # FSM
@@ -2546,20 +3889,56 @@ MAIN_ENTRY_TEXTS = {
     "🔗 Важные ссылки", "🔐 Пароли"
 }
 
+# Сколько запросов к БД делает один апдейт (middleware + хэндлер)
+_update_query_stats = {"updates": 0, "queries_total": 0, "queries_max": 0,
+                       "users_max": 0, "users_over_1": 0}
+
+def update_query_snapshot() -> dict:
+    st = _update_query_stats
+    avg = st["queries_total"] / st["updates"] if st["updates"] else 0.0
+    return {**st, "queries_avg": round(avg, 2)}
+
 class AccessMiddleware(BaseMiddleware):
     async def __call__(
         self,
         handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
         event: Update,
         data: Dict[str, Any]
+    ) -> Any:
+        counter = {"queries": 0, "users": 0}
+        token = _db_query_counter.set(counter)
+        # запросы к Google из обработчиков идут вперёд фоновой синхронизации
+        gs_token = _gs_priority.set("interactive")
+        try:
+            return await self._dispatch(handler, event, data)
+        finally:
+            _gs_priority.reset(gs_token)
+            _db_query_counter.reset(token)
+            st = _update_query_stats
+            st["updates"] += 1
+            st["queries_total"] += counter["queries"]
+            st["queries_max"] = max(st["queries_max"], counter["queries"])
+            st["users_max"] = max(st["users_max"], counter["users"])
+            if counter["users"] > 1:
+                st["users_over_1"] += 1
+            logging.debug("update %s: %s DB queries (%s on users)",
+                          event.update_id, counter["queries"], counter["users"])
+
+    async def _dispatch(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
     ) -> Any:
         # Извлекаем tg_id и текст
         tg_id, text = None, ""
         if event.message:
             tg_id = event.message.from_user.id
+            tg_name = event.message.from_user.full_name
             text = (event.message.text or "").strip()
         elif event.callback_query:
             tg_id = event.callback_query.from_user.id
+            tg_name = event.callback_query.from_user.full_name
             text = (event.callback_query.data or "").strip()
         else:
             return await handler(event, data)
@@ -2575,11 +3954,8 @@ class AccessMiddleware(BaseMiddleware):
                 await state.clear()
 
 
-        # Пользователь из БД (создадим карточку при первом заходе)
-        async with aiosqlite.connect(DB_PATH) as db:
-            u = await get_user_by_tg(db, tg_id)
-            if not u:
-                u = await ensure_user(db, tg_id, None)
+        # Пользователь из кэша/БД (создадим карточку при первом заходе)
+        u = await get_user_cached(tg_id, tg_name)
 
         # Блок для уволенных (кроме developer)
         if u["is_active"] != 1 and not is_dev_tg(tg_id):
@@ -2645,9 +4021,8 @@ class AccessMiddleware(BaseMiddleware):
 # Общие команды и кнопки
 # =========================
 @router.message(CommandStart())
-async def cmd_start(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        user = await ensure_user(db, m.from_user.id, m.from_user.full_name or m.from_user.username or "unknown")
+async def cmd_start(m: Message, state: FSMContext, current_user: dict | None = None):
+    user = current_user or await get_user_cached(m.from_user.id, m.from_user.full_name or m.from_user.username or "unknown")
 
     # Если не зарегистрирован → сразу в форму
     if user["registered"] != 1 and not is_dev_tg(m.from_user.id):
@@ -2695,19 +4070,18 @@ async def cmd_help(m: Message):
     await m.answer(text, parse_mode="HTML")
 
 @router.message(Command("id"))
-async def cmd_id(m: Message):
+async def cmd_id(m: Message, current_user: dict | None = None):
     tg_id = m.from_user.id
 
-    # читаем роль из БД
+    # роль — из карточки, которую уже подгрузил middleware
     role_suffix = ""
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, tg_id)  # уже существующая функция
-        if me and me.get("role"):
-            # показываем только допустимые роли
-            r = me["role"]
-            title = {"head": "Head", "lead": "Lead", "employee": "Employee", "developer": "Dev"}.get(r)
-            if title:
-                role_suffix = f" ({title})"
+    me = current_user or await get_user_cached(tg_id)
+    if me and me.get("role"):
+        # показываем только допустимые роли
+        r = me["role"]
+        title = {"head": "Head", "lead": "Lead", "employee": "Employee", "developer": "Dev"}.get(r)
+        if title:
+            role_suffix = f" ({title})"
 
     # как на скриншоте: кликабельный "user id", ниже — сам id, затем роль (если есть)
     await m.answer(
@@ -2726,13 +4100,13 @@ async def cmd_now(m: Message):
     await m.answer(f"UTC: {now_utc:%Y-%m-%d %H:%M:%S %Z}\n{TZ_NAME}: {now_local:%Y-%m-%d %H:%M:%S %Z}")
 
 @router.message(Command("test_morning"))
-async def cmd_test_morning(m: Message):
+async def cmd_test_morning(m: Message, current_user: dict | None = None):
     """
     Принудительно запустить утренний опрос (для тестов).
     Доступно только head.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me or me["role"] != "head":
             await m.answer("❌ Нет доступа.")
             return
@@ -2744,10 +4118,9 @@ async def cmd_test_morning(m: Message):
 # Регистрация
 # =========================
 @router.message(Command("register"))
-async def cmd_register(m: Message, state: FSMContext):
+async def cmd_register(m: Message, state: FSMContext, current_user: dict | None = None):
     # запрещаем повторную регистрацию, если уже зарегистрирован (кроме developer — он и так не проходит форму)
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or m.from_user.username or "unknown")
+    u = current_user or await get_user_cached(m.from_user.id, m.from_user.full_name or m.from_user.username or "unknown")
 
     if u.get("registered") == 1 and not is_dev_tg(m.from_user.id):
         await m.answer("Вы уже зарегистрированы ✅. Если нужна перерегистрация — обратитесь к разработчику.")
@@ -2757,17 +4130,18 @@ async def cmd_register(m: Message, state: FSMContext):
     await m.answer("Введите ваши Фамилию и Имя (например: Иванов Иван).")
 
 @router.message(RegisterForm.waiting_fullname)
-async def do_register(m: Message, state: FSMContext):
+async def do_register(m: Message, state: FSMContext, current_user: dict | None = None):
     full = (m.text or "").strip()
     if len(full.split()) < 2:
         await m.answer("Нужно две части: Фамилия и Имя. Попробуйте ещё раз.")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # сохраним ФИО, регистрацию пока не закрываем
-        u = await ensure_user(db, m.from_user.id, full)
+        u = current_user or await get_user_by_tg(db, m.from_user.id)
         await db.execute("UPDATE users SET full_name=? WHERE id=?", (full, u["id"]))
         await db.commit()
+    user_cache_invalidate(tg_id=m.from_user.id)
 
     await state.set_state(RegisterForm.waiting_dept)
     await m.answer(
@@ -2777,22 +4151,23 @@ async def do_register(m: Message, state: FSMContext):
     )
 
 @router.message(RegisterForm.waiting_dept)
-async def do_register_dept(m: Message, state: FSMContext):
+async def do_register_dept(m: Message, state: FSMContext, current_user: dict | None = None):
     dept = (m.text or "").strip()
     if not dept:
         await m.answer("Отдел не распознан. Напишите название отдела текстом (например: SMM).")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, None)
+    async with db_write() as db:
+        u = current_user or await get_user_by_tg(db, m.from_user.id)
         await db.execute("UPDATE users SET dept=?, registered=1 WHERE id=?", (dept, u["id"]))
         await db.commit()
+    user_cache_invalidate(tg_id=m.from_user.id)
 
     await state.clear()
     await m.answer("Готово. Регистрация завершена ✅. Доступ к функциям открыт.", reply_markup=main_menu_kb())
 
 @router.message(DeptAssign.waiting_dept)
-async def dept_assign_apply(m: Message, state: FSMContext):
+async def dept_assign_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     dept = (m.text or "").strip()
     if not dept:
         await m.answer("Отдел не распознан. Введите короткое название."); 
@@ -2805,13 +4180,14 @@ async def dept_assign_apply(m: Message, state: FSMContext):
         await m.answer("Сессия потеряна, начните заново через «🏷 Определить отдел».")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
-        if me["role"] not in ("head", "developer"):
-            await m.answer("Нет доступа"); await state.clear(); return
+    me = current_user or await get_user_cached(m.from_user.id)
+    if me["role"] not in ("head", "developer"):
+        await m.answer("Нет доступа"); await state.clear(); return
 
+    async with db_write() as db:
         await db.execute("UPDATE users SET dept=? WHERE id=?", (dept, target_user_id))
         await db.commit()
+        user_cache_invalidate(user_id=target_user_id)
 
         tgt = await get_user_by_id(db, target_user_id)
 
@@ -2826,9 +4202,9 @@ async def dept_assign_apply(m: Message, state: FSMContext):
 # Добавление задачи СЕБЕ
 # =========================
 @router.message(Command("task"))
-async def cmd_task(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or m.from_user.username or "unknown")
+async def cmd_task(m: Message, state: FSMContext, current_user: dict | None = None):
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, m.from_user.id)
         if not u["full_name"] or u["full_name"] == "unknown" or len(u["full_name"].split()) < 2:
             await m.answer("⚠️ Сначала зарегистрируйтесь: «📝 Регистрация».")
             return
@@ -2842,10 +4218,10 @@ async def cmd_task(m: Message, state: FSMContext):
 
 # ====== DEV: "📈 Зарегистрировались" (reply-кнопка) ======
 @router.message(F.text == "📈 Зарегистрировались")
-async def admin_stats_reply(m: Message):
+async def admin_stats_reply(m: Message, current_user: dict | None = None):
     # доступ только разработчику
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me or me.get("role") != "developer":
             await m.answer("Нет доступа."); return
 
@@ -2884,10 +4260,10 @@ async def admin_stats_reply(m: Message):
 
 # ====== DEV: "👥 Сотрудники (удаление)" (reply-кнопка) ======
 @router.message(F.text == "👥 Сотрудники (удаление)")
-async def admin_users_reply(m: Message):
+async def admin_users_reply(m: Message, current_user: dict | None = None):
     # доступ только разработчику
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me or me.get("role") != "developer":
             await m.answer("Нет доступа."); return
 
@@ -2950,33 +4326,32 @@ async def admin_full_reset_prompt(m: Message, state: FSMContext):
     )
 
 @router.message(F.text == "➕ Добавить задачу")
-async def on_btn_add_task(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def on_btn_add_task(m: Message, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(m.from_user.id)
     if not me or not me.get("is_active", 1):
         await m.answer("❌ Вы больше не активны в системе. Обратитесь к руководителю.")
         return
-    await cmd_task(m, state)
+    await cmd_task(m, state, current_user=me)
 
 from aiogram import F
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 @router.message(F.text.in_({"Мои задачи", "📋 Мои задачи"}))
-async def cmd_my_tasks(m: Message):
+async def cmd_my_tasks(m: Message, current_user: dict | None = None):
     """
     Показывает список активных задач сотрудника, отсортированных по дедлайну,
     каждая задача — отдельная карточка с кнопками управления.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    async with db_read() as db:
+        u = current_user or await get_user_by_tg(db, m.from_user.id)
 
         # Получаем задачи, отсортированные по ближайшему дедлайну
         cur = await db.execute("""
             SELECT id, description, status, deadline
             FROM tasks
             WHERE user_id=? AND status!='done'
-            ORDER BY COALESCE(deadline, '9999-12-31') ASC, id ASC
+            ORDER BY deadline_ts IS NULL, deadline_ts ASC, id ASC
         """, (u["id"],))
         rows = await cur.fetchall()
 
@@ -3008,9 +4383,8 @@ async def cmd_my_tasks(m: Message):
         await m.answer(text, parse_mode="HTML", reply_markup=kb.as_markup())
 
 @router.message(F.text == "🔗 Важные ссылки")
-async def links_home(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+async def links_home(m: Message, current_user: dict | None = None):
+    me = current_user or await get_user_cached(m.from_user.id, m.from_user.full_name or "")
     is_editor = me["role"] in ("head", "developer")
     txt = (
         "Хранилище ссылок:\n"
@@ -3030,10 +4404,9 @@ async def cmd_creds_menu(m: Message):
     await m.answer(text, reply_markup=_creds_main_kb().as_markup())
 
 @router.callback_query(F.data == "pl:add_project")
-async def pl_add_project(cq: CallbackQuery, state: FSMContext):
+async def pl_add_project(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     await _remove_kb_safe(cq.message)
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет прав", show_alert=True); return
 
@@ -3042,21 +4415,21 @@ async def pl_add_project(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.message(LinkProjectCreate.waiting_name)
-async def pl_add_project_apply(m: Message, state: FSMContext):
+async def pl_add_project_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     name = (m.text or "").strip()
     if len(name) < 2:
         await m.answer("Слишком коротко. Введите название проекта."); return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
-        try:
+    me = current_user or await get_user_cached(m.from_user.id)
+    try:
+        async with db_write() as db:
             await db.execute(
                 "INSERT INTO projects(name, created_by_id) VALUES(?,?)",
                 (name, me["id"])
             )
             await db.commit()
-        except Exception:
-            await m.answer("Такой проект уже есть или ошибка БД."); await state.clear(); return
+    except Exception:
+        await m.answer("Такой проект уже есть или ошибка БД."); await state.clear(); return
 
     await state.clear()
     await m.answer(f"✅ Проект «{H(name)}» создан.")
@@ -3065,11 +4438,11 @@ def _pl_open_cb(pid: int) -> str:
     return f"pl:open:{pid}"
 
 @router.callback_query(F.data == "pl:choose")
-async def pl_choose(cq: CallbackQuery):
+async def pl_choose(cq: CallbackQuery, current_user: dict | None = None):
     # снимаем инлайн-клавиатуру у вызвавшего сообщения
     await _remove_kb_safe(cq.message)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         # показываем ТОЛЬКО те проекты, по которым уже есть ссылки
         cur = await db.execute("""
             SELECT p.id, p.name
@@ -3082,7 +4455,7 @@ async def pl_choose(cq: CallbackQuery):
         """)
         rows = await cur.fetchall()
 
-        me = await get_user_by_tg(db, cq.from_user.id)
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         is_editor = me["role"] in ("head", "developer")
 
     if not rows:
@@ -3102,10 +4475,10 @@ async def pl_choose(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("pl:open:"))
-async def pl_open(cq: CallbackQuery):
+async def pl_open(cq: CallbackQuery, current_user: dict | None = None):
     await _remove_kb_safe(cq.message)
     pid = int(cq.data.split(":")[2])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT name FROM projects WHERE id=?", (pid,))
         r = await cur.fetchone()
         if not r:
@@ -3120,7 +4493,7 @@ async def pl_open(cq: CallbackQuery):
         """, (pid,))
         links = await cur.fetchall()
 
-        me = await get_user_by_tg(db, cq.from_user.id)
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         is_editor = me["role"] in ("head", "developer")
 
     # вывод: «Имя проекта — <a href="...">краткое название</a>»
@@ -3140,13 +4513,12 @@ def _pl_add_link_cb(pid: int) -> str:
     return f"pl:add_link:{pid}"
 
 @router.callback_query(F.data.startswith("pl:add_link:"))
-async def pl_add_link_start(cq: CallbackQuery, state: FSMContext):
+async def pl_add_link_start(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     await _remove_kb_safe(cq.message)
     parts = cq.data.split(":")
     pid = int(parts[2])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет прав", show_alert=True); return
 
@@ -3165,7 +4537,7 @@ async def pl_add_link_title(m: Message, state: FSMContext):
     await m.answer("Вставь сам URL (начинается с http:// или https://).")
 
 @router.message(LinkAdd.waiting_url)
-async def pl_add_link_url(m: Message, state: FSMContext):
+async def pl_add_link_url(m: Message, state: FSMContext, current_user: dict | None = None):
     url = (m.text or "").strip()
     if not (url.startswith("http://") or url.startswith("https://")):
         await m.answer("Похоже, это не URL. Вставь ссылку целиком (http/https)."); return
@@ -3174,8 +4546,8 @@ async def pl_add_link_url(m: Message, state: FSMContext):
     pid = int(data["pl_project_id"])
     title = data["pl_title"]
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         await db.execute(
             "INSERT INTO project_links(project_id, title, url, created_by_id) VALUES(?,?,?,?)",
             (pid, title, url, me["id"])
@@ -3195,14 +4567,15 @@ async def pl_add_link_url(m: Message, state: FSMContext):
     )
 
 @router.callback_query(F.data == "my_tasks")
-async def cq_my_tasks(cq: CallbackQuery):
-    await cmd_my_tasks(cq.message)
+async def cq_my_tasks(cq: CallbackQuery, current_user: dict | None = None):
+    # cq.message отправлено ботом — пользователя берём из middleware, а не из from_user
+    await cmd_my_tasks(cq.message, current_user=current_user)
     await cq.answer()
 
 @router.message(F.text == "🛠 Изменить статус задачи")
-async def on_btn_change_status(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def on_btn_change_status(m: Message, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me or not me.get("is_active", 1):
             await m.answer("❌ Вы больше не активны в системе.")
             return
@@ -3210,7 +4583,7 @@ async def on_btn_change_status(m: Message):
             SELECT id, description, deadline, status
             FROM tasks
             WHERE user_id=? AND status!='done'
-            ORDER BY COALESCE(deadline,'9999') ASC, id DESC
+            ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
         """, (me["id"],))
         rows = await cur.fetchall()
 
@@ -3278,7 +4651,7 @@ async def mgrp_choose_project(cq: CallbackQuery, state: FSMContext):
     except Exception:
         pass
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         # узнаём фактические колонки таблицы projects
         cur = await db.execute("PRAGMA table_info(projects)")
         cols = {row[1] for row in await cur.fetchall()}
@@ -3355,7 +4728,7 @@ async def mgrp_open_project(cq: CallbackQuery, state: FSMContext):
         await cq.answer("Ошибка формата данных", show_alert=True)
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         # берём имя по той же логике, что и в списке
         cur = await db.execute("PRAGMA table_info(projects)")
         cols = {row[1] for row in await cur.fetchall()}
@@ -3406,7 +4779,7 @@ async def mgrp_list_tasks(cq: CallbackQuery, state: FSMContext):
         return
 
     # 1) Название проекта
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT name FROM projects WHERE id=?", (pid,))
         row = await cur.fetchone()
         project_name = row[0] if row else f"Проект #{pid}"
@@ -3474,15 +4847,14 @@ async def mgrp_list_tasks(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.callback_query(F.data == "mgrp:add_project")
-async def mgrp_add_project(cq: CallbackQuery, state: FSMContext):
+async def mgrp_add_project(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     # удалить сообщение-меню «Проекты»
     try:
         await cq.message.delete()
     except Exception:
         pass
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет доступа", show_alert=True)
         return
@@ -3494,15 +4866,15 @@ async def mgrp_add_project(cq: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "mgrp:add_task")
-async def mgrp_add_task(cq: CallbackQuery):
+async def mgrp_add_task(cq: CallbackQuery, current_user: dict | None = None):
     # удалить сообщение-меню «Проекты»
     try:
         await cq.message.delete()
     except Exception:
         pass
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("head", "developer"):
             await cq.answer("Нет доступа", show_alert=True)
             return
@@ -3534,31 +4906,30 @@ async def mgrp_add_task(cq: CallbackQuery):
 
 # Назначить задачу (reply-кнопка)
 @router.message(F.text == "👤 Назначить задачу")
-async def mgr_assign_reply(m: Message, state: FSMContext):
+async def mgr_assign_reply(m: Message, state: FSMContext, current_user: dict | None = None):
     await state.set_state(AssignPick.picking_user)
-    await show_user_picker(m, 0, for_tg_id=m.from_user.id)
+    await show_user_picker(m, 0, for_tg_id=m.from_user.id, me=current_user)
 
 # Сводка по сотруднику
 @router.message(F.text == "📊 Сводка по сотруднику")
-async def mgr_summary_reply(m: Message):
-    await show_user_picker_summary(m, 0, for_tg_id=m.from_user.id)
+async def mgr_summary_reply(m: Message, current_user: dict | None = None):
+    await show_user_picker_summary(m, 0, for_tg_id=m.from_user.id, me=current_user)
 
 @router.message(F.text == "🏷 Определить отдел")
-async def dept_assign_start(m: Message, state: FSMContext):
+async def dept_assign_start(m: Message, state: FSMContext, current_user: dict | None = None):
     # Доступ только head/developer
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    me = current_user or await get_user_cached(m.from_user.id)
     if me["role"] not in ("head", "developer"):
         await m.answer("Нет доступа"); return
 
     await state.set_state(DeptAssign.picking_user)
-    await show_user_picker_dept(m, 0, for_tg_id=m.from_user.id)
+    await show_user_picker_dept(m, 0, for_tg_id=m.from_user.id, me=me)
 
 # Мои подчинённые (тот же вывод, что и callback)
 @router.message(F.text == "👥 Мои подчинённые")
-async def mgr_team_reply(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def mgr_team_reply(m: Message, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if me["role"] not in ("lead","head","developer"):
             await m.answer("Нет доступа"); return
 
@@ -3582,9 +4953,9 @@ async def mgr_team_reply(m: Message):
 
 # Руководители
 @router.message(F.text == "📒 Руководители")
-async def mgr_leads_reply(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def mgr_leads_reply(m: Message, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if me["role"] not in ("head","developer"):
             await m.answer("Нет доступа"); return
         cur = await db.execute("SELECT full_name, tg_id FROM users WHERE role='lead' ORDER BY full_name")
@@ -3597,9 +4968,8 @@ async def mgr_leads_reply(m: Message):
 
 # Назначить роль
 @router.message(F.text == "🛠 Назначить роль")
-async def mgr_setrole_reply(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def mgr_setrole_reply(m: Message, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(m.from_user.id)
     if me["role"] not in ("head", "developer"):
         await m.answer("Нет доступа")
         return
@@ -3613,9 +4983,8 @@ async def mgr_setrole_reply(m: Message, state: FSMContext):
 
 # Связать иерархию
 @router.message(F.text == "🔗 Связать иерархию")
-async def mgr_link_reply(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+async def mgr_link_reply(m: Message, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(m.from_user.id)
     if me["role"] not in ("head", "developer"):
         await m.answer("Нет доступа")
         return
@@ -3628,8 +4997,8 @@ async def mgr_link_reply(m: Message, state: FSMContext):
 
 # Запросить план
 @router.message(F.text == "📨 Запросить план")
-async def mgr_plan_req_reply(m: Message):
-    await show_user_picker_planreq(m, 0, for_tg_id=m.from_user.id)
+async def mgr_plan_req_reply(m: Message, current_user: dict | None = None):
+    await show_user_picker_planreq(m, 0, for_tg_id=m.from_user.id, me=current_user)
 
 # Назад к главному меню
 @router.message(F.text == "⬅️ В главное меню")
@@ -3641,7 +5010,7 @@ import re
 TIME_RE = re.compile(r"\b([01]\d|2[0-3]):([0-5]\d)\b")  # HH:MM
 
 @router.message(F.reply_to_message)
-async def handle_daily_plan_item(m: Message):
+async def handle_daily_plan_item(m: Message, current_user: dict | None = None):
     """
     Если пользователь отвечает РЕПЛАЕМ на утреннее сообщение, принимаем пункт плана.
     Требуем наличие времени HH:MM. Иначе — просим отправить заново.
@@ -3649,37 +5018,38 @@ async def handle_daily_plan_item(m: Message):
     if not (m.text and m.text.strip()):
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me:
             return
 
         # сверяем, что реплай именно на «утреннее» сообщение
         cur = await db.execute("SELECT last_plan_msg_id, last_plan_date FROM users WHERE id=?", (me["id"],))
         row = await cur.fetchone()
-        if not row:
-            return
-        last_plan_msg_id, last_plan_date = row
-        if not last_plan_msg_id or not last_plan_date:
-            return
-        if m.reply_to_message.message_id != last_plan_msg_id:
-            # это реплай не к утреннему, отдадим дальше другим хэндлерам (например, отчёт по напоминанию)
-            return
+    if not row:
+        return
+    last_plan_msg_id, last_plan_date = row
+    if not last_plan_msg_id or not last_plan_date:
+        return
+    if m.reply_to_message.message_id != last_plan_msg_id:
+        # это реплай не к утреннему, отдадим дальше другим хэндлерам (например, отчёт по напоминанию)
+        return
 
-        # валидируем время
-        txt = m.text.strip()
-        mt = TIME_RE.search(txt)
-        if not mt:
-            await m.answer(
-                "❌ Не принял пункт: в сообщении нет времени в формате `HH:MM`.\n"
-                "Пример: `Сдать обложку в 15:45`.\n"
-                "Отправьте пункт снова, ОБЯЗАТЕЛЬНО отвечая реплаем на моё утреннее сообщение.",
-                parse_mode="Markdown"
-            )
-            return
+    # валидируем время
+    txt = m.text.strip()
+    mt = TIME_RE.search(txt)
+    if not mt:
+        await m.answer(
+            "❌ Не принял пункт: в сообщении нет времени в формате `HH:MM`.\n"
+            "Пример: `Сдать обложку в 15:45`.\n"
+            "Отправьте пункт снова, ОБЯЗАТЕЛЬНО отвечая реплаем на моё утреннее сообщение.",
+            parse_mode="Markdown"
+        )
+        return
 
-        hhmm = mt.group(0)
+    hhmm = mt.group(0)
 
+    async with db_write() as db:
         # сохраняем пункт
         await db.execute(
             "INSERT INTO daily_plan_items(user_id, plan_date, text, time_str) VALUES(?,?,?,?)",
@@ -3692,7 +5062,7 @@ async def handle_daily_plan_item(m: Message):
 # Фолбэк: принимать пункт плана даже без reply,
 # ТОЛЬКО когда нет активного состояния FSM
 @router.message(StateFilter(None), F.text & ~F.text.startswith("/"))
-async def handle_daily_plan_item_fallback(m: Message):
+async def handle_daily_plan_item_fallback(m: Message, current_user: dict | None = None):
     txt = (m.text or "").strip()
     if not txt:
         return
@@ -3701,8 +5071,8 @@ async def handle_daily_plan_item_fallback(m: Message):
     if not mt:
         return  # это не пункт плана
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me:
             return
 
@@ -3726,7 +5096,7 @@ async def handle_daily_plan_item_fallback(m: Message):
     await m.answer(f"✅ Принято: {txt}\n(время {hhmm})")
 
 @router.message(F.reply_to_message)
-async def handle_report_reply(m: Message):
+async def handle_report_reply(m: Message, current_user: dict | None = None):
     """
     Если пользователь ответил реплаем на напоминание/просрочку,
     отправляем его текст руководителям как отчёт по задаче.
@@ -3740,8 +5110,8 @@ async def handle_report_reply(m: Message):
     report_text = m.text.strip()
 
     # Найти задачу, для которой это напоминание было отправлено
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, user_tg)
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, user_tg)
         if not me:
             return
 
@@ -3753,19 +5123,19 @@ async def handle_report_reply(m: Message):
             LIMIT 1
         """, (me["id"], reply_msg_id))
         row = await cur.fetchone()
+        if row:
+            task_id, desc, user_id, deadline, status = row
+            managers = await get_manager_tg_ids(db, user_id)
 
-        if not row:
-            # Ничего не нашли — возможно, ответили не на то сообщение
-            await m.answer("Не удалось сопоставить ответ с задачей. Ответьте прямо на сообщение-напоминание (реплаем).")
-            return
-
-        task_id, desc, user_id, deadline, status = row
-        managers = await get_manager_tg_ids(db, user_id)
+            # По желанию можно «очистить» last_reminder_msg_id, чтобы ответ приняли только один раз
+            await db.execute("UPDATE tasks SET last_reminder_msg_id=NULL, updated_at=? WHERE id=?",
+                             (datetime.now(UTC).isoformat(), task_id))
+            await db.commit()
 
-        # По желанию можно «очистить» last_reminder_msg_id, чтобы ответ приняли только один раз
-        await db.execute("UPDATE tasks SET last_reminder_msg_id=NULL, updated_at=? WHERE id=?",
-                         (datetime.now(UTC).isoformat(), task_id))
-        await db.commit()
+    if not row:
+        # Ничего не нашли — возможно, ответили не на то сообщение
+        await m.answer("Не удалось сопоставить ответ с задачей. Ответьте прямо на сообщение-напоминание (реплаем).")
+        return
 
     # Сообщение сотруднику
     await m.answer("✅ Принял отчёт, отправляю руководителям.")
@@ -3784,11 +5154,7 @@ async def handle_report_reply(m: Message):
             f"Текущий статус: {status}\n\n"
             f"Ответ: {report_text}"
         )
-        for mid in managers:
-            try:
-                await bot.send_message(mid, text_mgr)
-            except Exception as e:
-                logging.warning(f"notify manager failed (report reply) tg_id={mid}: {e}")
+        notify_many(managers, text_mgr, what="report reply")
 
 @router.message(TaskForm.waiting_desc)
 async def form_desc(m: Message, state: FSMContext):
@@ -3825,7 +5191,7 @@ async def form_desc(m: Message, state: FSMContext):
     await state.update_data(add_msg_id=msg.message_id)
 
 @router.message(TaskForm.waiting_deadline)
-async def form_deadline(m: Message, state: FSMContext):
+async def form_deadline(m: Message, state: FSMContext, current_user: dict | None = None):
     text = (m.text or "").strip()
     dt_utc = parse_human_time(text)
     if not dt_utc:
@@ -3839,8 +5205,8 @@ async def form_deadline(m: Message, state: FSMContext):
     desc = data["description"]
     now = datetime.now(UTC)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        user = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    async with db_write() as db:
+        user = current_user or await get_user_by_tg(db, m.from_user.id)
         # ВАЖНО: не часовой пинг, а один-единственный триггер в момент дедлайна
         next_rem = dt_utc.isoformat()
 
@@ -3851,30 +5217,28 @@ async def form_deadline(m: Message, state: FSMContext):
         """, (user["id"], desc, dt_utc.isoformat(), 'new', next_rem, None, now.isoformat(), now.isoformat()))
         await db.commit()
         task_id = cur.lastrowid
+        await reminders_refresh(db, task_id)
         await log_task_event(db, task_id, "create", meta=f"deadline={dt_utc.isoformat()}")
 
         manager_tg_ids = await get_manager_tg_ids(db, user["id"])
-        if manager_tg_ids:
-            text_mgr = (
-                f"🆕 Новая задача у {H(user['full_name'])}:\n"
-                f"#{task_id} — <b>{H(desc)}</b>\n"
-                f"{Q('Дедлайн: ' + fmt_dt_local(dt_utc.isoformat()))}"
-            )
-            for mid in manager_tg_ids:
-                try:
-                    await bot.send_message(mid, text_mgr, parse_mode="HTML")
-                except Exception as e:
-                    logging.warning(f"notify manager failed (create) tg_id={mid}: {e}")
-
         summary = await active_tasks_summary(db, user["id"])
 
+    # уведомления — уже после освобождения писателя
+    if manager_tg_ids:
+        text_mgr = (
+            f"🆕 Новая задача у {H(user['full_name'])}:\n"
+            f"#{task_id} — <b>{H(desc)}</b>\n"
+            f"{Q('Дедлайн: ' + fmt_dt_local(dt_utc.isoformat()))}"
+        )
+        notify_many(manager_tg_ids, text_mgr, what="create", parse_mode="HTML")
+
     # === финальный вывод одной карточки в том же сообщении ===
     # собираем клавиатуру под карточкой
     kb = await build_task_buttons(task_id)
 
     # если у пользователя нет начатых задач — добавим «Выбрать другую»
     try:
-        async with aiosqlite.connect(DB_PATH) as db2:
+        async with db_read() as db2:
             has_active = await user_has_active_task(db2, user["id"])
     except Exception:
         has_active = True  # безопасно
@@ -3909,7 +5273,7 @@ async def form_deadline(m: Message, state: FSMContext):
 # Мои задачи
 # =========================
 async def build_task_buttons(task_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("SELECT status, started_at FROM tasks WHERE id=?", (task_id,))
         row = await cur.fetchone()
 
@@ -3928,16 +5292,16 @@ async def build_task_buttons(task_id: int):
     return kb
 
 @router.message(Command("my"))
-async def cmd_my(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        user = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+async def cmd_my(m: Message, current_user: dict | None = None):
+    async with db_read() as db:
+        user = current_user or await get_user_by_tg(db, m.from_user.id)
         if not user or not user.get("is_active", 1):
             await m.answer("❌ Вы больше не активны в системе. Обратитесь к руководителю.")
             return
         cur = await db.execute("""
           SELECT id, description, deadline, status, last_postpone_reason, planned_start_at
           FROM tasks WHERE user_id=? AND status!='done'
-          ORDER BY COALESCE(deadline, '9999') ASC, id DESC
+          ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
         """, (user["id"],))
         rows = await cur.fetchall()
 
@@ -3970,9 +5334,8 @@ async def cmd_my(m: Message):
 # =========================
 
 @router.callback_query(F.data == "admin:reset")
-async def admin_reset_prompt(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def admin_reset_prompt(cq: CallbackQuery, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] != "developer":
         await cq.answer("Нет доступа", show_alert=True); return
     kb = InlineKeyboardBuilder()
@@ -3988,17 +5351,21 @@ async def admin_reset_cancel(cq: CallbackQuery):
     await cq.message.edit_text("Сброс отменён.")
 
 @router.callback_query(F.data == "admin:reset_confirm")
-async def admin_reset_confirm(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
-        if me["role"] != "developer":
-            await cq.answer("Нет доступа", show_alert=True); return
+async def admin_reset_confirm(cq: CallbackQuery, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
+    if me["role"] != "developer":
+        await cq.answer("Нет доступа", show_alert=True); return
 
-        # Удаляем все данные, кроме текущего разработчика
-        # 1) tasks
+    async with db_write() as db:
+        # Удаляем все данные, кроме текущего разработчика (дочерние таблицы — раньше родительских)
+        # 1) tasks (их журнал, свёртка для KPI и карта строк Gantt)
+        await db.execute("DELETE FROM task_events")
+        await db.execute("DELETE FROM kpi_daily")
+        await db.execute("DELETE FROM gantt_rows")
         await db.execute("DELETE FROM tasks")
         # 2) связи
         await db.execute("DELETE FROM manager_links")
+        await db.execute("DELETE FROM manager_closure")
         # 3) элементы планов
         await db.execute("DELETE FROM daily_plan_items")
         # 4) пользователи, кроме разработчика
@@ -4011,19 +5378,21 @@ async def admin_reset_confirm(cq: CallbackQuery):
         else:
             await db.execute("UPDATE users SET is_active=0, registered=0")
         await db.commit()
+    user_cache_invalidate()
+    mgr_mirror_invalidate()
 
     await cq.message.edit_text("✅ Полный сброс выполнен. В системе остался только Developer.")
     await cq.answer("Сброшено")
 
 @router.callback_query(F.data.startswith("plan_done:"))
-async def cb_plan_done(cq: CallbackQuery):
+async def cb_plan_done(cq: CallbackQuery, current_user: dict | None = None):
     plan_date = cq.data.split(":")[1]  # YYYY-MM-DD
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
-        if not me:
-            await cq.answer(); return
+    me = current_user or await get_user_cached(cq.from_user.id)
+    if not me:
+        await cq.answer(); return
 
+    async with db_write() as db:
         # заберём пункты плана
         cur = await db.execute("""
             SELECT text, time_str
@@ -4053,29 +5422,25 @@ async def cb_plan_done(cq: CallbackQuery):
     await cq.answer("Отправляю руководителям.")
 
     # Руководителям
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         mgrs = await get_manager_tg_ids(db, me["id"])
     if mgrs:
         hdr = f"📬 План {me['full_name']} (tg_id: {me['tg_id']}) на {plan_date}:\n"
-        for mid in mgrs:
-            try:
-                await bot.send_message(mid, hdr + plan_text)
-            except Exception as e:
-                logging.warning(f"notify manager failed (daily plan) tg_id={mid}: {e}")
+        notify_many(mgrs, hdr + plan_text, what="daily plan")
 
 # === НАЧАТЬ РАБОТУ ПО ЗАДАЧЕ ===============================================
 from aiogram.types import CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 @router.callback_query(F.data.startswith("task_start_now:"))
-async def cb_task_start_now(cq: CallbackQuery):
+async def cb_task_start_now(cq: CallbackQuery, current_user: dict | None = None):
     """
     Кнопка ▶️ «начать сейчас»: меняем статус и РЕДАКТИРУЕМ текущее сообщение.
     """
     rid = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         now = datetime.now(UTC).isoformat()
 
         await db.execute("""
@@ -4106,34 +5471,30 @@ async def cb_task_start_now(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("task_done:"))
-async def cb_task_done(cq: CallbackQuery):
+async def cb_task_done(cq: CallbackQuery, current_user: dict | None = None):
     """
     ✅ Завершение: помечаем как done и РЕДАКТИРУЕМ текущее сообщение карточки
     на зелёный блок «Задача выполнена». Никаких новых сообщений.
     """
     task_id = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, cq.from_user.id, cq.from_user.full_name or "")
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         # достанем описание/дедлайн до апдейта — нужно для текста
-        cur = await db.execute("SELECT description, deadline, last_reminder_msg_id FROM tasks WHERE id=?", (task_id,))
+        cur = await db.execute("""
+            SELECT description, deadline_ts, last_reminder_msg_id, user_id, status, completed_ts, delay_minutes
+            FROM tasks WHERE id=?
+        """, (task_id,))
         r = await cur.fetchone()
         desc = (r[0] if r else "") or ""
-        dl   =  r[1] if r else None
+        dl_ts = r[1] if r else None
         last_rem_msg_id = r[2] if r else None
 
         # посчитаем просрочку (в минутах)
-        delay_min = 0
-        try:
-            if dl:
-                from math import floor
-                dl_dt = dateparser.parse(dl)
-                diff  = (datetime.now(UTC) - dl_dt).total_seconds()
-                delay_min = max(0, floor(diff / 60))
-        except Exception:
-            pass
+        now_dt = datetime.now(UTC)
+        delay_min = max(0, (int(now_dt.timestamp()) - dl_ts) // 60) if dl_ts is not None else 0
 
-        now = datetime.now(UTC).isoformat()
+        now = now_dt.isoformat()
         await db.execute("""
             UPDATE tasks
                SET status='done',
@@ -4143,8 +5504,14 @@ async def cb_task_done(cq: CallbackQuery):
                    delay_minutes=?
              WHERE id=?
         """, (now, now, me["id"], delay_min, task_id))
+        if r and r[3] is not None:
+            # повторное нажатие перезаписывает completed_at — старый вклад в свёртку убираем
+            if r[4] == "done" and r[5] is not None:
+                await kpi_daily_apply(db, r[3], r[5], r[6], sign=-1)
+            await kpi_daily_apply(db, r[3], int(now_dt.timestamp()), delay_min)
         await db.commit()
         await log_task_event(db, task_id, "done")
+        reminder_schedule(task_id, None)
 
     # Удалим возможное «сообщение о просрочке»
     if last_rem_msg_id:
@@ -4180,7 +5547,7 @@ async def prompt_next_task_for_user(user_tg_id: int, chat_id: int, force: bool =
     и кнопки «▶️ #id Название». Есть «🕗 Выберу позже».
     Если force=False и у пользователя есть задача в работе — ничего не шлём.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         u = await get_user_by_tg(db, user_tg_id)
         if not u:
             return
@@ -4194,7 +5561,7 @@ async def prompt_next_task_for_user(user_tg_id: int, chat_id: int, force: bool =
             SELECT id, description, deadline
             FROM tasks
             WHERE user_id=? AND status!='done'
-            ORDER BY COALESCE(deadline,'9999') ASC, id DESC
+            ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
             LIMIT 10
         """, (u["id"],))
         rows = await cur.fetchall()
@@ -4284,7 +5651,7 @@ async def extend_datetime_entered(m: Message, state: FSMContext):
     new_next = dt_utc.isoformat()
     old_dl = None
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # получаем старый дедлайн
         cur_old = await db.execute("SELECT deadline FROM tasks WHERE id=?", (task_id,))
         row = await cur_old.fetchone()
@@ -4303,6 +5670,7 @@ async def extend_datetime_entered(m: Message, state: FSMContext):
             """,
             (dt_utc.isoformat(), now.isoformat(), new_next, reason, task_id),
         )
+        await reminders_refresh(db, task_id)
 
         # записываем событие в журнал
         try:
@@ -4351,11 +5719,12 @@ async def cb_overdue_snooze(cq: CallbackQuery):
 
     next_at_utc = datetime.now(UTC) + timedelta(minutes=minutes)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE tasks SET next_reminder_at=?, updated_at=? WHERE id=?",
             (next_at_utc.isoformat(), datetime.now(UTC).isoformat(), task_id)
         )
+        await reminders_refresh(db, task_id)
         await db.commit()
 
     await cq.answer(f"Напомню через {minutes} мин.")
@@ -4411,7 +5780,7 @@ async def overdue_set_custom_time(m: Message, state: FSMContext):
 
     next_at = next_reminder_after(dt_utc.isoformat())
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # 0) прочитаем старый дедлайн
         cur_old = await db.execute("SELECT deadline FROM tasks WHERE id=?", (task_id,))
         r_old = await cur_old.fetchone()
@@ -4447,11 +5816,12 @@ async def overdue_set_custom_time(m: Message, state: FSMContext):
             """,
             (dt_utc.isoformat(), now_iso, new_next, reason, task_id),
         )
+        await reminders_refresh(db, task_id)
         await db.commit()
 
         # если меняли deadline — записываем событие
         try:
-            async with aiosqlite.connect(DB_PATH) as db2:
+            async with db_write() as db2:
                 cur_old = await db2.execute("SELECT deadline FROM tasks WHERE id=?", (task_id,))
                 r_old = await cur_old.fetchone()
                 old_dl = r_old[0] if r_old else None
@@ -4472,7 +5842,8 @@ async def overdue_set_custom_time(m: Message, state: FSMContext):
     msg_id = data.get("overdue_msg_id")
     info = f"🔔 Напоминание перенесено на {fmt_dt_local(next_at)}"
     if chat_id and msg_id:
-        await _refresh_overdue_card(db, chat_id, msg_id, task_id, info)
+        async with db_read() as db:
+            await _refresh_overdue_card(db, chat_id, msg_id, task_id, info)
     else:
         await m.answer(info)
     await state.clear()
@@ -4518,11 +5889,12 @@ async def cb_overdue_custom_apply(m: Message, state: FSMContext):
     # для напоминаний тоже уважаем рабочие часы
     next_at = clamp_to_work_hours(dt_utc)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE tasks SET next_reminder_at=?, updated_at=? WHERE id=?",
             (next_at.isoformat(), datetime.now(UTC).isoformat(), task_id)
         )
+        await reminders_refresh(db, task_id)
         await db.commit()
 
     await state.clear()
@@ -4537,15 +5909,16 @@ async def cb_overdue_custom_apply(m: Message, state: FSMContext):
         )
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE tasks SET next_reminder_at=?, updated_at=? WHERE id=?",
             (dt_utc.isoformat(), datetime.now(UTC).isoformat(), int(task_id))
         )
+        await reminders_refresh(db, int(task_id))
 
         # если меняли deadline — записываем событие
         try:
-            async with aiosqlite.connect(DB_PATH) as db2:
+            async with db_write() as db2:
                 cur_old = await db2.execute("SELECT deadline FROM tasks WHERE id=?", (task_id,))
                 r_old = await cur_old.fetchone()
                 old_dl = r_old[0] if r_old else None
@@ -4579,7 +5952,7 @@ async def set_new_deadline(msg: Message, state: FSMContext):
         task_desc = None
         managers = []
 
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_write() as db:
             now_iso = datetime.now(UTC).isoformat()
 
             # ВАЖНО: next_reminder_at считаем с учётом грейса/часовой логики
@@ -4589,6 +5962,7 @@ async def set_new_deadline(msg: Message, state: FSMContext):
                 "UPDATE tasks SET deadline=?, updated_at=?, next_reminder_at=?, last_postpone_reason=? WHERE id=?",
                 (dt_utc.isoformat(), now_iso, new_next, reason, task_id)
             )
+            await reminders_refresh(db, task_id)
 
             cur = await db.execute("""
                 SELECT t.user_id, t.description, u.full_name
@@ -4599,20 +5973,7 @@ async def set_new_deadline(msg: Message, state: FSMContext):
             row = await cur.fetchone()
             if row:
                 user_id, task_desc, emp_full_name = row
-                cur2 = await db.execute("""
-                    WITH RECURSIVE chain(manager_id, subordinate_id) AS (
-                      SELECT manager_user_id, subordinate_user_id FROM manager_links
-                      UNION
-                      SELECT ml.manager_user_id, c.subordinate_id
-                      FROM manager_links ml
-                      JOIN chain c ON ml.subordinate_user_id = c.manager_id
-                    )
-                    SELECT DISTINCT u.tg_id
-                    FROM chain ch
-                    JOIN users u ON u.id = ch.manager_id
-                    WHERE ch.subordinate_id = ?;
-                """, (user_id,))
-                managers = [r[0] for r in await cur2.fetchall()]
+                managers = list(await _manager_tg_ids_of(db, user_id))
 
             await db.commit()
         
@@ -4621,7 +5982,8 @@ async def set_new_deadline(msg: Message, state: FSMContext):
         od_msg = data.get("overdue_msg_id")
         if od_chat and od_msg:
             info = f"🗓 Дедлайн обновлён: {fmt_dt_local(dt_utc.isoformat())}"
-            await _refresh_overdue_card(db, od_chat, od_msg, task_id, info)
+            async with db_read() as db:
+                await _refresh_overdue_card(db, od_chat, od_msg, task_id, info)
 
         if managers and emp_full_name and task_desc:
             note = (
@@ -4630,11 +5992,7 @@ async def set_new_deadline(msg: Message, state: FSMContext):
                 f"Причина: {reason}\n"
                 f"Новый дедлайн: {fmt_dt_local(dt_utc.isoformat())}"
             )
-            for mid in managers:
-                try:
-                    await bot.send_message(mid, note)
-                except Exception as e:
-                    logging.warning(f"notify manager failed (postpone) tg_id={mid}: {e}")
+            notify_many(managers, note, what="postpone")
 
     except Exception as e:
         logging.exception("set_new_deadline failed: %s", e)
@@ -4645,7 +6003,7 @@ async def cb_set_status(cq: CallbackQuery):
     _, task_id, new_status = cq.data.split(":")
     task_id = int(task_id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # обновим статус
         now_iso = datetime.now(UTC).isoformat()
         await db.execute(
@@ -4657,10 +6015,12 @@ async def cb_set_status(cq: CallbackQuery):
         # достанем актуальную карточку задачи
         cur = await db.execute("SELECT id, description, status, deadline FROM tasks WHERE id=?", (task_id,))
         t = await cur.fetchone()
-        if not t:
-            await cq.answer("Задача не найдена", show_alert=True)
-            return
-        t = dict(zip([c[0] for c in cur.description], t))
+        if t:
+            t = dict(zip([c[0] for c in cur.description], t))
+
+    if not t:
+        await cq.answer("Задача не найдена", show_alert=True)
+        return
 
     # красиво выводим карточку
     txt = render_task_card_html(t) + f"\n\nСтатус задачи #{task_id} изменён на <u>{STATUS_RU.get(new_status,new_status)}</u>."
@@ -4677,9 +6037,8 @@ def assign_user_cb(user_id: int) -> str:
     return f"assign_user:{user_id}"
 
 @router.message(Command("manager"))
-async def cmd_manager(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        u = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+async def cmd_manager(m: Message, current_user: dict | None = None):
+    u = current_user or await get_user_cached(m.from_user.id, m.from_user.full_name or "")
     role = (u.get("role") or "").lower()
     is_dev = (role == "developer")
     is_head = is_dev or (role == "head")
@@ -4693,15 +6052,14 @@ async def cmd_manager(m: Message):
 from aiogram.filters import Command
 
 @router.message(Command("rehire"))
-async def cmd_rehire(m: Message):
+async def cmd_rehire(m: Message, current_user: dict | None = None):
     parts = (m.text or "").split()
     if len(parts) < 2:
         await m.answer("Использование: /rehire <tg_id> [role]\nrole: employee|lead|head|developer (необязательно)")
         return
 
     # права
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    me = current_user or await get_user_cached(m.from_user.id)
     if not me or not me.get("is_active", 1) or me.get("role") != "developer":
         await m.answer("❌ Нет доступа.")
         return
@@ -4714,7 +6072,7 @@ async def cmd_rehire(m: Message):
     if role and role not in ("employee","lead","head","developer"):
         await m.answer("Недопустимая роль. Разрешено: employee|lead|head|developer"); return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # По умолчанию поднимаем is_active=1, роль — как указали (или оставляем), registered — не трогаем
         updated = await rehire_user_by_tg(db, target_tg, role=role, set_registered=None)
         u = await get_user_by_tg(db, target_tg)
@@ -4734,7 +6092,7 @@ async def cmd_rehire(m: Message):
 from aiogram.filters import Command
 
 @router.message(Command("resetreg"))
-async def cmd_resetreg(m: Message):
+async def cmd_resetreg(m: Message, current_user: dict | None = None):
     parts = (m.text or "").strip().split()
 
     if len(parts) != 2 or not parts[1].isdigit():
@@ -4745,28 +6103,28 @@ async def cmd_resetreg(m: Message):
         return
 
     # проверяем права
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, m.from_user.id)
         if not me or me.get("role") != "developer":
             await m.answer("❌ Нет доступа.")
             return
 
     target_tg = int(parts[1])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         cur = await db.execute("SELECT id, full_name FROM users WHERE tg_id=?", (target_tg,))
         row = await cur.fetchone()
-        if not row:
-            await m.answer(
-                f"Пользователь с tg_id <code>{target_tg}</code> не найден.",
-                parse_mode="HTML",
-            )
-            return
-
-        user_id, full_name = row
-
-        # сбрасываем регистрацию
-        await db.execute("UPDATE users SET registered=0, is_active=1 WHERE tg_id=?", (target_tg,))
-        await db.commit()
+        if row:
+            # сбрасываем регистрацию
+            await db.execute("UPDATE users SET registered=0, is_active=1 WHERE tg_id=?", (target_tg,))
+            await db.commit()
+    if not row:
+        await m.answer(
+            f"Пользователь с tg_id <code>{target_tg}</code> не найден.",
+            parse_mode="HTML",
+        )
+        return
+    user_id, full_name = row
+    user_cache_invalidate(tg_id=target_tg)
 
     await m.answer(
         f"Регистрация пользователя <b>{full_name}</b> (tg_id: <code>{target_tg}</code>) сброшена.\n"
@@ -4775,10 +6133,9 @@ async def cmd_resetreg(m: Message):
     )
 
 @router.message(Command("gsync"))
-async def cmd_gsync(m: Message):
+async def cmd_gsync(m: Message, current_user: dict | None = None):
     # доступ только руководителям/разработчику — оставьте вашу проверку, если уже есть
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    me = current_user or await get_user_cached(m.from_user.id)
     if not me or me.get("role") not in ("head", "developer"):
         await m.answer("⛔ Нет доступа.")
         return
@@ -4789,9 +6146,9 @@ async def cmd_gsync(m: Message):
         await m.answer(f"⚠️ Конфигурация Google Sheets не задана:\n<code>{e}</code>")
         return
 
-    await m.answer("🔄 Синхронизирую Google Sheet…")
+    await m.answer("🔄 Синхронизирую Google Sheet (полная пересборка)…")
     try:
-        await gs_sync_all()
+        await gs_sync_now(full=True)
         link = os.getenv("GSHEET_URL", "").strip()
         await m.answer("✅ Готово. " + (f"Таблица: {link}" if link else "Проверь таблицу."))
     except Exception as e:
@@ -4799,10 +6156,9 @@ async def cmd_gsync(m: Message):
         await m.answer(f"❌ Ошибка синхронизации:\n<code>{H(str(e))}</code>")
 
 @router.message(Command("gsdebug"))
-async def cmd_gsdebug(m: Message):
+async def cmd_gsdebug(m: Message, current_user: dict | None = None):
     # доступ как и был
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, m.from_user.id)
+    me = current_user or await get_user_cached(m.from_user.id)
     if not me or me.get("role") not in ("head", "developer"):
         await m.answer("⛔ Нет доступа.")
         return
@@ -4836,13 +6192,12 @@ async def cmd_gsdebug(m: Message):
     await m.answer("\n".join(lines))
 
 @router.callback_query(F.data == "mgr:assign")
-async def mgr_assign(cq: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_assign(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("lead","head","developer"):
         await cq.answer("Нет доступа", show_alert=True); return
     await state.set_state(AssignPick.picking_user)
-    await show_user_picker(cq, 0, for_tg_id=cq.from_user.id)
+    await show_user_picker(cq, 0, for_tg_id=cq.from_user.id, me=me)
 
 def summary_list_cb(page: int) -> str:
     return f"summary_list:{page}"
@@ -4851,22 +6206,20 @@ def summary_user_cb(user_id: int) -> str:
     return f"summary_user:{user_id}"
 
 @router.callback_query(F.data == "mgr:summary")
-async def mgr_summary(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_summary(cq: CallbackQuery, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("lead","head","developer"):
         await cq.answer("Нет доступа", show_alert=True); return
-    await show_user_picker_summary(cq, 0, for_tg_id=cq.from_user.id)
+    await show_user_picker_summary(cq, 0, for_tg_id=cq.from_user.id, me=me)
 
 @router.callback_query(F.data == "mgr:dept")
-async def mgr_dept(cq: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_dept(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет доступа", show_alert=True)
         return
     await state.set_state(DeptAssign.picking_user)
-    await show_user_picker_dept(cq, 0, for_tg_id=cq.from_user.id)
+    await show_user_picker_dept(cq, 0, for_tg_id=cq.from_user.id, me=me)
 
 # ====== Перезапрос плана: выбор сотрудника ======
 
@@ -4877,19 +6230,18 @@ def planreq_user_cb(user_id: int) -> str:
     return f"planreq_user:{user_id}"
 
 @router.callback_query(F.data == "mgr:plan_req")
-async def mgr_plan_req(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_plan_req(cq: CallbackQuery, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("lead","head","developer"):
         await cq.answer("Нет доступа", show_alert=True); return
-    await show_user_picker_planreq(cq, 0, for_tg_id=cq.from_user.id)
+    await show_user_picker_planreq(cq, 0, for_tg_id=cq.from_user.id, me=me)
 
-async def show_user_picker_planreq(m_or_cq, page: int, for_tg_id: int):
+async def show_user_picker_planreq(m_or_cq, page: int, for_tg_id: int, me: dict | None = None):
     is_callback = isinstance(m_or_cq, CallbackQuery)
     chat_id = m_or_cq.message.chat.id if is_callback else m_or_cq.chat.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, for_tg_id)
+    async with db_read() as db:
+        me = me or await get_user_by_tg(db, for_tg_id)
 
         # фильтрация по отделу
         if me["role"] == "developer":
@@ -4943,16 +6295,16 @@ async def show_user_picker_planreq(m_or_cq, page: int, for_tg_id: int):
         await bot.send_message(chat_id, text, reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("planreq_list:"))
-async def cb_planreq_list(cq: CallbackQuery):
+async def cb_planreq_list(cq: CallbackQuery, current_user: dict | None = None):
     page = int(cq.data.split(":")[1])
-    await show_user_picker_planreq(cq, page, for_tg_id=cq.from_user.id)
+    await show_user_picker_planreq(cq, page, for_tg_id=cq.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("planreq_user:"))
-async def cb_planreq_user(cq: CallbackQuery):
+async def cb_planreq_user(cq: CallbackQuery, current_user: dict | None = None):
     target_user_id = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("lead","head","developer"):
             await cq.answer("Нет доступа", show_alert=True); return
         if me["role"] == "lead" and not await is_manager_of(db, me["id"], target_user_id):
@@ -4966,12 +6318,12 @@ async def cb_planreq_user(cq: CallbackQuery):
     else:
         await cq.answer(f"Не удалось отправить: {err or 'ошибка'}", show_alert=True)
 
-async def show_user_picker_summary(m_or_cq, page: int, for_tg_id: int):
+async def show_user_picker_summary(m_or_cq, page: int, for_tg_id: int, me: dict | None = None):
     is_callback = isinstance(m_or_cq, CallbackQuery)
     chat_id = m_or_cq.message.chat.id if is_callback else m_or_cq.chat.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, for_tg_id)
+    async with db_read() as db:
+        me = me or await get_user_by_tg(db, for_tg_id)
         # фильтрация по отделу
         if me["role"] == "developer":
             # дев — все активные (кроме developer)
@@ -5024,19 +6376,19 @@ async def show_user_picker_summary(m_or_cq, page: int, for_tg_id: int):
         await bot.send_message(chat_id, text, reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("summary_list:"))
-async def cb_summary_list(cq: CallbackQuery):
+async def cb_summary_list(cq: CallbackQuery, current_user: dict | None = None):
     page = int(cq.data.split(":")[1])
-    await show_user_picker_summary(cq, page, for_tg_id=cq.from_user.id)
+    await show_user_picker_summary(cq, page, for_tg_id=cq.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("summary_user:"))
-async def cb_summary_user(cq: CallbackQuery):
+async def cb_summary_user(cq: CallbackQuery, current_user: dict | None = None):
     # УДАЛЯЕМ сообщение со списком сотрудников
     await _delete_msg_safe(cq.message)
 
     target_user_id = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("lead","head","developer"):
             await cq.answer("Нет доступа", show_alert=True); 
             return
@@ -5095,12 +6447,12 @@ async def cb_summary_user(cq: CallbackQuery):
 
     await cq.answer()
 
-async def show_user_picker(m_or_cq, page: int, for_tg_id: int):
+async def show_user_picker(m_or_cq, page: int, for_tg_id: int, me: dict | None = None):
     is_callback = isinstance(m_or_cq, CallbackQuery)
     chat_id = m_or_cq.message.chat.id if is_callback else m_or_cq.chat.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, for_tg_id)
+    async with db_read() as db:
+        me = me or await get_user_by_tg(db, for_tg_id)
         if me["role"] == "developer":
             cur = await db.execute("""
                 SELECT id, full_name, tg_id
@@ -5158,12 +6510,12 @@ def dept_list_cb(page: int) -> str:
 def dept_user_cb(user_id: int) -> str:
     return f"dept_user:{user_id}"
 
-async def show_user_picker_dept(m_or_cq, page: int, for_tg_id: int):
+async def show_user_picker_dept(m_or_cq, page: int, for_tg_id: int, me: dict | None = None):
     is_callback = isinstance(m_or_cq, CallbackQuery)
     chat_id = m_or_cq.message.chat.id if is_callback else m_or_cq.chat.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, for_tg_id)
+    async with db_read() as db:
+        me = me or await get_user_by_tg(db, for_tg_id)
         # head/developer видят всех активных (кроме developer)
         cur = await db.execute("""
             SELECT id, full_name, tg_id
@@ -5206,20 +6558,20 @@ async def show_user_picker_dept(m_or_cq, page: int, for_tg_id: int):
         await bot.send_message(chat_id, text, reply_markup=kb.as_markup())
 
 @router.callback_query(F.data.startswith("dept_list:"))
-async def cb_dept_list(cq: CallbackQuery, state: FSMContext):
+async def cb_dept_list(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     page = int(cq.data.split(":")[1])
     # состояние остаётся DeptAssign.picking_user
-    await show_user_picker_dept(cq, page, for_tg_id=cq.from_user.id)
+    await show_user_picker_dept(cq, page, for_tg_id=cq.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("dept_user:"))
-async def cb_dept_user(cq: CallbackQuery, state: FSMContext):
+async def cb_dept_user(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     # удаляем сообщение со списком
     await _delete_msg_safe(cq.message)
 
     target_user_id = int(cq.data.split(":")[1])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("head", "developer"):
             await cq.answer("Нет доступа", show_alert=True); return
         tgt = await get_user_by_id(db, target_user_id)
@@ -5237,16 +6589,16 @@ async def cb_dept_user(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("assign_list:"))
-async def cb_assign_list(cq: CallbackQuery, state: FSMContext):
+async def cb_assign_list(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     page = int(cq.data.split(":")[1])
     await state.set_state(AssignPick.picking_user)
-    await show_user_picker(cq, page, for_tg_id=cq.from_user.id)
+    await show_user_picker(cq, page, for_tg_id=cq.from_user.id, me=current_user)
 
 @router.callback_query(F.data.startswith("assign_user:"))
-async def cb_assign_user(cq: CallbackQuery, state: FSMContext):
+async def cb_assign_user(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
     target_user_id = int(cq.data.split(":")[1])
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("lead","head","developer"):
             await cq.answer("Нет доступа", show_alert=True); return
         if me["role"] == "lead" and not await is_manager_of(db, me["id"], target_user_id):
@@ -5275,7 +6627,7 @@ async def assign_desc(m: Message, state: FSMContext):
     )
 
 @router.message(AssignTask.waiting_deadline)
-async def assign_deadline(m: Message, state: FSMContext):
+async def assign_deadline(m: Message, state: FSMContext, current_user: dict | None = None):
     # 1) Парсим «человеческое» время -> aware UTC
     text = (m.text or "").strip()
     dt_utc = parse_human_time(text)
@@ -5293,8 +6645,8 @@ async def assign_deadline(m: Message, state: FSMContext):
     now = datetime.now(UTC)
 
     # 3) Создаём задачу: next_reminder_at ставим РОВНО НА ДЕДЛАЙН
-    async with aiosqlite.connect(DB_PATH) as db:
-        assigner = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
+    async with db_write() as db:
+        assigner = current_user or await get_user_by_tg(db, m.from_user.id)
 
         next_rem = dt_utc.isoformat()  # <- ключ: событие в момент дедлайна
 
@@ -5311,13 +6663,14 @@ async def assign_deadline(m: Message, state: FSMContext):
         ))
         await db.commit()
         task_id = cur.lastrowid
+        await reminders_refresh(db, task_id)
         await log_task_event(db, task_id, "create", meta=f"assigned_by={assigner['id']}; deadline={dt_utc.isoformat()}")
 
         tgt = await get_user_by_id(db, target_user_id)  # получим tg_id сотрудника
 
     # 4) Уведомляем сотрудника
     try:
-        await bot.send_message(
+        await send_queued(
             tgt["tg_id"],
             (
                 f"📌 Вам назначена новая задача от {H(assigner['full_name'])}:\n"
@@ -5331,15 +6684,15 @@ async def assign_deadline(m: Message, state: FSMContext):
         logging.warning(f"notify employee failed (assign): {e}")
 
     # 5) Ответ руководителю — сводка задач сотрудника
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         summary = await active_tasks_summary(db, target_user_id)
     await state.clear()
     await m.answer(f"Задача назначена ✅\n\n{summary}", parse_mode="HTML")
 
 @router.callback_query(F.data == "mgr:team")
-async def mgr_team(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_team(cq: CallbackQuery, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("lead","head","developer"):
             await cq.answer("Нет доступа", show_alert=True); return
 
@@ -5363,9 +6716,9 @@ async def mgr_team(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data == "mgr:leads")
-async def mgr_leads(cq: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_leads(cq: CallbackQuery, current_user: dict | None = None):
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if me["role"] not in ("head","developer"):
             await cq.answer("Нет доступа", show_alert=True); return
         cur = await db.execute("SELECT full_name, tg_id FROM users WHERE role='lead' ORDER BY full_name")
@@ -5378,9 +6731,8 @@ async def mgr_leads(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data == "mgr:setrole")
-async def mgr_setrole(cq: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_setrole(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет доступа", show_alert=True)
         return
@@ -5394,16 +6746,16 @@ async def mgr_setrole(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.message(SetRoleState.waiting)
-async def mgr_setrole_apply(m: Message, state: FSMContext):
+async def mgr_setrole_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     parts = m.text.strip().split()
     if len(parts) != 2 or (not parts[0].isdigit()) or parts[1] not in ("employee","lead","head"):
         await m.answer("Формат: <code>&lt;tg_id&gt; &lt;role&gt;</code> (role: employee|lead|head)")
         return
     target_tg_id = int(parts[0]); role = parts[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
-        if me["role"] not in ("head","developer"):
-            await m.answer("Нет доступа."); await state.clear(); return
+    me = current_user or await get_user_cached(m.from_user.id)
+    if me["role"] not in ("head","developer"):
+        await m.answer("Нет доступа."); await state.clear(); return
+    async with db_write() as db:
         tgt = await get_user_by_tg(db, target_tg_id)
         if not tgt:
             await db.execute("INSERT INTO users(tg_id, full_name, role) VALUES(?,?,?)",
@@ -5411,13 +6763,13 @@ async def mgr_setrole_apply(m: Message, state: FSMContext):
         else:
             await db.execute("UPDATE users SET role=? WHERE tg_id=?", (role, target_tg_id))
         await db.commit()
+    user_cache_invalidate(tg_id=target_tg_id)
     await state.clear()
     await m.answer(f"Роль пользователя {target_tg_id} установлена: {role}")
 
 @router.callback_query(F.data == "mgr:link")
-async def mgr_link(cq: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+async def mgr_link(cq: CallbackQuery, state: FSMContext, current_user: dict | None = None):
+    me = current_user or await get_user_cached(cq.from_user.id)
     if me["role"] not in ("head", "developer"):
         await cq.answer("Нет доступа", show_alert=True)
         return
@@ -5430,7 +6782,7 @@ async def mgr_link(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @router.message(LinkState.waiting)
-async def mgr_link_apply(m: Message, state: FSMContext):
+async def mgr_link_apply(m: Message, state: FSMContext, current_user: dict | None = None):
     parts = m.text.strip().split()
     if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
         await m.answer("Формат: `<manager_tg_id> <subordinate_tg_id>`"); return
@@ -5439,43 +6791,44 @@ async def mgr_link_apply(m: Message, state: FSMContext):
     if man_tg == sub_tg:
         await m.answer("Нельзя связать пользователя сам с собой."); return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await ensure_user(db, m.from_user.id, m.from_user.full_name or "")
-        if me["role"] not in ("head","developer"):
-            await m.answer("Нет доступа."); await state.clear(); return
+    me = current_user or await get_user_cached(m.from_user.id)
+    if me["role"] not in ("head","developer"):
+        await m.answer("Нет доступа."); await state.clear(); return
 
+    async with db_read() as db:
         man = await get_user_by_tg(db, man_tg)
         sub = await get_user_by_tg(db, sub_tg)
-        if not man or not sub:
-            await m.answer("Оба пользователя должны хотя бы раз открыть бота (/start)."); return
+    if not man or not sub:
+        await m.answer("Оба пользователя должны хотя бы раз открыть бота (/start)."); return
 
+    # проверки и вставка — под одним писателем, чтобы параллельная связь не проскочила между ними
+    err = None
+    async with db_write() as db:
         # Запрет дубликатов
         cur = await db.execute("""
             SELECT 1 FROM manager_links WHERE manager_user_id=? AND subordinate_user_id=? LIMIT 1
         """, (man["id"], sub["id"]))
         if await cur.fetchone():
-            await m.answer("Такая связь уже существует."); await state.clear(); return
-
-        # Запрет колец: нельзя сделать подчинённого руководителем своего начальника
-        # проверим, что sub не является (прямо/косвенно) руководителем man
-        cur = await db.execute("""
-            WITH RECURSIVE chain(manager_id, subordinate_id) AS (
-              SELECT manager_user_id, subordinate_user_id FROM manager_links
-              UNION
-              SELECT ml.manager_user_id, c.subordinate_id
-              FROM manager_links ml
-              JOIN chain c ON ml.subordinate_user_id = c.manager_id
+            err = "Такая связь уже существует."
+        else:
+            # Запрет колец: нельзя сделать подчинённого руководителем своего начальника
+            # проверим, что sub не является (прямо/косвенно) руководителем man
+            cur = await db.execute(
+                "SELECT 1 FROM manager_closure WHERE ancestor=? AND descendant=? LIMIT 1",
+                (sub["id"], man["id"])
             )
-            SELECT 1 FROM chain WHERE manager_id=? AND subordinate_id=? LIMIT 1
-        """, (sub["id"], man["id"]))
-        if await cur.fetchone():
-            await m.answer("Нельзя создавать циклическую иерархию."); await state.clear(); return
-
-        await db.execute(
-            "INSERT INTO manager_links(manager_user_id, subordinate_user_id) VALUES(?,?)",
-            (man["id"], sub["id"])
-        )
-        await db.commit()
+            if await cur.fetchone():
+                err = "Нельзя создавать циклическую иерархию."
+            else:
+                await db.execute(
+                    "INSERT INTO manager_links(manager_user_id, subordinate_user_id) VALUES(?,?)",
+                    (man["id"], sub["id"])
+                )
+                await manager_closure_add_link(db, man["id"], sub["id"])
+                await db.commit()
+    if err:
+        await m.answer(err); await state.clear(); return
+    mgr_mirror_invalidate()
 
     await state.clear()
     await m.answer(f"Связь установлена: {man['full_name']} → {sub['full_name']}")
@@ -5490,7 +6843,7 @@ async def cmd_taskinfo(m: Message):
         await m.answer("Использование: /taskinfo <task_id>")
         return
     tid = int(parts[1])
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute("""
             SELECT id, user_id, description, deadline, status, last_reminder_at, next_reminder_at, 
                    last_postpone_reason, started_at, planned_start_at, assigned_by_user_id
@@ -5510,18 +6863,70 @@ async def cmd_forcecheck(m: Message):
     await scheduler_job()
     await m.answer("Проверка напоминаний выполнена вручную.")
 
+@router.message(Command("sendstats"))
+async def cmd_sendstats(m: Message):
+    if not is_dev_tg(m.from_user.id):
+        await m.answer("Команда доступна только разработчику.")
+        return
+    snap = outbox.snapshot()
+    await m.answer("Очередь исходящих:\n" + "\n".join(f"{k}: {v}" for k, v in snap.items()))
+
+@router.message(Command("gsstats"))
+async def cmd_gsstats(m: Message):
+    if not is_dev_tg(m.from_user.id):
+        await m.answer("Команда доступна только разработчику.")
+        return
+    lines = ["Буферы записи Google Sheets:"]
+    for sid, buf in _sheets_buffers.items():
+        lines.append(f"{sid[:12]}…: " + ", ".join(f"{k}={v}" for k, v in buf.snapshot().items()))
+    lines.append("Реестр таблиц: " + ", ".join(f"{k}={v}" for k, v in gs_registry.snapshot().items()))
+    lines.append("Квоты API: " + ", ".join(f"{k}={v}" for k, v in gs_quota.snapshot().items()))
+    lines.append("Очередь Sheets: " + ", ".join(f"{k}={v}" for k, v in (await sheets_outbox_snapshot()).items()))
+    lines.append("Листы сотрудников: " + ", ".join(f"{k}={v}" for k, v in _emp_sync_stats.items()))
+    lines.append("Задания воркера: " + ", ".join(f"{k}={v}" for k, v in (await sheets_jobs_snapshot()).items()))
+    if not _sheets_buffers:
+        lines.insert(1, "пока не было записей")
+    await m.answer("\n".join(lines))
+
+@router.message(Command("dbstats"))
+async def cmd_dbstats(m: Message):
+    if not is_dev_tg(m.from_user.id):
+        await m.answer("Команда доступна только разработчику.")
+        return
+    snap = {**db_pool.snapshot(), "user_cache": user_cache_snapshot(), "per_update": update_query_snapshot()}
+    lines = ["Диагностика БД:"]
+    for k, v in snap.items():
+        if isinstance(v, dict):
+            lines.append(f"{k}: " + ", ".join(f"{kk}={vv}" for kk, vv in v.items()))
+        else:
+            lines.append(f"{k}: {v}")
+    await m.answer("\n".join(lines))
+
+@router.message(Command("kpibackfill"))
+async def cmd_kpibackfill(m: Message):
+    """/kpibackfill — пересобрать дневную свёртку KPI (kpi_daily) из истории задач."""
+    if not is_dev_tg(m.from_user.id):
+        await m.answer("Команда доступна только разработчику.")
+        return
+    async with db_write() as db:
+        n = await kpi_daily_backfill(db)
+        await db.commit()
+    async with db_read() as db:
+        same = await _compute_kpi(db) == await _compute_kpi_from_tasks(db)
+    await m.answer(f"kpi_daily пересобрана: {n} строк. Сверка с tasks: {'совпадает' if same else 'расходится'}.")
+
 # =========================
 # Утренний опрос (10:00) — «Нет задач сегодня»
 # =========================
 @router.callback_query(F.data.startswith("no_tasks_today:"))
-async def cb_no_tasks_today(cq: CallbackQuery):
+async def cb_no_tasks_today(cq: CallbackQuery, current_user: dict | None = None):
     parts = cq.data.split(":")
     if len(parts) != 2:
         await cq.answer(); return
     date_str = parts[1]
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         if not me:
             await cq.answer(); return
         mgrs = await get_manager_tg_ids(db, me["id"])
@@ -5531,11 +6936,7 @@ async def cb_no_tasks_today(cq: CallbackQuery):
 
     if mgrs:
         text = f"ℹ️ {me['full_name']} сообщил(а), что на {date_str} задач нет."
-        for mid in mgrs:
-            try:
-                await bot.send_message(mid, text)
-            except Exception as e:
-                logging.warning(f"notify manager failed (no_tasks_today) tg_id={mid}: {e}")
+        notify_many(mgrs, text, what="no_tasks_today")
 
 # === План дня: меню создания задач из пунктов плана ===
 
@@ -5543,10 +6944,10 @@ def _plan_item_btn_cb(item_id: int) -> str:
     return f"plan_item_to_task:{item_id}"
 
 @router.callback_query(F.data.startswith("plan_to_tasks_menu:"))
-async def cb_plan_to_tasks_menu(cq: CallbackQuery):
+async def cb_plan_to_tasks_menu(cq: CallbackQuery, current_user: dict | None = None):
     plan_date = cq.data.split(":")[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_read() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         cur = await db.execute("""
             SELECT id, text, time_str, task_id
             FROM daily_plan_items
@@ -5570,57 +6971,65 @@ async def cb_plan_to_tasks_menu(cq: CallbackQuery):
     await cq.answer()
 
 @router.callback_query(F.data.startswith("plan_item_to_task:"))
-async def cb_plan_item_to_task(cq: CallbackQuery):
+async def cb_plan_item_to_task(cq: CallbackQuery, current_user: dict | None = None):
     item_id = int(cq.data.split(":")[1])
     now_utc = datetime.now(UTC)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
-
+    me = current_user or await get_user_cached(cq.from_user.id)
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT plan_date, text, time_str, task_id FROM daily_plan_items WHERE id=? AND user_id=?",
             (item_id, me["id"])
         )
         row = await cur.fetchone()
-        if not row:
-            await cq.answer("Пункт не найден.", show_alert=True); return
-        plan_date, raw_text, hhmm, task_id = row
-        if task_id:
-            await cq.answer("Уже создано.", show_alert=True); return
+    if not row:
+        await cq.answer("Пункт не найден.", show_alert=True); return
+    plan_date, raw_text, hhmm, task_id = row
+    if task_id:
+        await cq.answer("Уже создано.", show_alert=True); return
 
-        # описание = текст без HH:MM
-        desc = raw_text.replace(hhmm, "").strip(" -–.,;")
+    # описание = текст без HH:MM
+    desc = raw_text.replace(hhmm, "").strip(" -–.,;")
 
-        # дедлайн: (plan_date + HH:MM локально) -> UTC
-        from datetime import datetime as dtmod
-        try:
-            dl_local = dtmod.strptime(f"{plan_date} {hhmm}", "%Y-%m-%d %H:%M").replace(tzinfo=LOCAL_TZ)
-        except ValueError:
-            await cq.answer("Некорректное время в пункте.", show_alert=True); return
-        dl_utc = dl_local.astimezone(UTC)
+    # дедлайн: (plan_date + HH:MM локально) -> UTC
+    from datetime import datetime as dtmod
+    try:
+        dl_local = dtmod.strptime(f"{plan_date} {hhmm}", "%Y-%m-%d %H:%M").replace(tzinfo=LOCAL_TZ)
+    except ValueError:
+        await cq.answer("Некорректное время в пункте.", show_alert=True); return
+    dl_utc = dl_local.astimezone(UTC)
 
-        # если уже прошло — подвинем в рабочее окно
-        if dl_utc <= now_utc:
-            dl_utc = clamp_to_work_hours(
-                now_utc.replace(hour=dl_local.hour, minute=dl_local.minute, second=0, microsecond=0)
-            )
+    # если уже прошло — подвинем в рабочее окно
+    if dl_utc <= now_utc:
+        dl_utc = clamp_to_work_hours(
+            now_utc.replace(hour=dl_local.hour, minute=dl_local.minute, second=0, microsecond=0)
+        )
 
-        next_rem = next_reminder_after(dl_utc.isoformat())
+    next_rem = next_reminder_after(dl_utc.isoformat())
 
-        # создаём задачу сразу в статусе «в работе»
-        cur2 = await db.execute("""
-            INSERT INTO tasks(user_id, description, deadline, status, next_reminder_at, started_at, updated_at, assigned_by_user_id)
-            VALUES(?,?,?,?,?,?,?,?)
-        """, (me["id"], desc, dl_utc.isoformat(), 'in_progress', next_rem, now_utc.isoformat(), now_utc.isoformat(), None))
-        await db.commit()
-        new_task_id = cur2.lastrowid
-        await log_task_event(db, new_task_id, "create", meta=f"from_plan={plan_date} {hhmm}; deadline={dl_utc.isoformat()}")
+    new_task_id = None
+    async with db_write() as db:
+        # двойное нажатие: пункт могли превратить в задачу, пока мы его читали
+        cur = await db.execute("SELECT task_id FROM daily_plan_items WHERE id=?", (item_id,))
+        row = await cur.fetchone()
+        if row and not row[0]:
+            # создаём задачу сразу в статусе «в работе»
+            cur2 = await db.execute("""
+                INSERT INTO tasks(user_id, description, deadline, status, next_reminder_at, started_at, updated_at, assigned_by_user_id)
+                VALUES(?,?,?,?,?,?,?,?)
+            """, (me["id"], desc, dl_utc.isoformat(), 'in_progress', next_rem, now_utc.isoformat(), now_utc.isoformat(), None))
+            await db.commit()
+            new_task_id = cur2.lastrowid
+            await log_task_event(db, new_task_id, "create", meta=f"from_plan={plan_date} {hhmm}; deadline={dl_utc.isoformat()}")
+            await reminders_refresh(db, new_task_id)
 
-        # связываем пункт плана с задачей
-        await db.execute("UPDATE daily_plan_items SET task_id=? WHERE id=?", (new_task_id, item_id))
-        await db.commit()
+            # связываем пункт плана с задачей
+            await db.execute("UPDATE daily_plan_items SET task_id=? WHERE id=?", (new_task_id, item_id))
+            await db.commit()
 
-        mgrs = await get_manager_tg_ids(db, me["id"])
+            mgrs = await get_manager_tg_ids(db, me["id"])
+    if new_task_id is None:
+        await cq.answer("Уже создано.", show_alert=True); return
 
     await cq.answer("Задача создана и запущена.")
     await cq.message.answer(
@@ -5629,20 +7038,16 @@ async def cb_plan_item_to_task(cq: CallbackQuery):
 
     if mgrs:
         note = f"🚀 {me['full_name']} начал(а) задачу #{new_task_id} из плана: {desc}\nДедлайн: {fmt_dt_local(dl_utc.isoformat())}"
-        for mid in mgrs:
-            try:
-                await bot.send_message(mid, note)
-            except Exception as e:
-                logging.warning(f"notify mgr (plan->task) failed: {e}")
+        notify_many(mgrs, note, what="plan->task")
 
 @router.callback_query(F.data.startswith("plan_all_to_tasks:"))
-async def cb_plan_all_to_tasks(cq: CallbackQuery):
+async def cb_plan_all_to_tasks(cq: CallbackQuery, current_user: dict | None = None):
     plan_date = cq.data.split(":")[1]
     now_utc = datetime.now(UTC)
     created = 0
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        me = await get_user_by_tg(db, cq.from_user.id)
+    async with db_write() as db:
+        me = current_user or await get_user_by_tg(db, cq.from_user.id)
         cur = await db.execute("""
             SELECT id, text, time_str, task_id
             FROM daily_plan_items
@@ -5650,6 +7055,7 @@ async def cb_plan_all_to_tasks(cq: CallbackQuery):
             ORDER BY time_str ASC, id ASC
         """, (me["id"], plan_date))
         items = await cur.fetchall()
+        events, links = [], []
 
         for iid, raw_text, hhmm, task_id in items:
             if task_id:
@@ -5671,14 +7077,18 @@ async def cb_plan_all_to_tasks(cq: CallbackQuery):
                 INSERT INTO tasks(user_id, description, deadline, status, next_reminder_at, started_at, updated_at, assigned_by_user_id)
                 VALUES(?,?,?,?,?,?,?,?)
             """, (me["id"], desc, dl_utc.isoformat(), 'in_progress', next_rem, now_utc.isoformat(), now_utc.isoformat(), None))
-            await db.commit()
             new_task_id = cur2.lastrowid
-            await log_task_event(db, new_task_id, "create", meta=f"from_plan={plan_date} {hhmm}; deadline={dl_utc.isoformat()}")
-
-            await db.execute("UPDATE daily_plan_items SET task_id=? WHERE id=?", (new_task_id, iid))
-            await db.commit()
+            events.append((new_task_id, "create", f"from_plan={plan_date} {hhmm}; deadline={dl_utc.isoformat()}"))
+            links.append((new_task_id, iid))
+            await reminders_refresh(db, new_task_id)
             created += 1
 
+        # весь план — одна транзакция: журнал и привязки пунктов пачкой
+        await log_task_events(db, events)
+        if links:
+            await db.executemany("UPDATE daily_plan_items SET task_id=? WHERE id=?", links)
+        await db.commit()
+
         mgrs = await get_manager_tg_ids(db, me["id"])
 
     await cq.answer(f"Создано задач: {created}")
@@ -5686,20 +7096,17 @@ async def cb_plan_all_to_tasks(cq: CallbackQuery):
         await cq.message.answer(f"📌 Создано задач из плана: {created}\nВсе поставлены в статус «в работе».")
         if mgrs:
             note = f"🚀 {me['full_name']} запустил(а) задачи из плана на {plan_date} (всего {created})."
-            for mid in mgrs:
-                try:
-                    await bot.send_message(mid, note)
-                except Exception as e:
-                    logging.warning(f"notify mgr (plan all->tasks) failed: {e}")
+            notify_many(mgrs, note, what="plan all->tasks")
 
 
 async def daily_morning_broadcast():
     now_local = datetime.now(LOCAL_TZ)
     today_local = now_local.date()
     midnight_local = datetime.combine(today_local, datetime.min.time(), tzinfo=LOCAL_TZ)
-    midnight_utc = midnight_local.astimezone(UTC).isoformat()
+    midnight_ts = int(midnight_local.timestamp())
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    outgoing = []
+    async with db_read() as db:
         cur = await db.execute("SELECT id, tg_id, full_name FROM users WHERE role='employee'")
         employees = await cur.fetchall()
 
@@ -5708,9 +7115,9 @@ async def daily_morning_broadcast():
             cur2 = await db.execute("""
                 SELECT id, description, deadline, status
                 FROM tasks
-                WHERE user_id=? AND status!='done' AND created_at < ?
-                ORDER BY COALESCE(deadline,'9999') ASC, id DESC
-            """, (uid, midnight_utc))
+                WHERE user_id=? AND status!='done' AND created_ts < ?
+                ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
+            """, (uid, midnight_ts))
             tasks = await cur2.fetchall()
 
             if tasks:
@@ -5741,25 +7148,30 @@ async def daily_morning_broadcast():
             kb.button(text="✅ План заполнен", callback_data=f"plan_done:{today_local.isoformat()}")
             kb.adjust(1)
 
-            resp = None
-            try:
-                resp = await bot.send_message(tg_id, text, reply_markup=kb.as_markup(), parse_mode="Markdown")
-            except Exception as e:
-                logging.warning(f"morning send failed to {tg_id}: {e}")
+            outgoing.append((uid, tg_id, text, kb.as_markup()))
 
-            if resp:
-                try:
-                    # запомним «утреннее сообщение» для реплаев
-                    await db.execute(
-                        "UPDATE users SET last_plan_msg_id=?, last_plan_date=? WHERE id=?",
-                        (resp.message_id, today_local.isoformat(), uid)
-                    )
-                    # почистим черновики плана на этот день (если вдруг есть)
-                    await db.execute("DELETE FROM daily_plan_items WHERE user_id=? AND plan_date=?",
-                                     (uid, today_local.isoformat()))
-                    await db.commit()
-                except Exception as e:
-                    logging.warning(f"morning meta store failed for {tg_id}: {e}")
+    async def _deliver(uid, tg_id, text, markup):
+        try:
+            resp = await send_queued(tg_id, text, reply_markup=markup, parse_mode="Markdown")
+        except Exception as e:
+            logging.warning(f"morning send failed to {tg_id}: {e}")
+            return
+        try:
+            async with db_write() as wdb:
+                # запомним «утреннее сообщение» для реплаев
+                await wdb.execute(
+                    "UPDATE users SET last_plan_msg_id=?, last_plan_date=? WHERE id=?",
+                    (resp.message_id, today_local.isoformat(), uid)
+                )
+                # почистим черновики плана на этот день (если вдруг есть)
+                await wdb.execute("DELETE FROM daily_plan_items WHERE user_id=? AND plan_date=?",
+                                  (uid, today_local.isoformat()))
+                await wdb.commit()
+        except Exception as e:
+            logging.warning(f"morning meta store failed for {tg_id}: {e}")
+
+    # все сообщения уходят через общую очередь параллельно, в пределах лимитов Telegram
+    await asyncio.gather(*(_deliver(*item) for item in outgoing))
 
 async def send_morning_plan_to_user(user_id: int) -> tuple[bool, str | None]:
     """
@@ -5769,10 +7181,10 @@ async def send_morning_plan_to_user(user_id: int) -> tuple[bool, str | None]:
     now_local = datetime.now(LOCAL_TZ)
     today_local = now_local.date()
     midnight_local = datetime.combine(today_local, datetime.min.time(), tzinfo=LOCAL_TZ)
-    midnight_utc = midnight_local.astimezone(UTC).isoformat()
+    midnight_ts = int(midnight_local.timestamp())
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             # берём пользователя
             cur = await db.execute("SELECT id, tg_id, full_name, role, is_active FROM users WHERE id=?", (user_id,))
             u = await cur.fetchone()
@@ -5788,9 +7200,9 @@ async def send_morning_plan_to_user(user_id: int) -> tuple[bool, str | None]:
             cur2 = await db.execute("""
                 SELECT id, description, deadline, status
                 FROM tasks
-                WHERE user_id=? AND status!='done' AND created_at < ?
-                ORDER BY COALESCE(deadline,'9999') ASC, id DESC
-            """, (uid, midnight_utc))
+                WHERE user_id=? AND status!='done' AND created_ts < ?
+                ORDER BY deadline_ts IS NULL, deadline_ts ASC, id DESC
+            """, (uid, midnight_ts))
             tasks = await cur2.fetchall()
 
             if tasks:
@@ -5822,23 +7234,24 @@ async def send_morning_plan_to_user(user_id: int) -> tuple[bool, str | None]:
 
             resp = None
             try:
-                resp = await bot.send_message(tg_id, text, reply_markup=kb.as_markup(), parse_mode="Markdown")
+                resp = await send_queued(tg_id, text, reply_markup=kb.as_markup(), parse_mode="Markdown")
             except Exception as e:
                 logging.warning(f"plan resend failed to {tg_id}: {e}")
                 return False, str(e)
 
             if resp:
                 try:
-                    # помечаем это сообщение как «утреннее» и сбрасываем черновики на сегодня
-                    await db.execute(
-                        "UPDATE users SET last_plan_msg_id=?, last_plan_date=? WHERE id=?",
-                        (resp.message_id, today_local.isoformat(), uid)
-                    )
-                    await db.execute(
-                        "DELETE FROM daily_plan_items WHERE user_id=? AND plan_date=?",
-                        (uid, today_local.isoformat())
-                    )
-                    await db.commit()
+                    async with db_write() as wdb:
+                        # помечаем это сообщение как «утреннее» и сбрасываем черновики на сегодня
+                        await wdb.execute(
+                            "UPDATE users SET last_plan_msg_id=?, last_plan_date=? WHERE id=?",
+                            (resp.message_id, today_local.isoformat(), uid)
+                        )
+                        await wdb.execute(
+                            "DELETE FROM daily_plan_items WHERE user_id=? AND plan_date=?",
+                            (uid, today_local.isoformat())
+                        )
+                        await wdb.commit()
                 except Exception as e:
                     logging.warning(f"plan resend meta store failed for {tg_id}: {e}")
                     return False, str(e)
@@ -5857,6 +7270,8 @@ import os
 import json
 import gspread_asyncio
 from google.oauth2.service_account import Credentials
+import gspread
+import requests
 from gspread.exceptions import WorksheetNotFound
 
 # --- Google Sheets: единый клиент и open ---
@@ -5884,125 +7299,398 @@ def _require_gs_config():
         raise RuntimeError("Конфигурация Google Sheets не задана:\n- " + "\n- ".join(errors))
     return gs_id, str(cred_path)
 
+# --- Квоты Sheets API: общий планировщик запросов для всех менеджеров клиента ---
+# Квота Google — 60 чтений и 60 записей в минуту на пользователя; оставляем запас.
+GS_READS_PER_MIN = max(1, int(os.getenv("GS_READS_PER_MIN", "55")))
+GS_WRITES_PER_MIN = max(1, int(os.getenv("GS_WRITES_PER_MIN", "55")))
+GS_MAX_RETRIES = max(0, int(os.getenv("GS_MAX_RETRIES", "6")))
+GS_BACKOFF_BASE_SEC = 1.0
+GS_BACKOFF_MAX_SEC = 64.0
+
+# "interactive" — запрос из обработчика апдейта (ставит AccessMiddleware), иначе фоновая синхронизация
+_gs_priority: ContextVar[str] = ContextVar("_gs_priority", default="background")
+
+_GS_READ_METHODS = {
+    "open_by_key", "open", "fetch_sheet_metadata", "worksheet", "worksheets", "get_worksheet",
+    "get_worksheet_by_id", "get", "get_values", "get_all_values", "get_all_records", "batch_get",
+    "values_get", "values_batch_get", "col_values", "row_values", "acell", "cell", "find", "findall",
+}
+
+class _PriorityTokenBucket:
+    """Токен-бакет, где ожидающие interactive-запросы обслуживаются раньше фоновых."""
+
+    def __init__(self, per_min: int):
+        self.rate = per_min / 60.0
+        self.capacity = float(per_min)
+        self.tokens = float(per_min)
+        self._ts = time.monotonic()
+        self._cond = asyncio.Condition()
+        self._queue: list[tuple[int, int, object]] = []
+        self._seq = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    async def acquire(self, interactive: bool) -> float:
+        """Взять токен; возвращает, сколько секунд пришлось ждать."""
+        t0 = time.monotonic()
+        self._seq += 1
+        entry = (0 if interactive else 1, self._seq, object())
+        async with self._cond:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    self._refill()
+                    head = self._queue[0] is entry
+                    if head and self.tokens >= 1:
+                        heapq.heappop(self._queue)
+                        self.tokens -= 1
+                        self._cond.notify_all()
+                        return time.monotonic() - t0
+                    timeout = (1 - self.tokens) / self.rate if head else None
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+                raise
+
+class GSQuota:
+    """Бюджеты чтений/записей, backoff с джиттером на 429/5xx и счётчики."""
+
+    def __init__(self):
+        self.buckets = {"read": _PriorityTokenBucket(GS_READS_PER_MIN), "write": _PriorityTokenBucket(GS_WRITES_PER_MIN)}
+        self.stats = {"read": 0, "write": 0, "interactive": 0, "throttled": 0, "throttle_wait_s": 0.0,
+                      "retried": 0, "rate_limited": 0, "gave_up": 0}
+
+    @staticmethod
+    def kind_of(method) -> str:
+        return "read" if getattr(method, "__name__", "") in _GS_READ_METHODS else "write"
+
+    async def before_call(self, method, kwargs):
+        kind = self.kind_of(method)
+        interactive = _gs_priority.get() == "interactive"
+        waited = await self.buckets[kind].acquire(interactive)
+        st = self.stats
+        st[kind] += 1
+        if interactive:
+            st["interactive"] += 1
+        if waited > 0.001:
+            st["throttled"] += 1
+            st["throttle_wait_s"] = round(st["throttle_wait_s"] + waited, 3)
+
+    async def backoff(self, e, method, n: int, retry_after: float | None = None):
+        """
+        Пауза перед n-м повтором (счёт ведёт сам вызов); после GS_MAX_RETRIES попыток пробрасываем ошибку.
+        """
+        if n > GS_MAX_RETRIES:
+            self.stats["gave_up"] += 1
+            raise e
+        self.stats["retried"] += 1
+        delay = min(GS_BACKOFF_MAX_SEC, GS_BACKOFF_BASE_SEC * 2 ** (n - 1)) * random.uniform(0.5, 1.0)
+        if retry_after:
+            delay = max(delay, retry_after)
+        logging.warning("Sheets %s failed (%s), retry %s/%s in %.1fs",
+                        getattr(method, "__name__", method), e, n, GS_MAX_RETRIES, delay)
+        await asyncio.sleep(delay)
+
+    def snapshot(self) -> dict:
+        out = dict(self.stats)
+        for kind, b in self.buckets.items():
+            b._refill()
+            out[f"{kind}_tokens"] = round(b.tokens, 1)
+            out[f"{kind}_queue"] = len(b._queue)
+        return out
+
+gs_quota = GSQuota()
+
+# счётчик попыток текущего вызова API: свой у каждого _call (повторы крутятся внутри него)
+_gs_call_attempts: ContextVar[list[int] | None] = ContextVar("_gs_call_attempts", default=None)
+
+class QuotaGspreadClientManager(gspread_asyncio.AsyncioGspreadClientManager):
+    """Менеджер gspread_asyncio, который ходит в API только через gs_quota."""
+
+    async def _call(self, method, *args, **kwargs):
+        # как у базового класса, но без self.call_lock: тот держится через HTTP-запрос и паузу backoff,
+        # и все вызовы шли строго по одному. Темп задают бакеты gs_quota
+        kwargs.pop("api_call_count", None)
+        token = _gs_call_attempts.set([0])
+        try:
+            while True:
+                try:
+                    await self.before_gspread_call(method, args, kwargs)
+                    return await asyncio.to_thread(method, *args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    code = e.response.status_code
+                    # 4xx (кроме 429) — ошибка вызывающего, повторять бессмысленно
+                    if 400 <= code <= 499 and code != 429:
+                        raise
+                    await self.handle_gspread_error(e, method, args, kwargs)
+                except requests.RequestException as e:
+                    await self.handle_requests_error(e, method, args, kwargs)
+        finally:
+            _gs_call_attempts.reset(token)
+
+    @staticmethod
+    def _next_attempt() -> int:
+        box = _gs_call_attempts.get()
+        if box is None:
+            return 1
+        box[0] += 1
+        return box[0]
+
+    async def before_gspread_call(self, method, args, kwargs):
+        await gs_quota.before_call(method, kwargs)
+
+    async def handle_gspread_error(self, e, method, args, kwargs):
+        retry_after = None
+        resp = getattr(e, "response", None)
+        if resp is not None and resp.status_code == 429:
+            gs_quota.stats["rate_limited"] += 1
+            try:
+                retry_after = float(resp.headers.get("Retry-After") or 0) or None
+            except (TypeError, ValueError):
+                retry_after = None
+        await gs_quota.backoff(e, method, self._next_attempt(), retry_after)
+
+    async def handle_requests_error(self, e, method, args, kwargs):
+        await gs_quota.backoff(e, method, self._next_attempt())
+
 def _agcm_builder(abs_credentials_path: str):
     from google.oauth2.service_account import Credentials
     def _creds():
         return Credentials.from_service_account_file(abs_credentials_path, scopes=_GS_SCOPES)
-    return gspread_asyncio.AsyncioGspreadClientManager(_creds)
+    return QuotaGspreadClientManager(_creds, gspread_delay=0)
 
-async def _gs_ensure_ws(sh, title: str, rows: int = 100, cols: int = 20):
-    """Гарантированно получить лист по имени; создать при отсутствии."""
-    from gspread.exceptions import WorksheetNotFound
-    try:
-        return await sh.worksheet(title)
-    except WorksheetNotFound:
-        return await sh.add_worksheet(title=title, rows=rows, cols=cols)
-
-# кэш клиента
+# кешируем менеджер на процесс, чтобы не создавать заново каждый раз
 _agcm_cache = {"path": None, "mgr": None}
 
-async def _gs_open():
+GS_HANDLE_TTL_SEC = max(60, int(os.getenv("GS_HANDLE_TTL_SEC", "1800")))
+
+class GSRegistry:
     """
-    Возвращает Spreadsheet. Всегда проверяем конфиг и резолвим путь к JSON.
+    Кэш открытых таблиц: объект Spreadsheet, карта title → sheetId и размеры сетки.
+    Метаданные берутся одним fetch_sheet_metadata и живут GS_HANDLE_TTL_SEC;
+    add_worksheet дополняет карту сам, переименование/удаление — через invalidate().
+    В установившемся режиме open/ensure_ws не делают ни одного запроса к API.
     """
-    gs_id, cred_abs = _require_gs_config()
-    if _agcm_cache["mgr"] is None or _agcm_cache["path"] != cred_abs:
-        _agcm_cache["mgr"] = _agcm_builder(cred_abs)
-        _agcm_cache["path"] = cred_abs
-    agc = await _agcm_cache["mgr"].authorize()
-    sh = await agc.open_by_key(gs_id)
-    return sh
 
-# кешируем менеджер на процесс, чтобы не создавать заново каждый раз
-_agcm_cache = {"path": None, "mgr": None}
+    def __init__(self):
+        self._entries: dict[str, dict] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self.stats = {"opens": 0, "meta_fetches": 0, "hits": 0, "ws_lookups": 0, "ws_created": 0}
+
+    async def open(self, gs_id: str, mgr) -> "gspread_asyncio.AsyncioGspreadSpreadsheet":
+        e = self._entries.get(gs_id)
+        if e is not None and time.monotonic() - e["at"] < GS_HANDLE_TTL_SEC:
+            self.stats["hits"] += 1
+            return e["sh"]
+        lock = self._locks.setdefault(gs_id, asyncio.Lock())
+        async with lock:
+            e = self._entries.get(gs_id)
+            if e is not None and time.monotonic() - e["at"] < GS_HANDLE_TTL_SEC:
+                self.stats["hits"] += 1
+                return e["sh"]
+            agc = await mgr.authorize()
+            sh = await agc.open_by_key(gs_id)
+            self.stats["opens"] += 1
+            e = self._entries[gs_id] = {"sh": sh, "at": time.monotonic(), "titles": None, "grid": {}}
+            await self._refresh(e)
+            return sh
+
+    async def _refresh(self, e: dict):
+        """Одна выборка метаданных: заголовки, sheetId, размеры; заодно прогреваем кэш листов gspread_asyncio."""
+        sh = e["sh"]
+        meta = await sh.fetch_sheet_metadata(
+            params={"fields": "sheets.properties(sheetId,title,index,gridProperties(rowCount,columnCount))"}
+        )
+        self.stats["meta_fetches"] += 1
+        titles, grid = {}, {}
+        for sheet in meta.get("sheets", []):
+            props = sheet.get("properties", {})
+            titles[props.get("title")] = props.get("sheetId")
+            gp = props.get("gridProperties", {})
+            grid[props.get("sheetId")] = (gp.get("rowCount", 0), gp.get("columnCount", 0))
+            try:
+                # лист из уже полученных свойств — без отдельного sh.worksheet(title)
+                sh._wrap_ws(gspread.Worksheet(sh.ss, props, sh.ss.id, sh.ss.client))
+            except Exception:
+                pass
+        e.update(titles=titles, grid=grid)
+
+    def _entry_of(self, sh) -> dict:
+        e = self._entries.get(sh.id)
+        if e is None or e["sh"] is not sh:
+            # таблица открыта в обход реестра — заведём запись под неё
+            e = self._entries[sh.id] = {"sh": sh, "at": time.monotonic(), "titles": None, "grid": {}}
+        return e
+
+    async def titles(self, sh) -> dict[str, int]:
+        e = self._entry_of(sh)
+        if e["titles"] is None:
+            await self._refresh(e)
+        return e["titles"]
+
+    def cached_titles(self, gs_id: str) -> set[str]:
+        """Известные имена листов без обращения к API (пусто, если таблица ещё не открывалась)."""
+        e = self._entries.get(gs_id)
+        return set(e["titles"] or ()) if e else set()
+
+    def grid(self, sh, sheet_id: int) -> tuple[int, int] | None:
+        return self._entry_of(sh)["grid"].get(sheet_id)
+
+    async def ensure_ws(self, sh, title: str, rows: int = 100, cols: int = 20):
+        """Лист по имени (создать при отсутствии). Известный лист — из кэша, без запросов."""
+        e = self._entry_of(sh)
+        known = await self.titles(sh)
+        if title in known:
+            self.stats["ws_lookups"] += 1
+            return await sh.worksheet(title)  # кэш gspread_asyncio; запрос только если лист не прогрет
+        try:
+            ws = await sh.add_worksheet(title=title, rows=rows, cols=cols)
+        except Exception as err:
+            # лист появился мимо нас (гонка, ручное создание/переименование) — перечитаем метаданные
+            await self._refresh(e)
+            if title not in e["titles"]:
+                raise err
+            return await sh.worksheet(title)
+        self.stats["ws_created"] += 1
+        e["titles"][title] = ws.id
+        e["grid"][ws.id] = (rows, cols)
+        return ws
+
+    def note_grid(self, sh, sheet_id: int, rows: int, cols: int):
+        self._entry_of(sh)["grid"][sheet_id] = (rows, cols)
+
+    def invalidate(self, gs_id: str | None = None):
+        """Сбросить кэш таблицы (или всех) — после переименования/удаления листов или ошибок доступа."""
+        if gs_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(gs_id, None)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "spreadsheets": len(self._entries)}
+
+gs_registry = GSRegistry()
 
 async def _gs_ensure_ws(sh, title: str, rows: int = 100, cols: int = 20):
     """
     Гарантированно получить worksheet с именем `title`. Создать если нет.
     """
-    try:
-        ws = await sh.worksheet(title)
-        return ws
-    except Exception:
-        pass
-    # создаём
-    try:
-        ws = await sh.add_worksheet(title=title, rows=rows, cols=cols)
-        return ws
-    except Exception as e:
-        # возможно, только что создали/гонка — пробуем ещё раз получить
-        try:
-            return await sh.worksheet(title)
-        except Exception:
-            raise e
+    return await gs_registry.ensure_ws(sh, title, rows=rows, cols=cols)
+
+async def _gs_open():
+    """
+    Возвращает Spreadsheet (из реестра). Всегда проверяем конфиг и резолвим путь к JSON.
+    """
+    gs_id, cred_abs = _require_gs_config()
+    if _agcm_cache["mgr"] is None or _agcm_cache["path"] != cred_abs:
+        _agcm_cache["mgr"] = _agcm_builder(cred_abs)
+        _agcm_cache["path"] = cred_abs
+        gs_registry.invalidate(gs_id)
+    return await gs_registry.open(gs_id, _agcm_cache["mgr"])
 
 async def _ws_clear_and_set_header(ws, header: list[str]):
     await ws.clear()
     if header:
         await ws.update('A1', [header], value_input_option="USER_ENTERED")
 
-def _overdue_minutes(deadline_iso: str | None, completed_at_iso: str | None) -> int | None:
+def _overdue_minutes(deadline_ts: int | None, completed_ts: int | None, now_ts: int) -> int | None:
     """
-    Просрочка в минутах: если задача завершена — по completed_at, иначе по now().
+    Просрочка в минутах по колонкам *_ts: если задача завершена — по completed_ts, иначе по now_ts.
     Если дедлайна нет — None.
     """
-    if not deadline_iso:
-        return None
-    try:
-        dl = dateparser.parse(deadline_iso)
-        end = dateparser.parse(completed_at_iso) if completed_at_iso else datetime.now(UTC)
-        diff = int((end - dl).total_seconds() // 60)
-        return max(0, diff)
-    except Exception:
+    if deadline_ts is None:
         return None
+    end = completed_ts if completed_ts is not None else now_ts
+    return max(0, (end - deadline_ts) // 60)
 
-async def _fetch_gantt_rows(db) -> list[list]:
+async def sync_state_get(db, key: str, default: str | None = None) -> str | None:
+    cur = await db.execute("SELECT value FROM sync_state WHERE key=?", (key,))
+    row = await cur.fetchone()
+    return row[0] if row else default
+
+async def sync_state_set(db, key: str, value: str | None):
+    await db.execute(
+        "INSERT INTO sync_state(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value),
+    )
+
+async def _fetch_gantt_items(db, where: str = "", params: tuple | dict = ()) -> list[tuple[int, int, list]]:
     """
-    Подготовить строки для Gantt и персональных листов.
+    (task_id, gantt_rev, строка) для Gantt и персональных листов.
     Колонки: Сотр. | Задача | Дедлайн | Факт | Просрочка (мин) | Статус | Комментарий | Проект | Создана | Сдвиги
+    where — необязательный фильтр по t.* (инкрементальная синхронизация).
     """
-    # count postpones per task
-    postpone_counts = {}
-    curp = await db.execute("""
-        SELECT task_id, COUNT(*) 
-        FROM task_events 
-        WHERE event='postpone'
-        GROUP BY task_id
-    """)
-    for tid, cnt in await curp.fetchall():
-        postpone_counts[int(tid)] = int(cnt or 0)
-
-    cur = await db.execute("""
-        SELECT t.id, u.full_name, u.tg_id, t.description, t.deadline, t.completed_at,
-               t.status, t.last_postpone_reason, t.created_at
+    cur = await db.execute(f"""
+        SELECT t.id, t.gantt_rev, u.full_name, u.tg_id, t.description, t.deadline_ts, t.completed_ts,
+               t.status, t.last_postpone_reason, t.created_ts
         FROM tasks t
         JOIN users u ON u.id = t.user_id
-        ORDER BY COALESCE(t.deadline, '9999'), t.id
-    """)
+        {("WHERE " + where) if where else ""}
+        ORDER BY t.deadline_ts IS NULL, t.deadline_ts, t.id
+    """, params)
     rows = await cur.fetchall()
+    if not rows:
+        return []
+
+    # count postpones per task
+    postpone_counts = {}
+    ids = [r[0] for r in rows] if where else []
+    if not where:
+        curp = await db.execute("""
+            SELECT task_id, COUNT(*)
+            FROM task_events
+            WHERE event='postpone'
+            GROUP BY task_id
+        """)
+        for tid, cnt in await curp.fetchall():
+            postpone_counts[int(tid)] = int(cnt or 0)
+    for k in range(0, len(ids), 500):
+        chunk = ids[k:k + 500]
+        curp = await db.execute(f"""
+            SELECT task_id, COUNT(*)
+            FROM task_events
+            WHERE event='postpone' AND task_id IN ({",".join("?" * len(chunk))})
+            GROUP BY task_id
+        """, chunk)
+        for tid, cnt in await curp.fetchall():
+            postpone_counts[int(tid)] = int(cnt or 0)
 
     out = []
-    for (tid, full_name, tg_id, desc, deadline, completed_at, status, last_reason, created_at) in rows:
-        overdue = _overdue_minutes(deadline, completed_at)
+    now_ts = int(time.time())
+    for (tid, rev, full_name, tg_id, desc, deadline_ts, completed_ts, status, last_reason, created_ts) in rows:
+        overdue = _overdue_minutes(deadline_ts, completed_ts, now_ts)
         # "Проект" — у вас пока не связано; оставим пустым
         project = ""
         # Комментарий — последняя причина переноса (если была)
         comment = last_reason or ""
         employee = full_name or f"user_{tg_id}"
-        out.append([
+        out.append((tid, rev or 0, [
             employee,
             f"#{tid} {desc or ''}",
-            fmt_dt_local(deadline) if deadline else "",
-            fmt_dt_local(completed_at) if completed_at else "",
+            fmt_ts_local(deadline_ts) if deadline_ts is not None else "",
+            fmt_ts_local(completed_ts) if completed_ts is not None else "",
             overdue if overdue is not None else "",
             status_human(status or "new"),
             comment,
             project,
-            fmt_dt_local(created_at) if created_at else "",
+            fmt_ts_local(created_ts) if created_ts is not None else "",
             postpone_counts.get(int(tid), 0),
-        ])
+        ]))
     return out
 
+async def _fetch_gantt_rows(db) -> list[list]:
+    """Все строки Ганта (без id) — для полной пересборки и персональных листов."""
+    return [row for _, _, row in await _fetch_gantt_items(db)]
+
 async def _write_ws_table(ws, header: list[str], rows: list[list]):
     await _ws_clear_and_set_header(ws, header)
     if rows:
@@ -6010,6 +7698,61 @@ async def _write_ws_table(ws, header: list[str], rows: list[list]):
         rng = f"A2"
         await ws.update(rng, rows, value_input_option="USER_ENTERED")
 
+def _payload_digest(*parts) -> str:
+    """Хэш содержимого, которое уходит в лист: одинаковый payload — одинаковый хэш."""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+async def gs_payload_hashes(gs_id: str, prefix: str = "") -> dict[str, str]:
+    """Последние успешно записанные хэши диапазонов таблицы: target -> digest."""
+    head = f"payload_hash:{gs_id}:"
+    async with db_read() as db:
+        cur = await db.execute("SELECT key, value FROM sync_state WHERE key LIKE ?", (f"{head}{prefix}%",))
+        return {k[len(head):]: v for k, v in await cur.fetchall()}
+
+async def gs_payload_mark(gs_id: str, target: str, digest: str):
+    """Запомнить хэш после успешной записи диапазона target."""
+    async with db_write() as db:
+        await sync_state_set(db, f"payload_hash:{gs_id}:{target}", digest)
+        await db.commit()
+
+def _gs_sheet_missing(gs_id: str, title: str) -> bool:
+    """Лист точно удалён (реестр знает листы таблицы, а этого среди них нет). Без запросов к API."""
+    known = gs_registry.cached_titles(gs_id)
+    return bool(known) and title not in known
+
+class _GSLazy:
+    """
+    Таблица, которая открывается только при первой реальной записи:
+    прогон синхронизации, где всё совпало по хэшам, не делает ни одного запроса к API.
+    """
+
+    def __init__(self, gs_id: str, opener):
+        self.id = gs_id
+        self._opener = opener
+        self._sh = None
+
+    async def get(self):
+        if self._sh is None:
+            self._sh = await self._opener()
+        return self._sh
+
+# Наши правила условного форматирования для колонки B: (формула EN, формула RU, цвет фона)
+_TASK_CF_RULES = [
+    ("=$E2=0", "=$E2=0", {"red": 0.85, "green": 0.97, "blue": 0.85}),
+    ("=AND($E2>0,$E2<=120)", "=И($E2>0;$E2<=120)", {"red": 1.0, "green": 0.97, "blue": 0.80}),
+    ("=$E2>120", "=$E2>120", {"red": 1.0, "green": 0.80, "blue": 0.80}),
+]
+# вариант формул, который принял лист ("en" | "ru"): память процесса + sync_state, чтобы не ловить ошибку каждый раз
+_gs_cf_locale: dict[str, str] = {}
+
+def _cf_color_key(color: dict | None) -> tuple:
+    c = color or {}
+    return tuple(round(float(c.get(k, 0.0)), 2) for k in ("red", "green", "blue"))
+
+def _cf_is_invalid_formula(e: Exception) -> bool:
+    return "INVALID_ARGUMENT" in str(e) or "Invalid ConditionValue.userEnteredValue" in str(e)
+
 async def _apply_task_cf(sh, ws):
     """
     Условное форматирование колонки B (Задача) по значениям колонки E (Просрочка, мин).
@@ -6017,63 +7760,72 @@ async def _apply_task_cf(sh, ws):
       1 <= E <=120 -> жёлтый
       E > 120      -> красный
 
-    Функция автоматически подбирает формат формул под локаль листа:
-    1) сначала пробует EN-формы (AND, запятые),
-    2) при ошибке INVALID_ARGUMENT — пробует RU-формы (И, точки с запятой).
+    Правила сверяются с тем, что уже висит на листе (одно чтение метаданных):
+    недостающие добавляются, дубли и правила другого варианта локали удаляются.
+    Если всё на месте — ни одного запроса на запись.
+
+    Формат формул под локаль листа: EN (AND, запятые) или RU (И, точки с запятой).
+    Принятый вариант кэшируется; пробуем другой только если закэшированный отвергнут.
     """
     sheet_id = ws.id
-
     rng_B = {
         "sheetId": sheet_id,
         "startRowIndex": 1,    # со 2-й строки
         "startColumnIndex": 1, # B (0-based)
         "endColumnIndex": 2    # только колонка B
     }
-
-    def _rules(en: bool):
-        # Формулы с ведущим '=' — это обязательно для CUSTOM_FORMULA
-        if en:
-            f_green  = "=$E2=0"
-            f_yellow = "=AND($E2>0,$E2<=120)"
-            f_red    = "=$E2>120"
-        else:
-            # RU локаль: локализованное имя функции и ';' как разделитель
-            f_green  = "=$E2=0"
-            f_yellow = "=И($E2>0;$E2<=120)"
-            f_red    = "=$E2>120"
-
-        return [
-            {
-                "addConditionalFormatRule": {
-                    "index": 0,
-                    "rule": {
-                        "ranges": [rng_B],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "CUSTOM_FORMULA",
-                                "values": [{"userEnteredValue": f_green}]
-                            },
-                            "format": {"backgroundColor": {"red": 0.85, "green": 0.97, "blue": 0.85}}
-                        }
-                    }
-                }
-            },
-            {
-                "addConditionalFormatRule": {
-                    "index": 0,
-                    "rule": {
-                        "ranges": [rng_B],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "CUSTOM_FORMULA",
-                                "values": [{"userEnteredValue": f_yellow}]
-                            },
-                            "format": {"backgroundColor": {"red": 1.0, "green": 0.97, "blue": 0.80}}
-                        }
-                    }
-                }
-            },
-            {
+    ours = {f for en, ru, _ in _TASK_CF_RULES for f in (en, ru)}
+
+    meta = await sh.fetch_sheet_metadata(params={"fields": "sheets(properties(sheetId),conditionalFormats)"})
+    existing = []
+    for sheet in meta.get("sheets", []):
+        if sheet.get("properties", {}).get("sheetId") == sheet_id:
+            existing = sheet.get("conditionalFormats", []) or []
+            break
+
+    # (индекс, формула, цвет) только наших правил — чужие не трогаем
+    mine = []
+    for idx, rule in enumerate(existing):
+        br = rule.get("booleanRule") or {}
+        cond = br.get("condition") or {}
+        vals = cond.get("values") or []
+        formula = vals[0].get("userEnteredValue") if vals else None
+        ranges = rule.get("ranges") or []
+        on_b = any(r.get("startColumnIndex") == 1 and r.get("endColumnIndex") == 2 for r in ranges)
+        if cond.get("type") == "CUSTOM_FORMULA" and formula in ours and on_b:
+            mine.append((idx, formula, _cf_color_key((br.get("format") or {}).get("backgroundColor"))))
+
+    cache_key = f"{sh.id}:{sheet_id}"
+    locale = _gs_cf_locale.get(cache_key)
+    if locale is None:
+        async with db_read() as db:
+            locale = await sync_state_get(db, f"gs_cf_locale:{cache_key}")
+    if locale is None:
+        # по уже висящим правилам видно, какой вариант лист принял
+        ru_only = {ru for en, ru, _ in _TASK_CF_RULES if ru != en}
+        en_only = {en for en, ru, _ in _TASK_CF_RULES if ru != en}
+        if any(f in ru_only for _, f, _ in mine):
+            locale = "ru"
+        elif any(f in en_only for _, f, _ in mine):
+            locale = "en"
+
+    def _plan(loc: str) -> list[dict]:
+        wanted = {((en if loc == "en" else ru), _cf_color_key(color)): color for en, ru, color in _TASK_CF_RULES}
+        keep, drop = set(), []
+        for idx, formula, color in mine:
+            k = (formula, color)
+            if k in wanted and k not in keep:
+                keep.add(k)
+            else:
+                drop.append(idx)
+        reqs = [
+            {"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": idx}}
+            for idx in sorted(drop, reverse=True)
+        ]
+        for (formula, ck), color in wanted.items():
+            if (formula, ck) in keep:
+                continue
+            reqs.append({
                 "addConditionalFormatRule": {
                     "index": 0,
                     "rule": {
@@ -6081,26 +7833,35 @@ async def _apply_task_cf(sh, ws):
                         "booleanRule": {
                             "condition": {
                                 "type": "CUSTOM_FORMULA",
-                                "values": [{"userEnteredValue": f_red}]
+                                "values": [{"userEnteredValue": formula}]
                             },
-                            "format": {"backgroundColor": {"red": 1.0, "green": 0.80, "blue": 0.80}}
+                            "format": {"backgroundColor": color}
                         }
                     }
                 }
-            },
-        ]
-
-    # Попытка 1: EN (AND, запятые)
-    try:
-        await sh.batch_update({"requests": _rules(en=True)})
+            })
+        return reqs
+
+    order = [locale] if locale else []
+    order += [loc for loc in ("en", "ru") if loc not in order]
+    last_err = None
+    for loc in order:
+        reqs = _plan(loc)
+        try:
+            if reqs:
+                await sh.batch_update({"requests": reqs})
+        except Exception as e:
+            # если ошибка не про неверную формулу — пробрасываем дальше
+            if not _cf_is_invalid_formula(e):
+                raise
+            last_err = e
+            continue
+        if _gs_cf_locale.get(cache_key) != loc:
+            _gs_cf_locale[cache_key] = loc
+            async with db_write() as db:
+                await sync_state_set(db, f"gs_cf_locale:{cache_key}", loc)
         return
-    except Exception as e1:
-        # если ошибка не про неверную формулу — пробрасываем дальше
-        if "INVALID_ARGUMENT" not in str(e1) and "Invalid ConditionValue.userEnteredValue" not in str(e1):
-            raise
-
-    # Попытка 2: RU (И, точки с запятой)
-    await sh.batch_update({"requests": _rules(en=False)})
+    raise last_err
 
 async def _sync_gantt_and_personal(sh, db):
     header = ["Сотр.", "Задача", "Дедлайн", "Факт", "Просрочка (мин)", "Статус", "Комментарий", "Проект", "Создана", "Сдвиги"]
@@ -6121,102 +7882,251 @@ async def _sync_gantt_and_personal(sh, db):
         ws = await _gs_ensure_ws(sh, emp[:100], rows=max(50, len(rows)+5), cols=len(header)+2)
         await _write_ws_table(ws, header, rows)
 
+KPI_STREAK_MAX_DAYS = 60
+
+async def kpi_daily_apply(db, user_id: int, completed_ts: int, delay_minutes: int | None, sign: int = 1):
+    """Добавить (sign=1) или убрать (sign=-1) одну завершённую задачу из kpi_daily. Звать в секции db_write()."""
+    day = int(completed_ts) // 86400
+    d = max(0, int(delay_minutes or 0))
+    cur = await db.execute("SELECT delay_hist FROM kpi_daily WHERE user_id=? AND day=?", (user_id, day))
+    row = await cur.fetchone()
+    hist = json.loads(row[0]) if row and row[0] else {}
+    if d > 0:
+        n = hist.get(str(d), 0) + sign
+        if n > 0:
+            hist[str(d)] = n
+        else:
+            hist.pop(str(d), None)
+    late = sign if d > 0 else 0
+    await db.execute("""
+        INSERT INTO kpi_daily(user_id, day, done, late, delay_sum, delay_hist) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            done = done + excluded.done,
+            late = late + excluded.late,
+            delay_sum = delay_sum + excluded.delay_sum,
+            delay_hist = excluded.delay_hist
+    """, (user_id, day, sign, late, sign * d, json.dumps(hist)))
+    await db.execute("DELETE FROM kpi_daily WHERE user_id=? AND day=? AND done<=0", (user_id, day))
+
+async def kpi_daily_backfill(db) -> int:
+    """Пересобрать kpi_daily из истории tasks. Возвращает число строк свёртки."""
+    await db.execute("DELETE FROM kpi_daily")
+    await db.execute(_KPI_DAILY_FILL_SQL)
+    cur = await db.execute("SELECT COUNT(*) FROM kpi_daily")
+    return (await cur.fetchone())[0]
+
+def _hist_median(hist: dict[int, int]):
+    """Медиана по гистограмме {значение: кол-во} — как statistics.median по развёрнутому списку."""
+    total = sum(hist.values())
+    if not total:
+        return 0
+    lo_i, hi_i = (total - 1) // 2, total // 2
+    lo = hi = None
+    seen = 0
+    for v in sorted(hist):
+        seen += hist[v]
+        if lo is None and seen > lo_i:
+            lo = v
+        if seen > hi_i:
+            hi = v
+            break
+    return lo if lo == hi else (lo + hi) / 2
+
+# Серии «дней без просрочек» по свёртке: дни с завершёнными задачами от последнего назад, пока нет просрочек.
+_KPI_STREAK_SQL = f"""
+SELECT user_id, COUNT(*)
+FROM (
+    SELECT user_id, late,
+           ROW_NUMBER() OVER d AS rn,
+           SUM(late > 0) OVER d AS late_seen
+    FROM kpi_daily
+    WHERE done > 0 AND user_id IN (SELECT DISTINCT user_id FROM kpi_daily WHERE day >= :month_day)
+    WINDOW d AS (PARTITION BY user_id ORDER BY day DESC ROWS UNBOUNDED PRECEDING)
+)
+WHERE late_seen = 0 AND rn <= {KPI_STREAK_MAX_DAYS}
+GROUP BY user_id
+"""
+
+def _kpi_windows(now: datetime | None = None) -> dict:
+    """Начала окон «неделя» и «месяц», выровненные на сутки UTC — как дни в kpi_daily."""
+    now = now or datetime.now(UTC)
+    week_day = int((now - timedelta(days=7)).timestamp()) // 86400
+    month_day = int((now - timedelta(days=30)).timestamp()) // 86400
+    return {
+        "week_day": week_day, "month_day": month_day,
+        "week_ago": week_day * 86400, "month_ago": month_day * 86400,
+    }
+
+def _kpi_row(emp: str, period: str, total: int, late: int, med, streak: int) -> list:
+    med = med or 0
+    if float(med).is_integer():
+        med = int(med)
+    ontime = total - late
+    pct = round(ontime / total * 100, 1) if total else 100.0
+    return [emp, period, ontime, late, med, pct, streak]
+
 async def _compute_kpi(db) -> list[list]:
     """
-    KPI-таблица: по сотруднику за неделю и за месяц.
+    KPI-таблица: по сотруднику (user_id) за неделю и за месяц — по дневной свёртке kpi_daily
+    (несколько сотен строк вместо истории tasks).
     Столбцы: Сотр. | Период | В срок | Просрочено | Медиана просрочки (мин) | % on-time | Streak (дней без просрочек)
+    Streak — подряд идущие дни с завершёнными задачами, начиная с последнего, пока нет просрочек.
     """
-    now = datetime.now(UTC)
-    week_ago = (now - timedelta(days=7)).isoformat()
-    month_ago = (now - timedelta(days=30)).isoformat()
-
-    # заберём завершённые с delay_minutes
+    win = _kpi_windows()
     cur = await db.execute("""
-        SELECT u.full_name, u.tg_id, t.completed_at, COALESCE(t.delay_minutes, 0)
-        FROM tasks t
-        JOIN users u ON u.id = t.user_id
-        WHERE t.status='done' AND t.completed_at IS NOT NULL
-    """)
-    rows = await cur.fetchall()
-
-    from statistics import median
-
-    # аккумуляторы
-    data = {}  # (emp, period) -> list[delay_minutes]
-    for full, tg, completed_at, delay in rows:
-        emp = (full or f"user_{tg}")
-        delay = int(delay or 0)
-        # месяц
-        if completed_at >= month_ago:
-            data.setdefault((emp, "месяц"), []).append(delay)
-        # неделя
-        if completed_at >= week_ago:
-            data.setdefault((emp, "неделя"), []).append(delay)
-
-    # streak «дней без просрочек»: считаем по последним дням, пока нет задач с delay>0
-    # упрощённо: считаем подряд от вчера назад по датам completed_at
-    streak_cache = {}
-    for emp_period in list(data.keys()):
-        emp = emp_period[0]
-        if emp in streak_cache:
-            continue
-        cur2 = await db.execute("""
-            SELECT DATE(t.completed_at), MAX(CASE WHEN COALESCE(t.delay_minutes,0)>0 THEN 1 ELSE 0 END)
-            FROM tasks t
-            JOIN users u ON u.id = t.user_id
-            WHERE u.full_name=? OR u.full_name IS NULL
-            GROUP BY DATE(t.completed_at)
-            ORDER BY DATE(t.completed_at) DESC
-            LIMIT 60
-        """, (emp,))
-        days = await cur2.fetchall()
-        s = 0
-        # считаем от сегодняшней даты назад: если сегодня нет записей — streak не сбиваем
-        for d, has_late in days:
-            if int(has_late or 0) == 0:
-                s += 1
-            else:
-                break
-        streak_cache[emp] = s
+        SELECT k.user_id, COALESCE(u.full_name, 'user_' || u.tg_id), k.day, k.done, k.late, k.delay_hist
+        FROM kpi_daily k
+        JOIN users u ON u.id = k.user_id
+        WHERE k.day >= :month_day
+    """, win)
+    acc = {}  # (user_id, period) -> [emp, done, late, {delay: n}]
+    for uid, emp, day, done, late, hist in await cur.fetchall():
+        hist = {int(k): v for k, v in json.loads(hist or "{}").items()}
+        for period, since in (("месяц", win["month_day"]), ("неделя", win["week_day"])):
+            if day < since:
+                continue
+            a = acc.setdefault((uid, period), [emp, 0, 0, {}])
+            a[1] += done
+            a[2] += late
+            for d, n in hist.items():
+                a[3][d] = a[3].get(d, 0) + n
+    if not acc:
+        return []
+    cur = await db.execute(_KPI_STREAK_SQL, win)
+    streaks = dict(await cur.fetchall())
 
     out = []
-    for (emp, period), delays in sorted(data.items()):
-        total = len(delays)
-        late = sum(1 for x in delays if x > 0)
-        ontime = total - late
-        med = (median([x for x in delays if x > 0]) if late else 0)
-        pct = round(ontime / total * 100, 1) if total else 100.0
-        out.append([
-            emp, period, ontime, late, med, pct, streak_cache.get(emp, 0)
-        ])
+    for (uid, period), (emp, done, late, hist) in sorted(acc.items(), key=lambda kv: (kv[1][0], kv[0][1], kv[0][0])):
+        if done <= 0:
+            continue
+        out.append(_kpi_row(emp, period, done, late, _hist_median(hist), streaks.get(uid, 0)))
     return out
 
-async def _sync_kpi(sh, db):
+# Один проход по сырым tasks (без свёртки): окна неделя/месяц, медиана просрочки через ROW_NUMBER,
+# серия «дней без просрочек» через накопительную сумму по дням. Сверка свёртки — bench.py kpi.
+_KPI_SQL = f"""
+WITH periods(period, since) AS (VALUES ('месяц', :month_ago), ('неделя', :week_ago)),
+win AS (
+    SELECT t.user_id, p.period, COALESCE(t.delay_minutes, 0) AS delay
+    FROM tasks t
+    JOIN periods p ON t.completed_ts >= p.since
+    WHERE t.status = 'done' AND t.completed_ts >= :month_ago
+),
+ranked AS (
+    SELECT user_id, period, delay,
+           ROW_NUMBER() OVER (PARTITION BY user_id, period, delay > 0 ORDER BY delay) AS rn,
+           COUNT(*) OVER (PARTITION BY user_id, period, delay > 0) AS cnt
+    FROM win
+),
+agg AS (
+    SELECT user_id, period,
+           COUNT(*) AS total,
+           SUM(delay > 0) AS late,
+           AVG(CASE WHEN delay > 0 AND rn IN ((cnt + 1) / 2, (cnt + 2) / 2) THEN delay END) AS med
+    FROM ranked
+    GROUP BY user_id, period
+),
+days AS (
+    SELECT user_id, completed_ts / 86400 AS day, MAX(COALESCE(delay_minutes, 0) > 0) AS has_late
+    FROM tasks
+    WHERE status = 'done' AND completed_ts IS NOT NULL
+      AND user_id IN (SELECT user_id FROM agg)
+    GROUP BY user_id, day
+),
+streak AS (
+    SELECT user_id, COUNT(*) AS streak
+    FROM (
+        SELECT user_id,
+               ROW_NUMBER() OVER d AS rn,
+               SUM(has_late) OVER d AS late_seen
+        FROM days
+        WINDOW d AS (PARTITION BY user_id ORDER BY day DESC ROWS UNBOUNDED PRECEDING)
+    )
+    WHERE late_seen = 0 AND rn <= {KPI_STREAK_MAX_DAYS}
+    GROUP BY user_id
+)
+SELECT COALESCE(u.full_name, 'user_' || u.tg_id) AS emp, a.period,
+       a.total, a.late, a.med, COALESCE(s.streak, 0)
+FROM agg a
+JOIN users u ON u.id = a.user_id
+LEFT JOIN streak s ON s.user_id = a.user_id
+ORDER BY emp, a.period, a.user_id
+"""
+
+async def _compute_kpi_from_tasks(db) -> list[list]:
+    cur = await db.execute(_KPI_SQL, _kpi_windows())
+    return [_kpi_row(*r) for r in await cur.fetchall()]
+
+async def _sync_kpi(gs: _GSLazy, full: bool = False) -> bool:
+    """Лист "KPI": переписываем, только если таблица отличается от последней записанной. True, если писали."""
     header = ["Сотр.", "Период", "В срок", "Просрочено", "Медиана просрочки (мин)", "% on-time", "Streak (дней без просрочек)"]
-    rows = await _compute_kpi(db)
+    async with db_read() as db:
+        rows = await _compute_kpi(db)
+    digest = _payload_digest(header, rows)
+    if not full and not _gs_sheet_missing(gs.id, "KPI") and (await gs_payload_hashes(gs.id, "kpi")).get("kpi") == digest:
+        return False
+    sh = await gs.get()
     ws = await _gs_ensure_ws(sh, "KPI", rows=max(50, len(rows)+5), cols=len(header)+2)
     await _write_ws_table(ws, header, rows)
+    await gs_payload_mark(gs.id, "kpi", digest)
+    return True
+
+GANTT_HEADER = ["Сотр.", "Задача", "Дедлайн", "Факт", "Просрочка (мин)"]
+
+# "Gantt" — только текущее: открытые задачи + сданные за последние GANTT_CURRENT_DAYS дней.
+# Сданные раскладываются по листам периодов "Gantt 2026-Q4" / "Gantt 2026-10" (по дате сдачи).
+# Каждый прогон переписывается только активный период (и прошлый — GANTT_PERIOD_GRACE_DAYS после его конца,
+# чтобы не потерять сданное перед границей); закрытые периоды заморожены, их трогает только /gsync.
+GANTT_PARTITION = "month" if os.getenv("GANTT_PARTITION", "quarter").strip().lower() == "month" else "quarter"
+GANTT_CURRENT_DAYS = max(1, int(os.getenv("GANTT_CURRENT_DAYS", "14")))
+GANTT_PERIOD_GRACE_DAYS = max(0, int(os.getenv("GANTT_PERIOD_GRACE_DAYS", "2")))
+# как часто дописывать «Просрочка (мин)» открытым просроченным, у которых больше ничего не менялось:
+# значение растёт каждую минуту, и без паузы каждый прогон синхронизации писал бы в лист
+GANTT_OVERDUE_REFRESH_MIN = max(1, int(os.getenv("GANTT_OVERDUE_REFRESH_MIN", "60")))
+# условие «задача на текущем листе» (параметр :cutoff — граница GANTT_CURRENT_DAYS)
+_GANTT_CURRENT_WHERE = "(t.status != 'done' OR t.completed_ts >= :cutoff)"
+# ключ периода сданной задачи; у закрытых без completed_at (увольнение) — дедлайн/создание.
+# Задача совсем без дат ни в один период не попадает.
+_GANTT_PERIOD_KEY = "COALESCE(t.completed_ts, t.deadline_ts, t.created_ts)"
+# отметка в sync_state для закрытого периода без задач: лист не заводим, но и не перечитываем каждый прогон
+_GANTT_PERIOD_EMPTY = "empty"
+
+def _gantt_current_cutoff(now_ts: int | None = None) -> int:
+    now_ts = int(datetime.now(UTC).timestamp()) if now_ts is None else now_ts
+    return now_ts - GANTT_CURRENT_DAYS * 86400
+
+def _gantt_period(ts: int) -> tuple[str, int, int]:
+    """Период (по локальному времени), в который попадает ts: (метка, начало, конец) — границы в unix-секундах."""
+    d = datetime.fromtimestamp(int(ts), LOCAL_TZ)
+    if GANTT_PARTITION == "month":
+        y, m, step = d.year, d.month, 1
+        label = f"{y}-{m:02d}"
+    else:
+        y, m, step = d.year, (d.month - 1) // 3 * 3 + 1, 3
+        label = f"{y}-Q{(m - 1) // 3 + 1}"
+    start = datetime(y, m, 1, tzinfo=LOCAL_TZ)
+    ny, nm = (y + 1, m + step - 12) if m + step > 12 else (y, m + step)
+    end = datetime(ny, nm, 1, tzinfo=LOCAL_TZ)
+    return label, int(start.timestamp()), int(end.timestamp())
+
+def _gantt_period_title(label: str) -> str:
+    return f"Gantt {label}"
 
-async def gs_sync_all():
+async def _sync_gantt_full(sh) -> int:
     """
-    Полная синхронизация:
-      1) Общий лист "Gantt"
-      2) KPI
-      3) Персональные листы по сотрудникам на текущий месяц
+    Полная пересборка текущего листа "Gantt": очистка, запись строк текущего среза и новой карты task_id → строка.
+    Заодно ужимает сетку, если лист раздут с тех времён, когда в нём лежала вся история.
     """
-    _require_gs_config()
-    sh = await _gs_open()
-
-    # 1) Общий Gantt
-    GANTT_HEADER = ["Сотр.", "Задача", "Дедлайн", "Факт", "Просрочка (мин)"]
-    async with aiosqlite.connect(DB_PATH) as db:
-        rows = await _fetch_gantt_rows(db)  # у тебя уже есть эта функция
-
-    ws_gantt = await _gs_ensure_ws(
-        sh, "Gantt",
-        rows=max(2000, (len(rows) + 10) if rows else 2000),
-        cols=len(GANTT_HEADER) + 2
-    )
+    now_ts = int(datetime.now(UTC).timestamp())
+    async with db_read() as db:
+        items = await _fetch_gantt_items(db, _GANTT_CURRENT_WHERE, {"cutoff": _gantt_current_cutoff(now_ts)})
+    rows = [row for _, _, row in items]
+
+    need_rows = len(rows) + 200
+    ws_gantt = await _gs_ensure_ws(sh, "Gantt", rows=need_rows, cols=len(GANTT_HEADER) + 5)
+    if ws_gantt.row_count > need_rows * 2:
+        await ws_gantt.resize(rows=need_rows)
+        gs_registry.note_grid(sh, ws_gantt.id, ws_gantt.row_count, ws_gantt.col_count)
     await _ws_clear_and_set_header(ws_gantt, GANTT_HEADER)
     if rows:
         await ws_gantt.update("A2", rows, value_input_option="USER_ENTERED")
@@ -6228,12 +8138,201 @@ async def gs_sync_all():
         except Exception as _e:
             logging.warning("CF for Gantt skipped: %s", _e)
 
-    # 2) KPI
-    async with aiosqlite.connect(DB_PATH) as db:
-        await _sync_kpi(sh, db)
+    wm = max((rev for _, rev, _ in items), default=0)
+    async with db_write() as db:
+        await db.execute("DELETE FROM gantt_rows")
+        await db.executemany(
+            "INSERT INTO gantt_rows(task_id, row_index, row_hash) VALUES(?, ?, ?)",
+            [(tid, i + 2, _payload_digest(row)) for i, (tid, _, row) in enumerate(items)],
+        )
+        await sync_state_set(db, "gantt_wm", str(wm))
+        await sync_state_set(db, "gantt_overdue_ts", str(now_ts))
+        await sync_state_set(db, "gantt_compact_day", datetime.now(LOCAL_TZ).date().isoformat())
+        await db.commit()
+    return len(rows)
 
-    # 3) Персональные листы за текущий месяц
-    await _sync_emp_gantts(sh)
+async def _sync_gantt_incremental(gs: _GSLazy) -> int | None:
+    """
+    Дописать в "Gantt" только изменившиеся строки одним values.batchUpdate.
+    Кандидаты = ревизия gantt_rev выше водяного знака + открытые просроченные
+    (у них «Просрочка (мин)» растёт сама — их освежаем не чаще GANTT_OVERDUE_REFRESH_MIN);
+    из них пишем только строки, чей хэш отличается от записанного.
+    None — карта строк невалидна, нужна полная пересборка.
+    Сданные раньше GANTT_CURRENT_DAYS уходят с листа при пересборке, но не чаще раза в сутки:
+    до неё их строки просто остаются на месте.
+    """
+    from gspread.utils import rowcol_to_a1
+    now_ts = int(datetime.now(UTC).timestamp())
+    async with db_read() as db:
+        wm = await sync_state_get(db, "gantt_wm")
+        if wm is None:
+            return None
+        # задачи удаляли (сбросы) — строки в листе «повисли», инкрементально не поправить
+        cur = await db.execute("""
+            SELECT 1 FROM gantt_rows g LEFT JOIN tasks t ON t.id = g.task_id WHERE t.id IS NULL LIMIT 1
+        """)
+        if await cur.fetchone():
+            return None
+        cutoff = _gantt_current_cutoff(now_ts)
+        # на листе есть выбывшие из текущего среза — раз в сутки пересобираем (лист маленький)
+        if await sync_state_get(db, "gantt_compact_day") != datetime.now(LOCAL_TZ).date().isoformat():
+            cur = await db.execute("""
+                SELECT 1 FROM gantt_rows g JOIN tasks t ON t.id = g.task_id
+                WHERE t.status = 'done' AND (t.completed_ts IS NULL OR t.completed_ts < ?) LIMIT 1
+            """, (cutoff,))
+            if await cur.fetchone():
+                return None
+        overdue_ts = int(await sync_state_get(db, "gantt_overdue_ts") or 0)
+        refresh_overdue = now_ts - overdue_ts >= GANTT_OVERDUE_REFRESH_MIN * 60
+        candidates = "SELECT id FROM tasks WHERE gantt_rev > :wm"
+        if refresh_overdue:
+            candidates += " UNION SELECT id FROM tasks WHERE status != 'done' AND +deadline_ts < :now"
+        items = await _fetch_gantt_items(
+            db,
+            f"t.id IN ({candidates}) AND {_GANTT_CURRENT_WHERE}",
+            {"wm": int(wm), "now": now_ts, "cutoff": cutoff},
+        )
+        if not items:
+            return 0
+        cur = await db.execute("SELECT COALESCE(MAX(row_index), 1) FROM gantt_rows")
+        last_row = (await cur.fetchone())[0]
+        mapping = {}
+        ids = [tid for tid, _, _ in items]
+        for k in range(0, len(ids), 500):
+            chunk = ids[k:k + 500]
+            cur = await db.execute(
+                f"SELECT task_id, row_index, row_hash FROM gantt_rows WHERE task_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            mapping.update({tid: (r, h) for tid, r, h in await cur.fetchall()})
+
+    new_wm = max(int(wm), max(rev for _, rev, _ in items))
+    links = []
+    data = []
+    for tid, _, row in items:
+        r, old_hash = mapping.get(tid, (None, None))
+        digest = _payload_digest(row)
+        if digest == old_hash:
+            continue
+        if r is None:
+            last_row += 1
+            r = last_row
+        links.append((tid, r, digest))
+        data.append({"range": f"'Gantt'!A{r}:{rowcol_to_a1(r, len(row))}", "values": [row]})
+
+    if not data:
+        # всё совпало с записанным — API не трогаем, только сдвигаем водяной знак
+        if new_wm != int(wm) or refresh_overdue:
+            async with db_write() as db:
+                await sync_state_set(db, "gantt_wm", str(new_wm))
+                if refresh_overdue:
+                    await sync_state_set(db, "gantt_overdue_ts", str(now_ts))
+                await db.commit()
+        return 0
+
+    sh = await gs.get()
+    ws_gantt = await _gs_ensure_ws(sh, "Gantt", rows=last_row + 200, cols=len(GANTT_HEADER) + 5)
+    if last_row > ws_gantt.row_count:
+        await ws_gantt.add_rows(last_row - ws_gantt.row_count + 100)
+        gs_registry.note_grid(sh, ws_gantt.id, ws_gantt.row_count, ws_gantt.col_count)
+    await sh.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+
+    async with db_write() as db:
+        await db.executemany("INSERT OR REPLACE INTO gantt_rows(task_id, row_index, row_hash) VALUES(?, ?, ?)", links)
+        await sync_state_set(db, "gantt_wm", str(new_wm))
+        if refresh_overdue:
+            await sync_state_set(db, "gantt_overdue_ts", str(now_ts))
+        await db.commit()
+    return len(data)
+
+async def _sync_gantt_partitions(gs: _GSLazy, full: bool = False) -> int:
+    """
+    Листы периодов "Gantt <период>" со сданными задачами. Пишется лист целиком, если его payload
+    поменялся, — но только для активного периода (и прошлого в пределах GANTT_PERIOD_GRACE_DAYS).
+    Закрытый период пишется один раз (его ещё нет в sync_state) и дальше заморожен — пустой тоже,
+    отметкой _GANTT_PERIOD_EMPTY; full=True переписывает все. Возвращает число записанных листов.
+    """
+    now_ts = int(datetime.now(UTC).timestamp())
+    async with db_read() as db:
+        # MIN() пропускает NULL — обход начинается с самой ранней настоящей даты
+        cur = await db.execute(f"SELECT MIN({_GANTT_PERIOD_KEY}) FROM tasks t WHERE t.status = 'done'")
+        first_ts = (await cur.fetchone())[0]
+    if first_ts is None:
+        return 0
+    written_hashes = await gs_payload_hashes(gs.id, "gantt:")
+
+    periods = []
+    ts = int(first_ts)
+    while ts <= now_ts:
+        label, start, end = _gantt_period(ts)
+        periods.append((label, start, end))
+        ts = end
+    written = 0
+    for label, start, end in periods:
+        target = f"gantt:{label}"
+        title = _gantt_period_title(label)
+        active = end + GANTT_PERIOD_GRACE_DAYS * 86400 > now_ts
+        stored = written_hashes.get(target)
+        if not full and not active and stored is not None and (
+                stored == _GANTT_PERIOD_EMPTY or not _gs_sheet_missing(gs.id, title)):
+            continue  # закрытый период заморожен
+        async with db_read() as db:
+            items = await _fetch_gantt_items(
+                db,
+                f"t.status = 'done' AND {_GANTT_PERIOD_KEY} >= :start AND {_GANTT_PERIOD_KEY} < :end",
+                {"start": start, "end": end},
+            )
+        if not items and stored in (None, _GANTT_PERIOD_EMPTY):
+            # пустой период — лист не заводим; закрытый запоминаем, чтобы больше не перечитывать
+            if not active and stored is None:
+                await gs_payload_mark(gs.id, target, _GANTT_PERIOD_EMPTY)
+            continue
+        rows = [row for _, _, row in items]
+        digest = _payload_digest(GANTT_HEADER, rows)
+        if not full and written_hashes.get(target) == digest and not _gs_sheet_missing(gs.id, title):
+            continue
+        sh = await gs.get()
+        ws = await _gs_ensure_ws(sh, title, rows=len(rows) + 20, cols=len(GANTT_HEADER) + 5)
+        await _write_ws_table(ws, GANTT_HEADER, rows)
+        if stored in (None, _GANTT_PERIOD_EMPTY):
+            try:
+                await _apply_task_cf(sh, ws)
+            except Exception as _e:
+                logging.warning("CF for %s skipped: %s", title, _e)
+        await gs_payload_mark(gs.id, target, digest)
+        written += 1
+    return written
+
+async def gs_sync_all(full: bool = False):
+    """
+    Синхронизация:
+      1) Текущий лист "Gantt" — инкрементально по водяному знаку; full=True (/gsync) — полная пересборка
+      2) Листы периодов "Gantt <период>" — только активный; full=True — все
+      3) KPI
+      4) Персональные листы по сотрудникам на текущий месяц
+    """
+    gs_id, _ = _require_gs_config()
+    # откроем таблицу только если что-то действительно поменялось (хэши payload в sync_state)
+    gs = _GSLazy(gs_id, _gs_open)
+
+    # 1) Общий Gantt
+    written = None if full else await _sync_gantt_incremental(gs)
+    if written is None:
+        written = await _sync_gantt_full(await gs.get())
+        logging.info("Gantt full rebuild: %s rows", written)
+    else:
+        logging.info("Gantt incremental: %s rows", written)
+
+    # 2) Периоды
+    parts = await _sync_gantt_partitions(gs, full=full)
+    if parts:
+        logging.info("Gantt periods written: %s", parts)
+
+    # 3) KPI
+    await _sync_kpi(gs, full=full)
+
+    # 4) Персональные листы за текущий месяц
+    await _sync_emp_gantts(gs, full=full)
 
 # ===== Персональные листы Gantt по сотрудникам =====
 
@@ -6252,32 +8351,9 @@ def _emp_ws_title(full_name: str) -> str:
     t = (full_name or "Employee").strip()
     return t[:80]
 
-async def _ensure_emp_month_ws(sh, full_name: str, year: int, month: int):
-    """Создать (если нет) и подготовить лист сотрудника на текущий месяц."""
-    title = _emp_ws_title(full_name)
-    ws = await _gs_ensure_ws(sh, title, rows=200, cols=40)
-
-    # шапка: строки 1-2
-    header = _month_days_header(year, month)
-    await ws.clear()
-    await ws.update("A1", [["Имя сотрудника", full_name]])
-    await ws.update("A2", [header], value_input_option="USER_ENTERED")
-
-    # заморозим верхние 2 строки и первый столбец
-    await sh.batch_update({
-        "requests": [
-            {
-                "updateSheetProperties": {
-                    "properties": {
-                        "sheetId": ws.id,
-                        "gridProperties": {"frozenRowCount": 2, "frozenColumnCount": 1},
-                    },
-                    "fields": "gridProperties.frozenRowCount,gridProperties.frozenColumnCount",
-                }
-            }
-        ]
-    })
-    return ws
+GS_EMP_SYNC_CONCURRENCY = max(1, int(os.getenv("GS_EMP_SYNC_CONCURRENCY", "4")))
+_EMP_CELL_FIELDS = "userEnteredValue,note,userEnteredFormat(backgroundColor,horizontalAlignment,verticalAlignment)"
+_emp_sync_stats = {"synced": 0, "skipped": 0, "failed": 0}
 
 def _rgb(r: int, g: int, b: int) -> dict:
     return {"red": r/255.0, "green": g/255.0, "blue": b/255.0}
@@ -6290,57 +8366,37 @@ LIGHT  = _rgb(238, 238, 238)
 BLUE = {"red": 0.80, "green": 0.90, "blue": 1.00}
 
 
-async def _fill_emp_month(sh, ws, rows_for_emp: list[dict], year: int, month: int):
+def _emp_month_requests(sheet_id: int, full_name: str, rows_for_emp: list[dict], year: int, month: int,
+                        grid: tuple[int, int] | None) -> list[dict]:
     """
-    rows_for_emp: список словарей с полями:
-      task_id, project, description, deadline_iso, completed_at_iso, overdue_min
-    Рисуем таблицу: строки — уникальные project/description, столбцы — дни месяца.
-    Цвет ячейки по просрочке; в заметке — детали с временем завершения.
+    Весь лист сотрудника одним набором запросов для batchUpdate:
+      заморозка (и расширение сетки при нехватке) → очистка значений/заметок/заливки → одна updateCells
+      с шапкой (строки 1-2), списком задач в колонке A и цветом+заметкой в ячейках дней.
+    rows_for_emp: task_id, project, description, deadline_iso, completed_at_iso, overdue_min.
+    Строки — уникальные project/description, столбцы — дни месяца; цвет по просрочке, в заметке — детали.
     """
     from calendar import monthrange
     days = monthrange(year, month)[1]
 
     # Собираем уникальные "проекты/задачи" в порядке появления
-    lines: list[str] = []
+    lines: dict[str, int] = {}
     def _key(r):
         p = (r.get("project") or "").strip()
         d = (r.get("description") or "").strip()
         return p or d or f"Задача #{r.get('task_id')}"
-    for r in rows_for_emp:
-        k = _key(r)
-        if k not in lines:
-            lines.append(k)
-    if not lines:
-        return  # нет строк — оставляем только шапку
-
-    # Запишем левый столбец со списком задач (начиная с A3)
-    table = [[name] + [""] * days for name in lines]
-    await ws.update("A3", table, value_input_option="USER_ENTERED")
-
-    # Индексы для быстрого доступа
-    line_index = {name: i for i, name in enumerate(lines)}  # строка (0..)
-    start_row = 2  # zero-based (строка 3)
-    start_col = 1  # zero-based (колонка B)
-
-    requests = []
-    notes = []
 
+    cells: dict[tuple[int, int], dict] = {}  # (строка задачи, день) -> ячейка; последняя задача дня перекрывает
     for r in rows_for_emp:
-        k = _key(r)
-        i = line_index[k]
+        i = lines.setdefault(_key(r), len(lines))
         dt_src = r.get("completed_at_iso") or r.get("deadline_iso")
         if not dt_src:
             continue
         try:
-            dt = dateparser.parse(dt_src)
+            dt = _parse_iso(dt_src)
         except Exception:
             continue
         if dt.year != year or dt.month != month:
             continue
-        d = dt.day  # 1..days
-
-        row_index = start_row + i
-        col_index = start_col + (d - 1)
 
         overdue = r.get("overdue_min")
         color = GREEN
@@ -6350,53 +8406,46 @@ async def _fill_emp_month(sh, ws, rows_for_emp: list[dict], year: int, month: in
             color = RED
         elif overdue > 0:
             color = YELLOW
+        cells[(i, dt.day)] = {
+            "userEnteredFormat": {
+                "backgroundColor": color,
+                "horizontalAlignment": "CENTER",
+                "verticalAlignment": "MIDDLE",
+            },
+            "note": (
+                f"#{r.get('task_id')} — {r.get('description') or r.get('project')}\n"
+                f"Дедлайн: {fmt_dt_local(r.get('deadline_iso'))}\n"
+                f"Факт:    {fmt_dt_local(r.get('completed_at_iso'))}\n"
+                f"Просрочка: {overdue if overdue is not None else '—'} мин"
+            ),
+        }
 
-        # Красим одну ячейку
-        requests.append({
-            "repeatCell": {
-                "range": {
-                    "sheetId": ws.id,
-                    "startRowIndex": row_index,
-                    "endRowIndex": row_index + 1,
-                    "startColumnIndex": col_index,
-                    "endColumnIndex": col_index + 1,
-                },
-                "cell": {
-                    "userEnteredFormat": {
-                        "backgroundColor": color,
-                        "horizontalAlignment": "CENTER",
-                        "verticalAlignment": "MIDDLE",
-                    }
-                },
-                "fields": "userEnteredFormat(backgroundColor,horizontalAlignment,verticalAlignment)"
-            }
-        })
-
-        # Заметка с деталями
-        note = (
-            f"#{r.get('task_id')} — {r.get('description') or r.get('project')}\n"
-            f"Дедлайн: {fmt_dt_local(r.get('deadline_iso'))}\n"
-            f"Факт:    {fmt_dt_local(r.get('completed_at_iso'))}\n"
-            f"Просрочка: {overdue if overdue is not None else '—'} мин"
-        )
-        notes.append({
-            "updateCells": {
-                "range": {
-                    "sheetId": ws.id,
-                    "startRowIndex": row_index,
-                    "endRowIndex": row_index + 1,
-                    "startColumnIndex": col_index,
-                    "endColumnIndex": col_index + 1,
-                },
-                "rows": [{"values": [{"note": note}]}],
-                "fields": "note"
-            }
-        })
-
-    if requests:
-        await sh.batch_update({"requests": requests})
-    if notes:
-        await sh.batch_update({"requests": notes})
+    # значения — как текст: USER_ENTERED превращал «1.10» в число 1.1, а «=…» в описании — в формулу
+    grid_rows = [
+        {"values": [{"userEnteredValue": _cell_value(v)} for v in ("Имя сотрудника", full_name)]},
+        {"values": [{"userEnteredValue": _cell_value(v)} for v in _month_days_header(year, month)]},
+    ]
+    for name, i in lines.items():
+        grid_rows.append({"values": [{"userEnteredValue": _cell_value(name)}]
+                          + [cells.get((i, d), {}) for d in range(1, days + 1)]})
+
+    gp = {"frozenRowCount": 2, "frozenColumnCount": 1}
+    fields = ["gridProperties.frozenRowCount", "gridProperties.frozenColumnCount"]
+    have_rows, have_cols = grid or (0, 0)
+    if have_rows < len(grid_rows):
+        gp["rowCount"] = len(grid_rows) + 20
+        fields.append("gridProperties.rowCount")
+    if have_cols < days + 1:
+        gp["columnCount"] = days + 1
+        fields.append("gridProperties.columnCount")
+    return [
+        {"updateSheetProperties": {"properties": {"sheetId": sheet_id, "gridProperties": gp},
+                                   "fields": ",".join(fields)}},
+        # range только с sheetId = весь лист; без rows — очистка перечисленных полей
+        {"updateCells": {"range": {"sheetId": sheet_id}, "fields": _EMP_CELL_FIELDS}},
+        {"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                         "rows": grid_rows, "fields": _EMP_CELL_FIELDS}},
+    ]
 
 async def _collect_emp_rows_for_month(year: int, month: int) -> dict[str, list[dict]]:
     """
@@ -6413,23 +8462,25 @@ async def _collect_emp_rows_for_month(year: int, month: int) -> dict[str, list[d
                u.full_name,
                t.description,
                t.deadline,
-               t.completed_at
+               t.completed_at,
+               t.deadline_ts,
+               t.completed_ts
         FROM tasks t
         JOIN users u ON u.id = t.user_id
-        WHERE t.completed_at IS NOT NULL
-          AND t.completed_at >= ?
-          AND t.completed_at <  ?
-        ORDER BY u.full_name, t.completed_at
+        WHERE t.completed_ts >= ?
+          AND t.completed_ts <  ?
+        ORDER BY u.full_name, t.completed_ts
     """
 
     out: dict[str, list[dict]] = {}
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(q, (start.isoformat(), end.isoformat()))
+    async with db_read() as db:
+        cur = await db.execute(q, (int(start.timestamp()), int(end.timestamp())))
         rows = await cur.fetchall()
 
-    # rows: (task_id, full_name, description, deadline_iso, completed_at_iso)
-    for (task_id, full, descr, deadline_iso, completed_at_iso) in rows:
-        overdue = _overdue_minutes(deadline_iso, completed_at_iso)
+    # rows: (task_id, full_name, description, deadline_iso, completed_at_iso, deadline_ts, completed_ts)
+    now_ts = int(time.time())
+    for (task_id, full, descr, deadline_iso, completed_at_iso, deadline_ts, completed_ts) in rows:
+        overdue = _overdue_minutes(deadline_ts, completed_ts, now_ts)
         emp = (full or "Employee").strip() or "Employee"
 
         out.setdefault(emp, []).append({
@@ -6444,30 +8495,80 @@ async def _collect_emp_rows_for_month(year: int, month: int) -> dict[str, list[d
 
     return out
 
-async def _sync_emp_gantts(sh):
-    """Построить/обновить персональные листы за текущий месяц по всем сотрудникам."""
+async def _sync_emp_month(gs: _GSLazy, full_name: str, rows: list[dict], year: int, month: int,
+                          stored: dict[str, str], full: bool) -> bool:
+    """Лист одного сотрудника: пропуск по хэшу данных месяца, иначе — один batchUpdate. True, если писали."""
+    title = _emp_ws_title(full_name)
+    target = f"emp:{title}"
+    digest = _payload_digest(full_name, year, month, rows)
+    if not full and stored.get(target) == digest and not _gs_sheet_missing(gs.id, title):
+        _emp_sync_stats["skipped"] += 1
+        return False
+
+    sh = await gs.get()
+    ws = await _gs_ensure_ws(sh, title, rows=200, cols=40)
+    grid = gs_registry.grid(sh, ws.id)
+    reqs = _emp_month_requests(ws.id, full_name, rows, year, month, grid)
+    await sh.batch_update({"requests": reqs})
+    gp = reqs[0]["updateSheetProperties"]["properties"]["gridProperties"]
+    if "rowCount" in gp or "columnCount" in gp:
+        gs_registry.note_grid(sh, ws.id, max(gp.get("rowCount", 0), (grid or (0, 0))[0]),
+                              max(gp.get("columnCount", 0), (grid or (0, 0))[1]))
+
+    await gs_payload_mark(gs.id, target, digest)
+    _emp_sync_stats["synced"] += 1
+    return True
+
+async def _sync_emp_gantts(gs: _GSLazy, full: bool = False):
+    """
+    Построить/обновить персональные листы за текущий месяц по всем сотрудникам:
+    до GS_EMP_SYNC_CONCURRENCY листов параллельно, по одному batchUpdate на лист;
+    сотрудники с неизменившимися данными месяца пропускаются (full=True — пишем всех).
+    """
     now = datetime.now(UTC).astimezone(LOCAL_TZ)
     year, month = now.year, now.month
     emp_rows = await _collect_emp_rows_for_month(year, month)
-    for full_name, rows in emp_rows.items():
-        ws = await _ensure_emp_month_ws(sh, full_name, year, month)
-        await _fill_emp_month(sh, ws, rows, year, month)
+    stored = await gs_payload_hashes(gs.id, "emp:")
+
+    sem = asyncio.Semaphore(GS_EMP_SYNC_CONCURRENCY)
+
+    async def _one(full_name: str, rows: list[dict]):
+        async with sem:
+            try:
+                await _sync_emp_month(gs, full_name, rows, year, month, stored, full)
+            except Exception as e:
+                _emp_sync_stats["failed"] += 1
+                logging.warning(f"emp month sheet {full_name!r} failed: {e}")
+
+    await asyncio.gather(*(_one(n, r) for n, r in emp_rows.items()))
 
 # =========================
 # Планировщик напоминаний
 # =========================
-async def fetch_due_tasks(db):
-    now_iso = datetime.now(UTC).isoformat()
-    # ВАЖНО: только по next_reminder_at, без OR deadline<=now — иначе спам каждую минуту при просрочке
-    q = """
+# Пора напомнить = max(deadline, next_reminder) <= now, т.е. deadline <= now И (next IS NULL ИЛИ next <= now).
+# OR через NULL SQLite индексом не обслуживает, поэтому две ветки UNION ALL — каждая берёт
+# idx_tasks_open_due (status != 'done' совпадает с условием частичного индекса буквально).
+DUE_SCAN_SQL = """
+    SELECT id FROM tasks
+     WHERE status != 'done' AND next_reminder_ts IS NULL AND deadline_ts <= :now
+    UNION ALL
+    SELECT id FROM tasks
+     WHERE status != 'done' AND next_reminder_ts <= :now AND deadline_ts <= :now
+"""
+
+async def fetch_due_tasks(db, now_ts: int | None = None) -> list[dict]:
+    if now_ts is None:
+        now_ts = int(datetime.now(UTC).timestamp())
+    # ВАЖНО: дедлайн обязателен — без него напоминаний нет (как и в reminders_loop)
+    q = f"""
     SELECT t.id, t.user_id, t.description, t.deadline, t.status, t.started_at,
            t.next_reminder_at, u.tg_id
     FROM tasks t
     JOIN users u ON u.id = t.user_id
-    WHERE t.status != 'done'
-      AND (t.next_reminder_at IS NULL OR t.next_reminder_at <= ?)
+    WHERE t.id IN ({DUE_SCAN_SQL})
+    ORDER BY t.id
     """
-    cur = await db.execute(q, (now_iso,))
+    cur = await db.execute(q, {"now": now_ts})
     rows = await cur.fetchall()
     keys = ["id","user_id","description","deadline","status","started_at","next_reminder_at","tg_id"]
     return [dict(zip(keys, r)) for r in rows]
@@ -6475,7 +8576,7 @@ async def fetch_due_tasks(db):
 async def mark_reminded(db, task_id: int, next_iso: str | None = None, hours: int = 1):
     now = datetime.now(UTC)
     if next_iso:
-        next_at = dateparser.parse(next_iso)
+        next_at = _parse_iso(next_iso)
     else:
         next_at = now + timedelta(hours=hours)
     next_at = clamp_to_work_hours(next_at)
@@ -6484,71 +8585,211 @@ async def mark_reminded(db, task_id: int, next_iso: str | None = None, hours: in
         (now.isoformat(), next_at.isoformat(), task_id)
     )
     await db.commit()
+    await reminders_refresh(db, task_id)
 
-async def scheduler_job():
-    logging.info("Scheduler tick")
-    now_utc = datetime.now(UTC)
+# =========================
+# Движок напоминаний: куча ближайших событий вместо опроса раз в минуту
+# =========================
+REMINDER_RESYNC_MIN = max(1, int(os.getenv("REMINDER_RESYNC_MIN", "30")))
+OVERDUE_GRACE = timedelta(minutes=5)
+
+# (epoch_sec, task_id); устаревшие записи не удаляем, а пропускаем при извлечении
+_rem_heap: list[tuple[float, int]] = []
+# task_id → актуальный момент события (то, что считается «правдой» для кучи)
+_rem_due: dict[int, float] = {}
+_rem_wakeup = asyncio.Event()
+_rem_task: asyncio.Task | None = None
+# задачи, по которым сейчас идёт отправка (отправка через очередь может ждать лимитов)
+_rem_inflight: dict[int, asyncio.Task] = {}
+
+def _reminder_due_at(next_ts: int | None, deadline_ts: int | None) -> float | None:
+    """
+    Момент, когда задаче нужно внимание планировщика:
+    не раньше дедлайна и не раньше next_reminder_at. Без дедлайна — никогда.
+    """
+    if deadline_ts is None:
+        return None
+    return float(max(deadline_ts, next_ts if next_ts is not None else deadline_ts))
+
+def reminder_schedule(task_id: int, due_ts: float | None):
+    """Поставить/снять событие задачи. Будит цикл, если новое событие раньше текущего «головного»."""
+    if due_ts is None:
+        _rem_due.pop(task_id, None)
+        return
+    if _rem_due.get(task_id) == due_ts:
+        return
+    _rem_due[task_id] = due_ts
+    head = _rem_heap[0][0] if _rem_heap else None
+    heapq.heappush(_rem_heap, (due_ts, task_id))
+    if head is None or due_ts < head:
+        _rem_wakeup.set()
+
+async def reminders_refresh(db, task_id: int):
+    """Перечитать задачу и переставить её событие. Звать после записи deadline/next_reminder_at."""
+    cur = await db.execute("SELECT status, next_reminder_ts, deadline_ts FROM tasks WHERE id=?", (task_id,))
+    row = await cur.fetchone()
+    if not row or row[0] == "done":
+        reminder_schedule(task_id, None)
+        return
+    reminder_schedule(task_id, _reminder_due_at(row[1], row[2]))
 
-    async with aiosqlite.connect(DB_PATH) as db:
+async def reminders_load():
+    """Полная загрузка кучи из БД (старт и периодическая сверка)."""
+    async with db_read() as db:
+        cur = await db.execute(
+            # «+» отключает idx_tasks_deadline_ts (там вся история) — читаем частичный idx_tasks_open_due
+            "SELECT id, next_reminder_ts, deadline_ts FROM tasks WHERE status!='done' AND +deadline_ts IS NOT NULL"
+        )
+        rows = await cur.fetchall()
+    _rem_heap.clear()
+    _rem_due.clear()
+    for tid, next_ts, dl_ts in rows:
+        due = _reminder_due_at(next_ts, dl_ts)
+        if due is not None:
+            _rem_due[tid] = due
+            _rem_heap.append((due, tid))
+    heapq.heapify(_rem_heap)
+    _rem_wakeup.set()
+    logging.info("Reminders loaded: %s pending", len(_rem_due))
+
+async def _reminder_fire(tid: int, now_utc: datetime) -> float | None:
+    """
+    Обработать наступившее событие задачи. Возвращает следующий момент (epoch) или None.
+      • дедлайн наступил (меньше 5 минут назад) — «время вышло», проверка через 5 минут;
+      • прошло 5+ минут — просрочка сотруднику и руководителям, следующая проверка через час.
+    """
+    async with db_read() as db:
         cur = await db.execute("""
-            SELECT t.id, t.user_id, t.description, t.status, t.deadline,
-                   t.next_reminder_at, u.tg_id, u.full_name
+            SELECT t.user_id, t.description, t.status, t.deadline, t.deadline_ts, t.next_reminder_ts,
+                   u.tg_id, u.full_name
             FROM tasks t
             JOIN users u ON u.id = t.user_id
-            WHERE t.status!='done'
-              AND (
-                    (t.next_reminder_at IS NOT NULL AND t.next_reminder_at <= ?)
-                 OR (t.deadline IS NOT NULL AND t.deadline <= ? AND t.next_reminder_at IS NULL)
-              )
-            ORDER BY t.id ASC
-        """, (now_utc.isoformat(), now_utc.isoformat()))
-        tasks = await cur.fetchall()
+            WHERE t.id=?
+        """, (tid,))
+        row = await cur.fetchone()
+        if not row or row[2] == "done":
+            return None
+        user_id, desc, status, dl_iso, dl_ts, next_ts, tg_id, emp_name = row
+        due = _reminder_due_at(next_ts, dl_ts)
+        if due is None or due > now_utc.timestamp() + 1:
+            # задачу успели перенести — просто переставим событие
+            return due
+        mgr_ids = await get_manager_tg_ids(db, user_id)
+
+    dl_dt = datetime.fromtimestamp(dl_ts, UTC)
+
+    # 1) Дедлайн наступил: сообщение «время вышло» (не теряется, даже если цикл проснулся с опозданием)
+    if now_utc - dl_dt < OVERDUE_GRACE:
+        text_emp = text_deadline_reached(tid, desc or "", dl_iso)
+        resp = await send_queued(
+            tg_id, text_emp, parse_mode="HTML", reply_markup=_kb_overdue(tid).as_markup()
+        )
+        # Планируем проверку просрочки через 5 минут
+        next_check = dl_dt + OVERDUE_GRACE
+        async with db_write() as wdb:
+            await wdb.execute(
+                "UPDATE tasks SET last_reminder_msg_id=?, next_reminder_at=? WHERE id=?",
+                (resp.message_id, next_check.isoformat(), tid),
+            )
+            await wdb.commit()
+        return next_check.timestamp()
+
+    # 2) Просрочка (прошло 5+ минут после дедлайна)
+    text_emp = text_overdue_emp(emp_name, tid, desc or "", dl_iso)
+    await send_queued(
+        tg_id, text_emp, parse_mode="HTML", reply_markup=_kb_overdue(tid).as_markup()
+    )
+
+    # Руководителям — оповещение
+    if mgr_ids:
+        mgr_text = text_overdue_mgr(emp_name, tid, desc or "", dl_iso)
+        notify_many(mgr_ids, mgr_text, what="overdue", parse_mode="HTML")
+
+    # Следующая проверка через час
+    next_check = now_utc + timedelta(hours=1)
+    async with db_write() as wdb:
+        await wdb.execute("UPDATE tasks SET next_reminder_at=? WHERE id=?", (next_check.isoformat(), tid))
+        await wdb.commit()
+    return next_check.timestamp()
+
+async def _reminder_run(tid: int):
+    now_utc = datetime.now(UTC)
+    try:
+        nxt = await _reminder_fire(tid, now_utc)
+    except Exception as e:
+        logging.warning(f"reminder failed for task {tid}: {e}")
+        # не крутимся в горячем цикле на сломанной задаче
+        nxt = (now_utc + timedelta(minutes=5)).timestamp()
+    reminder_schedule(tid, nxt)
+
+def _reminder_dispatch(tid: int) -> asyncio.Task | None:
+    """Запустить отработку события задачи, если по ней ещё не идёт отправка (иначе — None)."""
+    if tid in _rem_inflight:
+        return None  # предыдущая отправка ещё идёт — она сама переставит событие
+    t = asyncio.create_task(_reminder_run(tid), name=f"reminder-{tid}")
+    _rem_inflight[tid] = t
+    t.add_done_callback(lambda _t, tid=tid: _rem_inflight.pop(tid, None))
+    return t
+
+async def reminders_loop():
+    """Спим ровно до ближайшего события; O(log n) на событие, без сканирования таблицы."""
+    while True:
+        # выкидываем устаревшие записи с головы кучи
+        while _rem_heap and _rem_due.get(_rem_heap[0][1]) != _rem_heap[0][0]:
+            heapq.heappop(_rem_heap)
 
-        for tid, user_id, desc, status, dl_iso, next_iso, tg_id, emp_name in tasks:
+        if not _rem_heap:
+            _rem_wakeup.clear()
+            await _rem_wakeup.wait()
+            continue
+
+        delay = _rem_heap[0][0] - time.time()
+        if delay > 0:
+            _rem_wakeup.clear()
             try:
-                dl_dt = None
-                if dl_iso:
-                    dl_dt = dateparser.parse(dl_iso)
-
-                # 1) Ровно в дедлайн: сообщение «время вышло»
-                if dl_dt and abs((now_utc - dl_dt).total_seconds()) < 60:
-                    text_emp = text_deadline_reached(tid, desc or "", dl_iso)
-                    resp = await bot.send_message(
-                        tg_id, text_emp, parse_mode="HTML", reply_markup=_kb_overdue(tid).as_markup()
-                    )
-                    # Планируем проверку просрочки через 5 минут
-                    next_check = (dl_dt + timedelta(minutes=5)).isoformat()
-                    await db.execute(
-                        "UPDATE tasks SET last_reminder_msg_id=?, next_reminder_at=? WHERE id=?",
-                        (resp.message_id, next_check, tid),
-                    )
-                    await db.commit()
-                    continue
-
-                # 2) Просрочка (прошло 5+ минут после дедлайна)
-                if dl_dt and (now_utc - dl_dt) > timedelta(minutes=5):
-                    text_emp = text_overdue_emp(emp_name, tid, desc or "", dl_iso)
-                    await bot.send_message(
-                        tg_id, text_emp, parse_mode="HTML", reply_markup=_kb_overdue(tid).as_markup()
-                    )
-
-                    # Руководителям — оповещение
-                    mgr_ids = await get_manager_tg_ids(db, user_id)
-                    if mgr_ids:
-                        mgr_text = text_overdue_mgr(emp_name, tid, desc or "", dl_iso)
-                        for mid in mgr_ids:
-                            try:
-                                await bot.send_message(mid, mgr_text, parse_mode="HTML")
-                            except Exception as e:
-                                logging.warning(f"notify manager failed (overdue) tg_id={mid}: {e}")
-
-                    # Следующая проверка через час
-                    next_check = (now_utc + timedelta(hours=1)).isoformat()
-                    await db.execute("UPDATE tasks SET next_reminder_at=? WHERE id=?", (next_check, tid))
-                    await db.commit()
+                await asyncio.wait_for(_rem_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
 
-            except Exception as e:
-                logging.warning(f"scheduler loop failed for task {tid}: {e}")
+        due_ts, tid = heapq.heappop(_rem_heap)
+        _rem_due.pop(tid, None)
+        _reminder_dispatch(tid)
+
+async def reminders_start():
+    global _rem_task
+    await reminders_load()
+    if _rem_task is None or _rem_task.done():
+        _rem_task = asyncio.create_task(reminders_loop(), name="reminders_loop")
+
+async def reminders_stop():
+    global _rem_task
+    if _rem_task is not None:
+        _rem_task.cancel()
+        try:
+            await _rem_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _rem_task = None
+
+async def scheduler_job():
+    """
+    Ручная проверка (/forcecheck): сверить кучу с БД и сразу отработать всё просроченное.
+    Регулярно больше не вызывается — событиями управляет reminders_loop().
+    """
+    logging.info("Reminders resync")
+    await reminders_load()
+    async with db_read() as db:
+        due = await fetch_due_tasks(db)
+    # через тот же диспетчер, что и reminders_loop: задачу, которую цикл уже взял, второй раз не шлём
+    runs = []
+    for t in due:
+        _rem_due.pop(t["id"], None)
+        run = _reminder_dispatch(t["id"])
+        if run is not None:
+            runs.append(run)
+    if runs:
+        await asyncio.gather(*runs, return_exceptions=True)
 
 # ——— шедулер
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -6557,7 +8798,8 @@ def start_scheduler():
     """
     Планировщик для асинхронного окружения бота.
     Запускаем:
-      • reminders_job — проверка дедлайнов/просрочек (каждую минуту);
+      • reminders_resync — сверка кучи напоминаний с БД (REMINDER_RESYNC_MIN);
+        сами напоминания срабатывают в reminders_loop() точно в срок;
       • gsync_job     — синхронизация Google Sheets (период из .env);
       • proj_sync_job — синхронизация просрочек по проектам.
     """
@@ -6580,21 +8822,23 @@ def start_scheduler():
 
     sched = AsyncIOScheduler()
 
-    # 1) Проверка дедлайнов/просрочек — КАЖДУЮ МИНУТУ
+    # 1) Страховочная сверка кучи напоминаний с БД (на случай записей в обход reminders_refresh)
     sched.add_job(
-        scheduler_job,
+        reminders_load,
         trigger="interval",
-        seconds=60,
+        minutes=REMINDER_RESYNC_MIN,
         coalesce=True,
         max_instances=1,
         misfire_grace_time=30,
-        id="reminders_job",
+        id="reminders_resync",
         replace_existing=True,
     )
-    logging.info("Reminders job scheduled every 60 sec")
+    logging.info("Reminders resync scheduled every %s min", REMINDER_RESYNC_MIN)
 
-    # 2) Синхронизация Google Sheets — если конфиг готов
-    if gs_ready:
+    # 2) Синхронизация Google Sheets — если конфиг готов (в режиме worker её планирует воркер)
+    if SHEETS_SYNC_MODE == "worker":
+        logging.info("Google Sheets sync runs in a separate worker process (SHEETS_SYNC_MODE=worker)")
+    elif gs_ready:
         sched.add_job(
             gs_sync_all,
             trigger="interval",
@@ -6609,17 +8853,18 @@ def start_scheduler():
     else:
         logging.info("Google Sheets sync job NOT scheduled (config not ready)")
 
-    # 3) Синхронизация просрочек по проектам — ВСЕГДА
-    sched.add_job(
-        projects_sync_overdues,
-        trigger="interval",
-        minutes=period_min,
-        coalesce=True,
-        max_instances=1,
-        misfire_grace_time=30,
-        id="proj_sync_job",
-        replace_existing=True,
-    )
+    # 3) Синхронизация просрочек по проектам — всегда (в режиме worker — у воркера)
+    if SHEETS_SYNC_MODE != "worker":
+        sched.add_job(
+            projects_sync_overdues,
+            trigger="interval",
+            minutes=period_min,
+            coalesce=True,
+            max_instances=1,
+            misfire_grace_time=30,
+            id="proj_sync_job",
+            replace_existing=True,
+        )
 
     sched.start()
     logging.info("Scheduler started")
@@ -6652,6 +8897,10 @@ async def setup_bot_commands():
             BotCommand(command="resetreg", description="Сбросить регистрацию пользователю"),
             BotCommand(command="forcecheck", description="Проверить напоминания сейчас"),
             BotCommand(command="taskinfo", description="Диагностика задачи"),
+            BotCommand(command="dbstats", description="Статистика БД и кэшей"),
+            BotCommand(command="kpibackfill", description="Пересобрать дневную свёртку KPI"),
+            BotCommand(command="sendstats", description="Очередь исходящих сообщений"),
+            BotCommand(command="gsstats", description="Статистика записи в Google Sheets"),
         ]
         await bot.set_my_commands(dev_cmds, scope=BotCommandScopeChat(chat_id=DEVELOPER_TG_ID))
 
@@ -6661,8 +8910,12 @@ async def setup_bot_commands():
 from aiogram.types.error_event import ErrorEvent  # корректный импорт для aiogram v3
 
 async def main():
+    await db_pool.open()
     await init_db()
     await setup_bot_commands()
+    await reminders_start()
+    if SHEETS_SYNC_MODE != "worker":
+        await sheets_outbox_start()
     start_scheduler()
     dp.update.middleware(AccessMiddleware())
     await bot.delete_webhook(drop_pending_updates=True)
@@ -6687,14 +8940,22 @@ async def main():
     try:
         await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
     finally:
+        await reminders_stop()
+        await sheets_outbox_stop()
+        await outbox.close()
         try:
             await bot.session.close()
         except Exception:
             pass
+        await db_pool.close()
 
 
 if __name__ == "__main__":
+    import sys
     try:
-        asyncio.run(main())
+        if sys.argv[1:2] == ["sheets-worker"]:
+            asyncio.run(sheets_worker_main())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Бот остановлен вручную.")
@@ -0,0 +1,316 @@
+"""
+Офлайн-заглушка Google Sheets для тестов и бенчмарков синхронизации (bot.py о ней не знает).
+Повторяет ту часть интерфейса gspread_asyncio, которой пользуется бот. Каждый вызов проходит
+через bot.gs_quota (бакеты, backoff) как настоящий, считается в stats, может ждать latency_ms
+и с вероятностью rate_429 отвечать 429. Подключается через use_fake(backend).
+"""
+import random
+import asyncio
+from unittest import mock
+
+from gspread.utils import a1_to_rowcol
+
+import bot
+
+
+class FakeSheetsAPIError(Exception):
+    """Ответ заглушки с кодом ошибки (текст — как у gspread.exceptions.APIError)."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"APIError: [{code}]: {message}")
+        self.code = code
+
+
+class FakeSheetsBackend:
+    """Хранилище таблиц заглушки и счётчики вызовов «API»."""
+
+    def __init__(self, latency_ms: float = 0.0, rate_429: float = 0.0, locale: str = "en"):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.locale = locale
+        self.spreadsheets: dict[str, FakeSpreadsheet] = {}
+        self.stats: dict[str, int] = {}
+        self._rng = random.Random(0)
+
+    def reset_stats(self):
+        self.stats = {}
+
+    def calls(self) -> int:
+        return sum(v for k, v in self.stats.items() if not k.startswith("!"))
+
+    async def call(self, name: str, fn):
+        """Один «запрос к API»: квота → задержка → (может быть) 429 с повтором через bot.gs_quota.backoff."""
+        def method():
+            pass
+        method.__name__ = name
+        attempt = 0
+        while True:
+            await bot.gs_quota.before_call(method, {})
+            self.stats[name] = self.stats.get(name, 0) + 1
+            if self.latency_ms:
+                await asyncio.sleep(self.latency_ms / 1000)
+            if self.rate_429 and self._rng.random() < self.rate_429:
+                self.stats["!429"] = self.stats.get("!429", 0) + 1
+                bot.gs_quota.stats["rate_limited"] += 1
+                attempt += 1
+                await bot.gs_quota.backoff(FakeSheetsAPIError(429, "Quota exceeded (fake)"), method, attempt)
+                continue
+            return fn()
+
+    def spreadsheet(self, gs_id: str) -> "FakeSpreadsheet":
+        sh = self.spreadsheets.get(gs_id)
+        if sh is None:
+            sh = self.spreadsheets[gs_id] = FakeSpreadsheet(self, gs_id)
+        return sh
+
+
+class FakeGspreadClientManager:
+    """Вместо QuotaGspreadClientManager: authorize() отдаёт клиента с open_by_key()."""
+
+    def __init__(self, backend: FakeSheetsBackend):
+        self.backend = backend
+
+    async def authorize(self):
+        return self
+
+    async def open_by_key(self, gs_id: str):
+        return await self.backend.call("open_by_key", lambda: self.backend.spreadsheet(gs_id))
+
+
+class FakeWorksheet:
+    def __init__(self, sh: "FakeSpreadsheet", sheet_id: int, title: str, rows: int, cols: int):
+        self.sh = sh
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.frozen = (0, 0)
+        self.cells: dict[tuple[int, int], object] = {}   # (row0, col0) -> значение
+        self.notes: dict[tuple[int, int], str] = {}
+        self.formats: dict[tuple[int, int], dict] = {}
+        self.cf_rules: list[dict] = []
+
+    def _state(self) -> tuple:
+        return (self.row_count, self.col_count, self.frozen, dict(self.cells), dict(self.notes),
+                {k: dict(v) for k, v in self.formats.items()}, list(self.cf_rules))
+
+    def _restore(self, st: tuple):
+        (self.row_count, self.col_count, self.frozen, self.cells, self.notes, self.formats, self.cf_rules) = st
+
+    def _set_values(self, r0: int, c0: int, values: list[list]):
+        # values.update/batchUpdate у Google сами расширяют сетку (в отличие от updateCells)
+        self.row_count = max(self.row_count, r0 + len(values))
+        self.col_count = max(self.col_count, c0 + max((len(v) for v in values), default=0))
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self.cells[(r0 + i, c0 + j)] = v
+
+    async def clear(self):
+        await self.sh.backend.call("values_clear", self.cells.clear)
+
+    async def update(self, a, b=None, value_input_option=None, **kw):
+        # как в gspread 6: update(range, values) и update(values, range) оба допустимы
+        rng, values = (a, b) if isinstance(a, str) else (b or "A1", a)
+        r, c = _fake_a1_start(rng)
+        await self.sh.backend.call("values_update", lambda: self._set_values(r, c, values))
+
+    async def freeze(self, rows=None, cols=None):
+        def _do():
+            self.frozen = (rows if rows is not None else self.frozen[0], cols if cols is not None else self.frozen[1])
+        await self.sh.backend.call("batch_update", _do)
+
+    async def format(self, rng: str, fmt: dict):
+        r, c = _fake_a1_start(rng.split(":")[0])
+        await self.sh.backend.call("batch_update", lambda: self.formats.setdefault((r, c), {}).update(fmt))
+
+    async def add_rows(self, n: int):
+        def _do():
+            self.row_count += n
+        await self.sh.backend.call("batch_update", _do)
+
+    async def resize(self, rows: int | None = None, cols: int | None = None):
+        def _do():
+            if rows is not None:
+                self.row_count = rows
+                self.cells = {k: v for k, v in self.cells.items() if k[0] < rows}
+            if cols is not None:
+                self.col_count = cols
+                self.cells = {k: v for k, v in self.cells.items() if k[1] < cols}
+        await self.sh.backend.call("batch_update", _do)
+
+    async def col_values(self, col: int) -> list:
+        def _do():
+            rows = [r for (r, c) in self.cells if c == col - 1]
+            return [self.cells.get((r, col - 1), "") for r in range(max(rows) + 1)] if rows else []
+        return await self.sh.backend.call("col_values", _do)
+
+    async def get_all_values(self) -> list[list]:
+        def _do():
+            if not self.cells:
+                return []
+            nr = max(r for r, _ in self.cells) + 1
+            nc = max(c for _, c in self.cells) + 1
+            return [[self.cells.get((r, c), "") for c in range(nc)] for r in range(nr)]
+        return await self.sh.backend.call("get_all_values", _do)
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend: FakeSheetsBackend, gs_id: str):
+        self.backend = backend
+        self.id = gs_id
+        self.title = f"fake {gs_id}"
+        self._ws: dict[str, FakeWorksheet] = {}
+        # как кэш листов gspread_asyncio: известный лист отдаётся без запроса
+        self._cached: set[str] = set()
+        self._next_id = 1
+        self._add("Sheet1", 1000, 26)
+
+    def _add(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        if title in self._ws:
+            raise FakeSheetsAPIError(400, f'INVALID_ARGUMENT: A sheet with the name "{title}" already exists.')
+        ws = self._ws[title] = FakeWorksheet(self, self._next_id, title, rows, cols)
+        self._next_id += 1
+        return ws
+
+    def _by_id(self, sheet_id: int) -> FakeWorksheet:
+        for ws in self._ws.values():
+            if ws.id == sheet_id:
+                return ws
+        raise FakeSheetsAPIError(400, f"INVALID_ARGUMENT: No grid with id: {sheet_id}")
+
+    def _wrap_ws(self, ws):
+        return ws
+
+    async def fetch_sheet_metadata(self, params=None) -> dict:
+        def _do():
+            # GSRegistry прогревает кэш листов из этих же метаданных
+            self._cached.update(self._ws)
+            return {
+                "properties": {"title": self.title, "locale": "ru_RU" if self.backend.locale == "ru" else "en_US"},
+                "sheets": [{
+                    "properties": {"sheetId": ws.id, "title": ws.title, "index": i,
+                                   "gridProperties": {"rowCount": ws.row_count, "columnCount": ws.col_count}},
+                    "conditionalFormats": [dict(r) for r in ws.cf_rules],
+                } for i, ws in enumerate(self._ws.values())],
+            }
+        return await self.backend.call("fetch_sheet_metadata", _do)
+
+    async def worksheets(self) -> list[FakeWorksheet]:
+        return await self.backend.call("worksheets", lambda: list(self._ws.values()))
+
+    async def worksheet(self, title: str) -> FakeWorksheet:
+        if title in self._cached and title in self._ws:
+            return self._ws[title]
+        def _do():
+            if title not in self._ws:
+                raise FakeSheetsAPIError(400, f"WorksheetNotFound: {title}")
+            self._cached.add(title)
+            return self._ws[title]
+        return await self.backend.call("worksheet", _do)
+
+    async def add_worksheet(self, title: str, rows: int = 100, cols: int = 26, index=None) -> FakeWorksheet:
+        def _do():
+            ws = self._add(title, rows, cols)
+            self._cached.add(title)
+            return ws
+        return await self.backend.call("add_worksheet", _do)
+
+    def _apply(self, req: dict):
+        (kind, body), = req.items()
+        if kind == "updateSheetProperties":
+            props = body["properties"]
+            ws = self._by_id(props["sheetId"])
+            gp = props.get("gridProperties", {})
+            ws.row_count = gp.get("rowCount", ws.row_count)
+            ws.col_count = gp.get("columnCount", ws.col_count)
+            ws.frozen = (gp.get("frozenRowCount", ws.frozen[0]), gp.get("frozenColumnCount", ws.frozen[1]))
+        elif kind in ("updateCells", "repeatCell"):
+            rng = body.get("range") or {"sheetId": body["start"]["sheetId"],
+                                        "startRowIndex": body["start"].get("rowIndex", 0),
+                                        "startColumnIndex": body["start"].get("columnIndex", 0)}
+            ws = self._by_id(rng["sheetId"])
+            r0, c0 = rng.get("startRowIndex", 0), rng.get("startColumnIndex", 0)
+            if kind == "repeatCell":
+                cell = body.get("cell", {})
+                cells = [(r, c) for r in range(r0, rng.get("endRowIndex", r0 + 1))
+                         for c in range(c0, rng.get("endColumnIndex", c0 + 1))]
+                for rc in cells:
+                    ws.formats.setdefault(rc, {}).update(cell.get("userEnteredFormat", {}))
+                return
+            if "rows" not in body:
+                # без rows — очистка полей диапазона (здесь: всего листа или прямоугольника)
+                r1, c1 = rng.get("endRowIndex", ws.row_count), rng.get("endColumnIndex", ws.col_count)
+                for store in (ws.cells, ws.notes, ws.formats):
+                    for rc in [rc for rc in store if r0 <= rc[0] < r1 and c0 <= rc[1] < c1]:
+                        del store[rc]
+                return
+            for i, row in enumerate(body["rows"]):
+                for j, cell in enumerate(row.get("values", [])):
+                    rc = (r0 + i, c0 + j)
+                    if rc[0] >= ws.row_count or rc[1] >= ws.col_count:
+                        raise FakeSheetsAPIError(400, f"INVALID_ARGUMENT: range exceeds grid limits of '{ws.title}'")
+                    uv = cell.get("userEnteredValue")
+                    if uv:
+                        ws.cells[rc] = next(iter(uv.values()))
+                    if "note" in cell:
+                        ws.notes[rc] = cell["note"]
+                    if "userEnteredFormat" in cell:
+                        ws.formats.setdefault(rc, {}).update(cell["userEnteredFormat"])
+        elif kind == "addConditionalFormatRule":
+            rule = body["rule"]
+            ws = self._by_id(rule["ranges"][0]["sheetId"])
+            formula = ((rule.get("booleanRule") or {}).get("condition") or {}).get("values", [{}])[0].get("userEnteredValue", "")
+            # локаль листа: RU не принимает AND и запятые, EN — И и точки с запятой
+            if (self.backend.locale == "ru" and ("AND(" in formula or "," in formula)) or \
+               (self.backend.locale != "ru" and ("И(" in formula or ";" in formula)):
+                raise FakeSheetsAPIError(400, "INVALID_ARGUMENT: Invalid ConditionValue.userEnteredValue")
+            ws.cf_rules.insert(body.get("index", 0), rule)
+        elif kind == "deleteConditionalFormatRule":
+            del self._by_id(body["sheetId"]).cf_rules[body["index"]]
+        else:
+            raise FakeSheetsAPIError(400, f"INVALID_ARGUMENT: fake does not support {kind}")
+
+    async def batch_update(self, body: dict) -> dict:
+        def _do():
+            # как у Google: запрос атомарен — при ошибке не применяется ничего
+            saved = {title: ws._state() for title, ws in self._ws.items()}
+            try:
+                for req in body.get("requests", []):
+                    self._apply(req)
+            except Exception:
+                for title, st in saved.items():
+                    self._ws[title]._restore(st)
+                raise
+            return {"replies": [{} for _ in body.get("requests", [])]}
+        return await self.backend.call("batch_update", _do)
+
+    async def values_batch_update(self, body: dict) -> dict:
+        def _do():
+            for item in body.get("data", []):
+                title, _, a1 = item["range"].rpartition("!")
+                ws = self._ws.get(title.strip("'"))
+                if ws is None:
+                    raise FakeSheetsAPIError(400, f"INVALID_ARGUMENT: Unable to parse range: {item['range']}")
+                r, c = _fake_a1_start(a1)
+                ws._set_values(r, c, item["values"])
+            return {"totalUpdatedCells": sum(len(v) for d in body.get("data", []) for v in d["values"])}
+        return await self.backend.call("values_batch_update", _do)
+
+
+def _fake_a1_start(a1: str) -> tuple[int, int]:
+    """'B3' или 'B3:F9' → (строка, колонка) левого верхнего угла, с нуля."""
+    r, c = a1_to_rowcol(a1.split(":")[0])
+    return r - 1, c - 1
+
+
+def use_fake(backend: FakeSheetsBackend):
+    """
+    Подменить в bot фабрику менеджера клиента и конфиг обеих таблиц на заглушку.
+    Возвращает mock.patch.multiple: `with use_fake(b): ...` или start()/stop() в тестах.
+    """
+    return mock.patch.multiple(
+        bot,
+        _agcm_builder=lambda abs_credentials_path: FakeGspreadClientManager(backend),
+        _require_gs_config=lambda: ("fake-main", "fake"),
+        _require_gs_projects_config=lambda: ("fake-projects", "fake"),
+    )
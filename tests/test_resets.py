@@ -0,0 +1,108 @@
+"""
+Сбросы базы (/admin → полный сброс и db_full_reset) на заполненной временной базе:
+ни одна таблица не «застревает» из-за внешних ключей, остаётся только разработчик.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("BOT_TOKEN", "123456:offline-test-token")
+
+import bot  # noqa: E402
+
+DEV_TG = 1001
+CHILD_TABLES = ["task_events", "kpi_daily", "gantt_rows", "daily_plan_items", "manager_links", "tasks"]
+
+
+class ResetTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        bot.db_pool.path = os.path.join(self._tmp.name, "test.db")
+        await bot.db_pool.open()
+        await bot.init_db()
+        await self._populate()
+
+    async def asyncTearDown(self):
+        await bot.db_pool.close()
+        bot.db_pool.path = bot.DB_PATH
+        self._tmp.cleanup()
+
+    async def _populate(self):
+        async with bot.db_write() as db:
+            await db.execute("INSERT INTO users(id, tg_id, full_name, role) VALUES (1, ?, 'Dev', 'developer')", (DEV_TG,))
+            await db.execute("INSERT INTO users(id, tg_id, full_name, role) VALUES (2, 2002, 'Сотр.', 'employee')")
+            await db.execute("INSERT INTO manager_links(manager_user_id, subordinate_user_id) VALUES (1, 2)")
+            await db.execute("INSERT INTO tasks(id, user_id, description, deadline, status, completed_at) "
+                             "VALUES (1, 2, 'x', '2026-10-01T10:00:00+00:00', 'done', '2026-10-01T11:00:00+00:00')")
+            await db.execute("INSERT INTO task_events(task_id, event, at) VALUES (1, 'done', '2026-10-01T11:00:00+00:00')")
+            await bot.kpi_daily_backfill(db)
+            await db.execute("INSERT INTO gantt_rows(task_id, row_index) VALUES (1, 2)")
+            await db.execute("INSERT INTO daily_plan_items(user_id, plan_date, text, time_str) VALUES (2, '2026-10-01', 'p', '10:00')")
+            await db.execute("INSERT INTO projects(id, name, created_by_id) VALUES (1, 'P', 2)")
+            await db.execute("INSERT INTO project_meta(project_id, prj_type, start_date, deadline, sheet_title) "
+                             "VALUES (1, '3D', '2026-10-01', '2026-10-10', 'P')")
+            await db.execute("INSERT INTO project_tasks(id, project_id, row_index, task_text, assignee_user_id, planned_date) "
+                             "VALUES (1, 1, 2, 't', 2, '2026-10-02')")
+            await db.execute("INSERT INTO project_cell_paint(project_task_id, col_index, color) VALUES (1, 3, 'c')")
+            await db.execute("INSERT INTO project_links(project_id, title, url, created_by_id) VALUES (1, 'l', 'u', 2)")
+            await db.execute("INSERT INTO creds(title, login, password, created_by_id, created_at) "
+                             "VALUES ('s', 'l', 'p', 2, '2026-10-01')")
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="P", row=2, col=1, values=["t"])
+            await db.commit()
+
+    async def _count(self, table: str) -> int:
+        async with bot.db_read() as db:
+            cur = await db.execute(f"SELECT COUNT(*) FROM {table}")
+            return (await cur.fetchone())[0]
+
+    async def _tg_ids(self) -> list[int]:
+        async with bot.db_read() as db:
+            cur = await db.execute("SELECT tg_id FROM users ORDER BY id")
+            return [r[0] for r in await cur.fetchall()]
+
+    async def test_admin_reset_keeps_only_developer(self):
+        answers = []
+
+        async def _answer(*a, **kw):
+            answers.append(a)
+
+        cq = SimpleNamespace(from_user=SimpleNamespace(id=DEV_TG), answer=_answer,
+                             message=SimpleNamespace(edit_text=_answer))
+        me = {"id": 1, "tg_id": DEV_TG, "role": "developer"}
+        await bot.admin_reset_confirm(cq, current_user=me)
+
+        self.assertEqual(await self._tg_ids(), [DEV_TG])
+        for t in CHILD_TABLES:
+            self.assertEqual(await self._count(t), 0, t)
+        self.assertIn(("Сброшено",), answers)
+
+    async def test_full_reset_clears_everything(self):
+        with mock.patch.dict(os.environ, {"DEVELOPER_TG_ID": str(DEV_TG)}):
+            await bot.db_full_reset()
+        self.assertEqual(await self._tg_ids(), [DEV_TG])
+        for t in CHILD_TABLES + ["projects", "project_meta", "project_tasks", "project_cell_paint",
+                                 "project_links", "creds", "sheets_outbox"]:
+            self.assertEqual(await self._count(t), 0, t)
+
+    async def test_full_reset_order_respects_foreign_keys(self):
+        # тот же сброс с включёнными внешними ключами: дочерние таблицы удаляются раньше родительских
+        async with bot.db_write(batch=False) as db:
+            await db.commit()
+            await db.execute("PRAGMA foreign_keys=ON")
+            cur = await db.execute("PRAGMA foreign_keys")
+            self.assertEqual((await cur.fetchone())[0], 1)
+        try:
+            await self.test_full_reset_clears_everything()
+        finally:
+            async with bot.db_write(batch=False) as db:
+                await db.execute("PRAGMA foreign_keys=OFF")
+
+
+if __name__ == "__main__":
+    unittest.main()
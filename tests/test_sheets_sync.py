@@ -0,0 +1,260 @@
+"""
+Синхронизация с Google Sheets на офлайн-заглушке (tests/sheets_fake.py): что оказалось в ячейках,
+какие правила CF стоят и сколько «запросов к API» ушло. База — временная, на каждый тест своя.
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import gspread
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+# bot.py при импорте требует токен; в Telegram тесты не ходят
+os.environ.setdefault("BOT_TOKEN", "123456:offline-test-token")
+
+import bot  # noqa: E402
+from tests.sheets_fake import FakeSheetsAPIError, FakeSheetsBackend, FakeSpreadsheet, use_fake  # noqa: E402
+
+fake = FakeSheetsBackend()
+
+
+def _cells(title: str, gs_id: str = "fake-main") -> dict:
+    return fake.spreadsheets[gs_id]._ws[title].cells
+
+def _column(title: str, col: int, gs_id: str = "fake-main") -> list:
+    cells = _cells(title, gs_id)
+    return [cells[(r, c)] for r, c in sorted(cells) if c == col and r > 0]
+
+
+class _FlakyManager(bot.QuotaGspreadClientManager):
+    """Настоящий _call/backoff, но «запрос» — функция, которая первые fails раз отвечает 429."""
+
+    @staticmethod
+    def flaky(fails: int):
+        left = [fails]
+
+        def fetch_sheet_metadata():
+            if left[0]:
+                left[0] -= 1
+                resp = requests.Response()
+                resp.status_code = 429
+                resp._content = json.dumps({"error": {"code": 429, "message": "Quota exceeded",
+                                                      "status": "RESOURCE_EXHAUSTED"}}).encode()
+                raise gspread.exceptions.APIError(resp)
+            return {}
+        return fetch_sheet_metadata
+
+
+def _overdue(task: str) -> int:
+    cells = _cells("Gantt")
+    row = next(r for (r, c), v in cells.items() if c == 1 and v == task)
+    return int(cells[(row, bot.GANTT_HEADER.index("Просрочка (мин)"))])
+
+
+class SheetsSyncTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        bot.db_pool.path = os.path.join(self._tmp.name, "test.db")
+        await bot.db_pool.open()
+        await bot.init_db()
+        fake.spreadsheets.clear()
+        fake.reset_stats()
+        patcher = use_fake(fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        bot.gs_registry.invalidate()
+        bot._agcm_cache.update(path=None, mgr=None)
+        bot._agcm_cache_projects.update(path=None, mgr=None)
+        bot._sheets_buffers.clear()
+        bot._gs_cf_locale.clear()
+        # бакеты квоты — свои на каждый тест (и без ожидания)
+        bot.gs_quota.buckets = {k: bot._PriorityTokenBucket(100_000) for k in ("read", "write")}
+        self.now = datetime.now(bot.UTC)
+
+    async def asyncTearDown(self):
+        await bot.db_pool.close()
+        bot.db_pool.path = bot.DB_PATH
+        self._tmp.cleanup()
+
+    async def _add_tasks(self, rows: list[tuple]):
+        """rows: (описание, дедлайн, статус, сдана) — все задачи одному сотруднику."""
+        async with bot.db_write() as db:
+            await db.execute("INSERT OR IGNORE INTO users(id, tg_id, full_name, role) VALUES (1, 1, 'Тест', 'employee')")
+            await db.executemany(
+                "INSERT INTO tasks(user_id, description, deadline, status, completed_at) VALUES (1, ?, ?, ?, ?)",
+                [(d, dl.isoformat() if dl else None, st, fin.isoformat() if fin else None) for d, dl, st, fin in rows],
+            )
+            await db.commit()
+
+    async def _seed(self):
+        await self._add_tasks([
+            ("open", self.now + timedelta(days=1), "in_progress", None),
+            ("recent", self.now - timedelta(days=1), "done", self.now - timedelta(days=1)),
+            ("old", self.now - timedelta(days=200), "done", self.now - timedelta(days=200)),
+        ])
+        self.old_period = bot._gantt_period(int((self.now - timedelta(days=200)).timestamp()))[0]
+
+    async def test_full_sync_writes_current_sheet_periods_kpi_and_cf(self):
+        await self._seed()
+        await bot.gs_sync_all(full=True)
+
+        gantt = _cells("Gantt")
+        self.assertEqual([gantt[(0, c)] for c in range(len(bot.GANTT_HEADER))], bot.GANTT_HEADER)
+        self.assertEqual(_column("Gantt", 1), ["#2 recent", "#1 open"])
+        self.assertEqual(_column(bot._gantt_period_title(self.old_period), 1), ["#3 old"])
+        self.assertIn("KPI", fake.spreadsheets["fake-main"]._ws)
+
+        rules = fake.spreadsheets["fake-main"]._ws["Gantt"].cf_rules
+        formulas = [r["booleanRule"]["condition"]["values"][0]["userEnteredValue"] for r in rules]
+        self.assertEqual(sorted(formulas), sorted(en for en, _, _ in bot._TASK_CF_RULES))
+
+    async def test_idle_sync_makes_no_api_calls(self):
+        await self._seed()
+        # открытая просроченная: «Просрочка» растёт, но строку освежаем не чаще GANTT_OVERDUE_REFRESH_MIN
+        await self._add_tasks([("late", self.now - timedelta(minutes=30), "in_progress", None)])
+        await bot.gs_sync_all(full=True)
+        self.assertIn(_overdue("#4 late"), (30, 31))
+        # строка «устарела» (как будто прошли минуты), но окно ещё не прошло — в API не ходим
+        async with bot.db_write() as db:
+            await db.execute("UPDATE gantt_rows SET row_hash='' WHERE task_id=4")
+            await db.commit()
+        fake.reset_stats()
+        await bot.gs_sync_all()
+        self.assertEqual(fake.calls(), 0)
+
+        # окно прошло — строка переписывается точными минутами
+        async with bot.db_write() as db:
+            await bot.sync_state_set(db, "gantt_overdue_ts", "0")
+            await db.commit()
+        await bot.gs_sync_all()
+        self.assertEqual(fake.stats, {"values_batch_update": 1})
+        self.assertIn(_overdue("#4 late"), (30, 31, 32))
+
+    async def test_edit_of_open_task_writes_only_its_row(self):
+        await self._seed()
+        await bot.gs_sync_all(full=True)
+        async with bot.db_write() as db:
+            await db.execute("UPDATE tasks SET description='open (ред.)' WHERE id=1")
+            await db.commit()
+        fake.reset_stats()
+        await bot.gs_sync_all()
+        self.assertEqual(fake.stats, {"values_batch_update": 1})
+        self.assertEqual(_column("Gantt", 1), ["#2 recent", "#1 open (ред.)"])
+
+    async def test_closed_period_is_frozen_until_full_sync(self):
+        await self._seed()
+        await bot.gs_sync_all(full=True)
+        title = bot._gantt_period_title(self.old_period)
+        async with bot.db_write() as db:
+            await db.execute("UPDATE tasks SET description='old (ред.)' WHERE id=3")
+            await db.commit()
+        fake.reset_stats()
+        await bot.gs_sync_all()
+        self.assertEqual(fake.calls(), 0)
+        self.assertEqual(_column(title, 1), ["#3 old"])
+
+        await bot.gs_sync_all(full=True)
+        self.assertEqual(_column(title, 1), ["#3 old (ред.)"])
+
+    async def test_outbox_drain_writes_values_and_paint_in_one_batch(self):
+        async with bot.db_write() as db:
+            await bot.sheets_outbox_put(db, "ensure_project_ws", sheet_title="P", start="2026-10-01", end="2026-10-10")
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="P", row=2, col=1, values=["шаг", "Тест"])
+            await bot.sheets_outbox_put(db, "paint", sheet_title="P", row=2, col=3, color=bot.GREEN)
+            await db.commit()
+        self.assertEqual(await bot.sheets_outbox_drain(), 3)
+
+        ws = fake.spreadsheets["fake-projects"]._ws["P"]
+        self.assertEqual((ws.cells[(1, 0)], ws.cells[(1, 1)]), ("шаг", "Тест"))
+        self.assertEqual(ws.formats[(1, 2)]["backgroundColor"], bot.GREEN)
+        self.assertEqual(ws.cells[(0, 2)], "01.10.2026")
+        self.assertEqual((await bot.sheets_outbox_snapshot())["pending"], 0)
+
+    async def test_outbox_keeps_ops_when_flush_fails(self):
+        async with bot.db_write() as db:
+            await bot.sheets_outbox_put(db, "ensure_project_ws", sheet_title="P", start="2026-10-01", end="2026-10-10")
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="P", row=2, col=1, values=["шаг"])
+            await db.commit()
+        real = FakeSpreadsheet.batch_update
+
+        async def failing(sh, body):
+            if any("updateCells" in r for r in body.get("requests", [])):
+                raise FakeSheetsAPIError(500, "backend error")
+            return await real(sh, body)
+
+        with mock.patch.object(FakeSpreadsheet, "batch_update", failing):
+            self.assertEqual(await bot.sheets_outbox_drain(), 1)  # создание листа прошло
+        self.assertEqual((await bot.sheets_outbox_snapshot())["pending"], 1)
+
+        async with bot.db_write() as db:
+            await db.execute("UPDATE sheets_outbox SET next_try_ts=0")
+            await db.commit()
+        self.assertEqual(await bot.sheets_outbox_drain(), 1)
+        self.assertEqual(fake.spreadsheets["fake-projects"]._ws["P"].cells[(1, 0)], "шаг")
+
+    async def test_outbox_deferred_op_holds_only_its_sheet(self):
+        async with bot.db_write() as db:
+            for title in ("P", "Q"):
+                await bot.sheets_outbox_put(db, "ensure_project_ws", sheet_title=title, start="2026-10-01", end="2026-10-10")
+            await db.commit()
+        self.assertEqual(await bot.sheets_outbox_drain(), 2)
+
+        async with bot.db_write() as db:
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="P", row=2, col=1, values=["первый"])
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="Q", row=2, col=1, values=["другой лист"])
+            await bot.sheets_outbox_put(db, "set_values", sheet_title="P", row=2, col=1, values=["второй"])
+            # первая операция листа P отложена (как после неудачной попытки)
+            await db.execute("UPDATE sheets_outbox SET attempts=1, next_try_ts=? WHERE id=(SELECT MIN(id) FROM sheets_outbox)",
+                             (int(time.time()) + 600,))
+            await db.commit()
+        self.assertEqual(await bot.sheets_outbox_drain(), 1)
+        ws = fake.spreadsheets["fake-projects"]._ws
+        self.assertEqual(ws["Q"].cells[(1, 0)], "другой лист")
+        self.assertNotIn((1, 0), ws["P"].cells)
+
+        async with bot.db_write() as db:
+            await db.execute("UPDATE sheets_outbox SET next_try_ts=0")
+            await db.commit()
+        self.assertEqual(await bot.sheets_outbox_drain(), 2)
+        self.assertEqual(ws["P"].cells[(1, 0)], "второй")
+
+    async def test_quota_manager_does_not_serialize_calls(self):
+        # четыре «запроса» по 0.2 с: под call_lock gspread_asyncio они шли бы 0.8 с
+        def fetch_sheet_metadata():
+            time.sleep(0.2)
+            return {}
+
+        agcm = bot.QuotaGspreadClientManager(lambda: None, gspread_delay=0)
+        started = time.monotonic()
+        await asyncio.gather(*(agcm._call(fetch_sheet_metadata) for _ in range(4)))
+        self.assertLess(time.monotonic() - started, 0.6)
+
+    async def test_retries_are_counted_per_call(self):
+        # каждый вызов получает 429 ровно GS_MAX_RETRIES раз и проходит со следующей попытки:
+        # в сумме повторов втрое больше лимита, но счётчик у каждого _call свой — никто не сдаётся
+        agcm = _FlakyManager(lambda: None, gspread_delay=0)
+        stats = dict(bot.gs_quota.stats)
+        with mock.patch.object(bot, "GS_BACKOFF_BASE_SEC", 0.0), mock.patch.object(bot, "GS_BACKOFF_MAX_SEC", 0.0):
+            res = await asyncio.gather(*(agcm._call(agcm.flaky(bot.GS_MAX_RETRIES)) for _ in range(3)))
+            self.assertEqual(res, [{}] * 3)
+            self.assertEqual(bot.gs_quota.stats["retried"] - stats["retried"], 3 * bot.GS_MAX_RETRIES)
+            self.assertEqual(bot.gs_quota.stats["gave_up"], stats["gave_up"])
+
+            # а одному вызову сверх лимита — ошибка наружу
+            with self.assertRaises(gspread.exceptions.APIError):
+                await agcm._call(agcm.flaky(bot.GS_MAX_RETRIES + 1))
+        self.assertEqual(bot.gs_quota.stats["gave_up"], stats["gave_up"] + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()